@@ -0,0 +1,359 @@
+"""
+ABX discriminability of features in a h5features file, in-process.
+
+The items file is in the ABX *.item format (as made by abx_pairs.py):
+
+    #file onset offset #phone context talker
+    dr1_fcjf0_sa1 0.1 0.28 d e-g dr1_fcjf0
+
+and a task is given by its "on" label (A and X have the same, B another), its
+"by" labels (the same for A, B and X) and its "across" labels (the same for
+A and B, different for X). For each by context and each pair of on labels
+(c1, c2), the score is the proportion of the (A, B, X) triplets (A and X of
+c1, B of c2) for which the DTW distance between A and X is smaller than
+between B and X (ties count for 0.5). The ABX error is 1 - the mean of
+these scores.
+
+The features are loaded once. The DTW distances (normalized by the length
+of the path) use the "cos" (angle) or the "kl" (symmetrized Kullback-Leibler
+divergence, the frames being normalized to probability distributions)
+frame-wise distances, and are computed for batches of pairs of tokens at
+once. The by contexts are shared between a pool of processes:
+
+    python abx.py emb_wrd_test.features buckeye.item --on=phone --by=talker --dist=kl --ncore=18 --output=buckeye.phone.talker.emb_wrd_test.kl.output
+
+With --cache, the distances are also stored in (and read from) an sqlite
+file, keyed by (fingerprint of the features, token a, token b, distance), so
+that the tasks on the same features (e.g. talker.none and talker.phone)
+compute each distance only once, and that an interrupted evaluation resumes
+where it stopped (the cache is written after each by context).
+"""
+
+import sys
+import hashlib
+import sqlite3
+import numpy as np
+from collections import defaultdict
+from multiprocessing import Pool, cpu_count
+try:
+    import h5features
+except ImportError:  # only needed by abx_score (not by abx_proxy.py)
+    h5features = None
+
+EPS = 1.E-6
+BATCH_CELLS = 2**22  # padded DTW cells (or triplets) computed at once
+
+
+def read_items(fname):
+    """ Returns (labels names, [(file, onset, offset, labels)]). """
+    items = []
+    with open(fname) as f:
+        header = [c.lstrip('#') for c in f.readline().split()]
+        for line in f:
+            fields = line.split()
+            if len(fields):
+                items.append((fields[0], float(fields[1]), float(fields[2]),
+                    tuple(fields[3:])))
+    return header[3:], items
+
+
+def frame_distances(X, Y, dist='cos'):
+    """ [P, N, M] frame-wise distances between the frames of the padded
+    tokens X [P, N, dim] and Y [P, M, dim]. """
+    if dist == 'cos':
+        X = X / np.maximum(np.sqrt((X ** 2).sum(axis=-1)), EPS)[..., None]
+        Y = Y / np.maximum(np.sqrt((Y ** 2).sum(axis=-1)), EPS)[..., None]
+        return np.arccos(np.clip(np.matmul(X, Y.transpose(0, 2, 1)),
+            -1., 1.)) / np.pi
+    elif dist == 'kl':
+        X = np.maximum(X, EPS)
+        X /= X.sum(axis=-1)[..., None]
+        Y = np.maximum(Y, EPS)
+        Y /= Y.sum(axis=-1)[..., None]
+        lX = np.log(X)
+        lY = np.log(Y)
+        kl_xy = (X * lX).sum(axis=-1)[:, :, None] - np.matmul(X,
+                lY.transpose(0, 2, 1))
+        kl_yx = (Y * lY).sum(axis=-1)[:, None, :] - np.matmul(lX,
+                Y.transpose(0, 2, 1))
+        return 0.5 * (kl_xy + kl_yx)
+    raise ValueError("unknown distance " + dist)
+
+
+def dtw_batch(D, n, m):
+    """ DTW costs (normalized by the length of the path) of the [n[p], m[p]]
+    top-left parts of the P distance matrices D [P, N, M], computed along
+    the anti-diagonals for all of them at once. """
+    P, N, M = D.shape
+    cost = np.empty((P, N, M))
+    length = np.empty((P, N, M))
+    cost[:, 0, 0] = D[:, 0, 0]
+    length[:, 0, 0] = 1
+    for k in xrange(1, N + M - 1):
+        i = np.arange(max(0, k - M + 1), min(k, N - 1) + 1)
+        j = k - i
+        candidates = np.empty((3, P, len(i)))
+        lengths = np.ones((3, P, len(i)))
+        candidates.fill(np.inf)
+        for c, (di, dj) in enumerate(((1, 1), (1, 0), (0, 1))):
+            ok = (i >= di) & (j >= dj)
+            candidates[c][:, ok] = cost[:, i[ok] - di, j[ok] - dj]
+            lengths[c][:, ok] = length[:, i[ok] - di, j[ok] - dj]
+        best = np.argmin(candidates, axis=0)[None]
+        cost[:, i, j] = D[:, i, j] + np.take_along_axis(candidates, best,
+                0)[0]
+        length[:, i, j] = 1 + np.take_along_axis(lengths, best, 0)[0]
+    p = np.arange(P)
+    return cost[p, n - 1, m - 1] / length[p, n - 1, m - 1]
+
+
+def dtw_distances(tokens, pairs, dist='cos'):
+    """ DTW distances between the tokens (list of [frames, dim] arrays) of
+    each (i, j) of pairs, by batches of pairs of similar lengths. """
+    ret = np.zeros(len(pairs))
+    if not len(pairs):
+        return ret
+    pairs = np.asarray(pairs)
+    lengths = np.array([t.shape[0] for t in tokens])
+    n = lengths[pairs[:, 0]]
+    m = lengths[pairs[:, 1]]
+    order = np.lexsort((m, n))
+    dim = tokens[0].shape[1]
+    start = 0
+    while start < len(order):
+        end = start + 1
+        N, M = n[order[start]], m[order[start]]
+        while end < len(order):
+            N2 = max(N, n[order[end]])
+            M2 = max(M, m[order[end]])
+            if (end + 1 - start) * N2 * M2 > BATCH_CELLS:
+                break
+            N, M = N2, M2
+            end += 1
+        batch = order[start:end]
+        X = np.zeros((len(batch), N, dim))
+        Y = np.zeros((len(batch), M, dim))
+        for k, (a, b) in enumerate(pairs[batch]):
+            X[k, :lengths[a]] = tokens[a]
+            Y[k, :lengths[b]] = tokens[b]
+        ret[batch] = dtw_batch(frame_distances(X, Y, dist), n[batch],
+                m[batch])
+        start = end
+    return ret
+
+
+def score_context(D, on, across):
+    """ [(c1, c2, score, n triplets)] for the items of a by context, D being
+    their distances matrix, on their on labels and across their across
+    labels (or None). """
+    ret = []
+    on = np.asarray(on)
+    if across is not None:
+        across = np.asarray(across)
+    labels = sorted(set(on))
+    for c1 in labels:
+        A = np.where(on == c1)[0]  # and X
+        for c2 in labels:
+            if c2 == c1:
+                continue
+            B = np.where(on == c2)[0]
+            dBX = D[np.ix_(B, A)]
+            score = 0.
+            n = 0
+            step = max(1, BATCH_CELLS / (len(A) * len(B)))
+            for s in xrange(0, len(A), step):
+                X = A[s:s+step]
+                dAX = D[np.ix_(A, X)][:, None, :]
+                dbx = dBX[:, s:s+step][None, :, :]
+                valid = np.broadcast_to(A[:, None, None] != X[None, None, :],
+                        (len(A), len(B), len(X)))
+                if across is not None:
+                    valid = valid & (across[A][:, None, None] ==
+                            across[B][None, :, None]) & (
+                            across[A][:, None, None] != across[X][None, None, :])
+                score += (valid * ((dAX < dbx) + 0.5 * (dAX == dbx))).sum()
+                n += valid.sum()
+            if n:
+                ret.append((c1, c2, score / n, n))
+    return ret
+
+
+def features_fingerprint(times, features):
+    """ Hash of the contents (files names, times and features) of a
+    features store, as read by h5features.read. """
+    h = hashlib.sha1()
+    for name in sorted(features):
+        h.update(name.encode('utf-8'))
+        h.update(np.ascontiguousarray(times[name]).tostring())
+        h.update(np.ascontiguousarray(features[name]).tostring())
+    return h.hexdigest()
+
+
+def token_key(fname, onset, offset):
+    return "%s %r %r" % (fname, onset, offset)
+
+
+class DistanceCache(object):
+    """ DTW distances between tokens (identified by token_key) stored in an
+    sqlite file, for a given features fingerprint and distance. """
+    def __init__(self, fname, fingerprint, dist):
+        self.fingerprint = fingerprint
+        self.dist = dist
+        self._db = sqlite3.connect(fname, timeout=600)
+        self._db.execute("CREATE TABLE IF NOT EXISTS distances (features "
+                "TEXT, dist TEXT, a TEXT, b TEXT, d REAL, "
+                "PRIMARY KEY (features, dist, a, b))")
+        self._db.commit()
+
+    def load(self, keys):
+        """ {(i, j): distance} (i < j) of the pairs of keys in the cache. """
+        index = dict((k, i) for i, k in enumerate(keys))
+        ret = {}
+        for a, b, d in self._db.execute("SELECT a, b, d FROM distances "
+                "WHERE features=? AND dist=?", (self.fingerprint, self.dist)):
+            if a in index and b in index:
+                i, j = index[a], index[b]
+                ret[(min(i, j), max(i, j))] = d
+        return ret
+
+    def add(self, keys, pairs, distances):
+        self._db.executemany("INSERT OR REPLACE INTO distances VALUES "
+                "(?, ?, ?, ?, ?)", [(self.fingerprint, self.dist)
+                    + tuple(sorted((keys[i], keys[j]))) + (float(d),)
+                    for (i, j), d in zip(pairs, distances)])
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+_ABX = {}  # inherited (not copied) by the forked workers
+
+
+def _score_by_context(args):
+    by, indices, on, across = args
+    tokens = _ABX['tokens']
+    cached = _ABX['cached']
+    pairs = [(min(indices[a], indices[b]), max(indices[a], indices[b]))
+            for a in xrange(len(indices)) for b in xrange(a + 1, len(indices))]
+    d = np.array([cached.get(p, np.nan) for p in pairs])
+    missing = np.where(np.isnan(d))[0]
+    new_pairs = [pairs[k] for k in missing]
+    d[missing] = dtw_distances(tokens, new_pairs, _ABX['dist'])
+    D = np.zeros((len(indices), len(indices)))
+    iu = np.triu_indices(len(indices), 1)
+    D[iu] = d
+    D.T[iu] = d
+    return ([(by,) + r for r in score_context(D, on,
+        across if _ABX['across'] else None)], new_pairs, d[missing])
+
+
+def abx_score(features_fname, items_fname, on, by=(), across=(),
+        dist='cos', n_jobs=None, features_group='/features/', cache=None):
+    """ Returns the [(by labels, c1, c2, score, n triplets)] of the task
+    on/by/across (labels names of the items file) for the features.
+    cache is the (optional) sqlite file of the distances. """
+    names, items = read_items(items_fname)
+    times, features = h5features.read(features_fname, features_group)
+    tokens = []
+    keys = []
+    contexts = defaultdict(lambda: ([], [], []))  # indices, on, across
+    skipped = 0
+    i_on = names.index(on)
+    i_by = [names.index(b) for b in by]
+    i_across = [names.index(a) for a in across]
+    for fname, onset, offset, labels in items:
+        t = times[fname]
+        token = features[fname][(t >= onset) & (t <= offset)]
+        if not token.shape[0]:
+            skipped += 1
+            continue
+        indices, ons, acrosses = contexts[tuple(labels[i] for i in i_by)]
+        indices.append(len(tokens))
+        ons.append(labels[i_on])
+        acrosses.append(" ".join(labels[i] for i in i_across))
+        tokens.append(np.asarray(token, dtype='float64'))
+        keys.append(token_key(fname, onset, offset))
+    if skipped:
+        print >> sys.stderr, "skipped", skipped, "items without frames"
+    # the biggest contexts first, for the load balancing
+    tasks = sorted(((b,) + c for b, c in contexts.iteritems()),
+            key=lambda t: -len(t[1]))
+    _ABX['cached'] = {}
+    if cache is not None:
+        cache = DistanceCache(cache, features_fingerprint(times, features),
+                dist)
+        _ABX['cached'] = cache.load(keys)
+        print >> sys.stderr, len(_ABX['cached']), "cached distances"
+    del times, features
+    _ABX['tokens'] = tokens
+    _ABX['dist'] = dist
+    _ABX['across'] = len(across) > 0
+    if n_jobs is None:
+        n_jobs = cpu_count()
+    if n_jobs > 1:
+        pool = Pool(n_jobs)
+        results = pool.imap_unordered(_score_by_context, tasks, chunksize=1)
+    else:
+        results = (_score_by_context(t) for t in tasks)
+    rows = []
+    for rs, new_pairs, distances in results:
+        rows.extend(rs)
+        if cache is not None and len(new_pairs):
+            cache.add(keys, new_pairs, distances)
+    if n_jobs > 1:
+        pool.close()
+        pool.join()
+    if cache is not None:
+        cache.close()
+    _ABX.clear()
+    return sorted(rows)
+
+
+def write_scores(rows, by, on, fname=None):
+    """ Writes the per context scores (tab separated), returns the average
+    score. """
+    f = sys.stdout if fname is None else open(fname, 'w')
+    print >> f, "\t".join(list(by) + [on + '_1', on + '_2', 'score', 'n'])
+    for b, c1, c2, score, n in rows:
+        print >> f, "\t".join(list(b) + [c1, c2, str(score), str(n)])
+    if fname is not None:
+        f.close()
+    return np.mean([r[3] for r in rows])
+
+
+if __name__ == '__main__':
+    import argparse, json
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('features', help='h5features file')
+    parser.add_argument('items', help='ABX items file')
+    parser.add_argument('--on', default='phone', help='on label')
+    parser.add_argument('--by', default='', help='comma separated by labels')
+    parser.add_argument('--across', default='',
+            help='comma separated across labels')
+    parser.add_argument('--task', default=None, help='TASKS_JSON:NAME, a '
+            'task of the JSON written by abx_pairs.py --tasks (instead of '
+            '--on, --by and --across)')
+    parser.add_argument('--dist', default='cos', choices=['cos', 'kl'],
+            help='frame-wise distance')
+    parser.add_argument('--ncore', type=int, default=None,
+            help='number of processes (default: all the cores)')
+    parser.add_argument('--output', default=None,
+            help='per context scores file (default: stdout)')
+    parser.add_argument('--cache', default=None,
+            help='sqlite file of the distances, shared between the tasks '
+            'and the runs')
+    args = parser.parse_args()
+    on = args.on
+    by = [b for b in args.by.split(',') if b]
+    across = [a for a in args.across.split(',') if a]
+    if args.task is not None:
+        tasks_fname, name = args.task.rsplit(':', 1)
+        with open(tasks_fname) as f:
+            task = json.load(f)[name]
+        on, by, across = task['on'], task['by'], task['across']
+    rows = abx_score(args.features, args.items, on, by, across,
+            args.dist, args.ncore, cache=args.cache)
+    score = write_scores(rows, by, on, args.output)
+    print >> sys.stderr, "average score", score, "ABX error", 1. - score
@@ -1,72 +1,159 @@
 """ Takes an MLF as input and gives triphones in the *.items ABX format as output.
 
-python src/do_abx_pairs.py aligned.mlf [foldings.json]
+python src/do_abx_pairs.py aligned.mlf [foldings.json] [--features=FOLDER_OR_H5FEATURES] [--output=ITEMS] [--tasks=TASKS_JSON]
 
 e.g.:
 python src/do_abx_pairs.py /fhgfs/bootphon/scratch/gsynnaeve/TIMIT/train_dev_test_split/aligned_train.mlf timit_foldings.json
+
+The items are written as the MLF is read. Only the utterances with features
+are kept: by default the ones with a *_fbanks.npy next to their *.lab (each
+folder is listed once), or with --features the ones in a folder of features
+(e.g. npz7_train) or in a h5features file. With --tasks, the definitions of
+the phone/talker tasks on these items (see TASKS) are written in a JSON file
+for abx.py --task.
 """
 
 # currently tested only for TIMIT
-import sys, json
+import os, sys, json
+
+# name: (on, by, across), as the --on, --by and --across of abx.py
+TASKS = {'phone.talker': ('phone', ['talker'], []),
+         'talker.none': ('talker', [], []),
+         'talker.phone': ('talker', ['phone'], [])}
+
+
+def utterance_name(fname):
+    """ Name of the features of an utterance of the MLF (or of a features
+    file), e.g. 'fcjf0_sa1' for '.../dr1/fcjf0/sa1.lab'. """
+    fname = fname.split('.')[0]
+    if fname.endswith('_fbanks'):
+        fname = fname[:-len('_fbanks')]
+    return "_".join(fname.split('/')[-2:])
+
+
+def features_index(path):
+    """ The names of the utterances with features in path, a folder (of
+    *.npz/*.npy files) or a h5features file. """
+    if os.path.isdir(path):
+        return set(os.path.splitext(f)[0].replace('_fbanks', '')
+                for f in os.listdir(path))
+    import h5py
+    with h5py.File(path, 'r') as f:
+        return set(f['features']['files'][...])
 
-def find_triphones(mlf, foldings={}):
-    ret = []
-    current_file = None
+
+class FbanksIndex(object):
+    """ Tells whether an utterance of the MLF has its *_fbanks.npy, listing
+    each folder only once. """
+    def __init__(self):
+        self._listings = {}
+
+    def __contains__(self, lab_fname):
+        folder, fname = os.path.split(lab_fname)
+        if folder not in self._listings:
+            try:
+                self._listings[folder] = set(os.listdir(folder or '.'))
+            except OSError:
+                self._listings[folder] = set()
+        return fname.split('.')[0] + '_fbanks.npy' in self._listings[folder]
+
+
+def triphones(mlf, foldings={}, available=None):
+    """ Yields the [file, onset, offset, phone, context, talker] items of
+    the triphones of the MLF, for the utterances in available (names of
+    utterances, by default an FbanksIndex). """
+    if available is None:
+        available = FbanksIndex()
+        has_features = lambda lab: lab in available
+    else:
+        has_features = lambda lab: utterance_name(lab) in available
+    fold = lambda p: foldings.get(p, p)  # the foldings as a lookup table
+    skipfile = True
     with open(mlf) as f:
-        skipfile = False
         for line in f:
             if '.lab"' in line:
                 current_file = line.rstrip('\n').strip('"')
-                current_file_fbank = current_file.split('.')[0] + '_fbanks.npy'
-                try:
-                    rf = open(current_file_fbank)
-                    skipfile = False
-                    rf.close()
-                except IOError:
-                    # skip this file if we don't have the fbanks
-                    skipfile = True
-                current_file_fbank = current_file.split('.')[0]
-                current_file_fbank = current_file_fbank.split('/')[-2] + "_" +\
-                    current_file_fbank.split('/')[-1]
+                skipfile = not has_features(current_file)
+                current_file_fbank = utterance_name(current_file)
+                current_talker = current_file.split('/')[-2]
                 t_minus_2 = None
                 t_minus_1 = None
                 p_minus_2 = None
                 p_minus_1 = None
-                current_talker = current_file.split('/')[-2]
-            if skipfile:
                 continue
-            if line[0].isdigit():
-                # assume a line of START END PHONE_STATE LOG_LIKELIHOOD [PHONE]
-                # e.g. 1100000 1200000 d[2] -67.333511 d
-                # or   1200000 1400000 d[3] -151.204285
-                tmp = line.rstrip('\n').split()
-                if len(tmp) == 5:  # that means we have the final [PHONE]
-                    t = (str(float(tmp[0])/10000000), str(float(tmp[1])/10000000))
-                    p = tmp[-1]
-                    if p == "!ENTER" or p == "!EXIT":  # we omit ENTER and EXIT
-                        continue
-                    if p in foldings:
-                        p = foldings[p]
-                    if t_minus_2 is not None and p_minus_2 is not None:
-                        ret.append([current_file_fbank, t_minus_2[0], t[1], 
-                            p_minus_1, p_minus_2 + "-" + p, current_talker])
-                    p_minus_2 = p_minus_1
-                    p_minus_1 = p
-                    t_minus_2 = t_minus_1
-                    t_minus_1 = t
-    return ret
+            if skipfile or not line[0].isdigit():
+                continue
+            # assume a line of START END PHONE_STATE LOG_LIKELIHOOD [PHONE]
+            # e.g. 1100000 1200000 d[2] -67.333511 d
+            # or   1200000 1400000 d[3] -151.204285
+            tmp = line.split()
+            if len(tmp) != 5:  # only the lines with the final [PHONE]
+                continue
+            p = tmp[4]
+            if p == "!ENTER" or p == "!EXIT":  # we omit ENTER and EXIT
+                continue
+            p = fold(p)
+            t = (str(float(tmp[0])/10000000), str(float(tmp[1])/10000000))
+            if t_minus_2 is not None and p_minus_2 is not None:
+                yield [current_file_fbank, t_minus_2[0], t[1],
+                    p_minus_1, p_minus_2 + "-" + p, current_talker]
+            p_minus_2 = p_minus_1
+            p_minus_1 = p
+            t_minus_2 = t_minus_1
+            t_minus_1 = t
+
+
+def find_triphones(mlf, foldings={}, available=None):
+    return list(triphones(mlf, foldings, available))
+
+
+def write_items(items, out=sys.stdout):
+    """ Writes the items as they come, returns their number. """
+    print >> out, "#file onset offset #phone context talker"
+    n = 0
+    for item in items:
+        out.write(" ".join(item) + "\n")
+        n += 1
+    return n
+
+
+def write_tasks(fname, tasks=TASKS):
+    with open(fname, 'w') as f:
+        json.dump(dict((name, {'on': on, 'by': by, 'across': across})
+            for name, (on, by, across) in tasks.iteritems()), f, indent=2,
+            sort_keys=True)
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print __doc__
-    print >> sys.stderr, "working on the MLF:", sys.argv[1]
-    print >> sys.stderr, "!!! works only if the fbanks feature files exist!"
+    import argparse
+
+    parser = argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument('mlf', help='aligned MLF')
+    parser.add_argument('foldings', nargs='?', default=None,
+            help='JSON of the phones foldings')
+    parser.add_argument('--features', default=None, help='folder of the '
+            'features files or h5features file (default: the *_fbanks.npy '
+            'next to the *.lab)')
+    parser.add_argument('--output', default=None,
+            help='items file (default: stdout)')
+    parser.add_argument('--tasks', default=None,
+            help='write the phone/talker tasks definitions in this JSON')
+    args = parser.parse_args()
+    print >> sys.stderr, "working on the MLF:", args.mlf
     foldings = {}
-    if len(sys.argv) > 2:
-        with open(sys.argv[2]) as f:
+    if args.foldings is not None:
+        with open(args.foldings) as f:
             foldings = json.load(f)
-    l = find_triphones(sys.argv[1], foldings)
+    available = None
+    if args.features is not None:
+        available = features_index(args.features)
+    else:
+        print >> sys.stderr, "!!! works only if the fbanks feature files exist!"
     print >> sys.stderr, "filename onset offset phone context(left-right) talker"
-    print "#file onset offset #phone context talker"
-    print "\n".join(map(lambda x: " ".join(x), l))
+    out = sys.stdout if args.output is None else open(args.output, 'w')
+    n = write_items(triphones(args.mlf, foldings, available), out)
+    if args.output is not None:
+        out.close()
+    print >> sys.stderr, n, "items"
+    if args.tasks is not None:
+        write_tasks(args.tasks)
@@ -0,0 +1,120 @@
+"""
+A cheap estimate of the ABX error (of phones, by talker) of an embedding,
+computed during training.
+
+A fixed random sample of (A, B, X) triphone triplets (A and X of the same
+phone, B of another phone, all of the same talker) is drawn once from an
+items file of the dev set (as made by abx_pairs.py), and the stacked
+filterbanks of their tokens are kept in memory. Each call embeds all the
+tokens in a few large batches and computes the DTW distances of all the
+(A, X) and (B, X) pairs with the vectorized DTW of abx.py:
+
+    proxy = ABXProxy('timit_ABX_dev.item', 'npz_dev', mean, std, nframes)
+    valid_score = proxy.valid_score(nnet.transform_x1(),
+            same_diff(valid_scoref, "valid error"))
+
+valid_score is a scoring callback (see training_engine.py) whose validation
+loss is the estimated ABX error.
+"""
+
+import os, sys
+from collections import defaultdict
+import numpy as np
+
+from abx import read_items, dtw_distances
+from dataset_iterators import transform_chunks
+from embedding_pipeline import stack, FEATURES_RATE
+
+
+def load_fbanks(features_folder, fname):
+    """ Raw filterbanks of the utterance fname of the items file. """
+    for suffix in ('_fbanks.npy', '.npy'):
+        path = os.path.join(features_folder, fname + suffix)
+        if os.path.exists(path):
+            return np.load(path)
+    raise IOError("no filterbanks for " + fname + " in " + features_folder)
+
+
+def sample_triplets(items, on=0, by=(2,), n_triplets=2000, seed=1234):
+    """ [(A, B, X)] indices of items (with labels[on] the phone and
+    labels[by] the talker), drawn uniformly over the X. """
+    rng = np.random.RandomState(seed)
+    contexts = defaultdict(lambda: defaultdict(list))
+    for i, (_, _, _, labels) in enumerate(items):
+        contexts[tuple(labels[b] for b in by)][labels[on]].append(i)
+    candidates = []  # the X with at least one A and one B
+    for context in contexts.itervalues():
+        if len(context) < 2:
+            continue
+        for c, xs in context.iteritems():
+            if len(xs) >= 2:
+                candidates.extend((x, context, c) for x in xs)
+    if not len(candidates):
+        raise ValueError("no ABX triplet in these items")
+    triplets = []
+    for k in rng.randint(len(candidates), size=n_triplets):
+        x, context, c = candidates[k]
+        a = x
+        while a == x:
+            a = context[c][rng.randint(len(context[c]))]
+        others = [o for o in context.iterkeys() if o != c]
+        bs = context[others[rng.randint(len(others))]]
+        triplets.append((a, bs[rng.randint(len(bs))], x))
+    return triplets
+
+
+class ABXProxy(object):
+    """ ABX error of an embedding on a fixed sample of triplets of the items
+    of items_fname, whose filterbanks are in features_folder (*_fbanks.npy
+    or *.npy). mean and std are the (per filterbank) normalization of the
+    training. """
+    def __init__(self, items_fname, features_folder, mean, std, nframes,
+            n_triplets=2000, on='phone', by=('talker',), seed=1234,
+            dist='cos'):
+        names, items = read_items(items_fname)
+        triplets = sample_triplets(items, names.index(on),
+                [names.index(b) for b in by], n_triplets, seed)
+        tokens = sorted(set(i for t in triplets for i in t))
+        index = dict((i, k) for k, i in enumerate(tokens))
+        self.triplets = np.array([[index[i] for i in t] for t in triplets])
+        self.dist = dist
+        self.tokens = []  # normalized and stacked filterbanks
+        utterances = {}
+        for i in tokens:
+            fname, onset, offset, _ = items[i]
+            if fname not in utterances:
+                fbanks = load_fbanks(features_folder, fname)
+                utterances[fname] = stack((fbanks - mean) / std, nframes)
+            x = utterances[fname]
+            t = np.arange(x.shape[0]) * FEATURES_RATE + FEATURES_RATE / 2
+            token = x[(t >= onset) & (t <= offset)]
+            if not token.shape[0]:  # the closest frame
+                token = x[[np.argmin(np.abs(t - (onset + offset) / 2))]]
+            self.tokens.append(token)
+        self.pairs = np.r_[self.triplets[:, [0, 2]], self.triplets[:, [1, 2]]]
+        print >> sys.stderr, "ABX proxy on", len(self.triplets), "triplets of",
+        print >> sys.stderr, len(self.tokens), "tokens"
+
+    def error(self, transform_f):
+        """ ABX error of the embedding transform_f (e.g.
+        nnet.transform_x1()) on the sampled triplets. """
+        embs = [np.asarray(e, dtype='float64')
+                for e in transform_chunks(transform_f, self.tokens)]
+        d = dtw_distances(embs, self.pairs, self.dist)
+        d_ax, d_bx = d[:len(self.triplets)], d[len(self.triplets):]
+        return 1. - np.mean((d_ax < d_bx) + 0.5 * (d_ax == d_bx))
+
+    def valid_score(self, transform_f, other_score=None, desc="dev ABX"):
+        """ Scoring callback whose loss is the ABX error estimate, other_score
+        being another callback (e.g. same_diff) whose metrics are kept
+        (its loss as 'same_diff_loss'). """
+        def score(epoch):
+            metrics = {}
+            if other_score is not None:
+                metrics.update(other_score(epoch))
+                metrics['same_diff_loss'] = metrics.pop('loss')
+            error = self.error(transform_f)
+            print('  epoch %i, %s error (proxy) %f' % (epoch, desc, error))
+            metrics.update({'abx_error': error, 'loss': error})
+            return metrics
+        return score
@@ -1,5 +1,8 @@
 """
-python align_words.py folder_with_fbanks_and_words
+python align_words.py folder_with_fbanks_and_words [--archive=ARCHIVE]
+
+With --archive, the filterbanks are read from a features archive of the
+folder (see features_archive.py) instead of its *_fbanks.npy.
 """
 
 import os, sys, joblib, random
@@ -11,6 +14,7 @@ import numpy as np
 from dtw import DTW
 from itertools import izip
 from random import shuffle
+from features_archive import FeaturesArchive, utterance_name
 
 OLD_SCHEME = False  # obsolete
 BALANCED = False    # balance the number of same words / same speakers
@@ -21,6 +25,7 @@ if BALANCED:
 FBANKS_WINDOW = 0.025 # 25ms
 FBANKS_RATE = 100 # 10ms
 N_FBANKS = 40 # number of filterbanks to use
+ARCHIVE = None  # FeaturesArchive of the filterbanks, or the *_fbanks.npy
 
 
 class Memoize:
@@ -69,6 +74,13 @@ def do_dtw_pair(p1, p2):
     return p1[0], p1[1], p2[1], p1[2], p2[2], dtw[0], dtw[-1][1], dtw[-1][2]
 
 
+def load_fbanks(fname):
+    """ Filterbanks of the utterance of fname (e.g. its *.wrd). """
+    if ARCHIVE is not None:
+        return ARCHIVE[utterance_name(fname)]
+    return np.load(fname.split('.')[0] + "_fbanks.npy")
+
+
 @Memoize
 def extract_features(word, fname, s, e, before_after=3):
     sf = s * FBANKS_RATE
@@ -77,9 +89,9 @@ def extract_features(word, fname, s, e, before_after=3):
     fbankfname = fname.split('.')[0] + "_fbanks.npy"
     talker = fname.split('/')[-2]
     try:
-        fb = np.load(fbankfname)
+        fb = load_fbanks(fname)
         print "opened:", fbankfname
-    except IOError:
+    except (IOError, KeyError):
         print "missing fbank for", fbankfname
     before = max(0, sf - before_after)
     after = min(ef + before_after, fb.shape[0])
@@ -121,9 +133,7 @@ def pair_word_features(words_timings, min_len_word_char=3, before_after=3,
         for fname, s, e in l:
             sf = s * FBANKS_RATE
             ef = e * FBANKS_RATE
-            fb = None
-            with open(fname.split('.')[0] + "_fbanks.npy") as f:
-                fb = np.load(f)
+            fb = load_fbanks(fname)
             if fb == None:
                 print >> sys.stderr, "problem with file", fname
                 continue 
@@ -198,8 +208,12 @@ def sample_words(words_feats, n_words):
 
 if __name__ == '__main__':
     folder = '.'
-    if len(sys.argv) > 1:
-        folder = sys.argv[1].rstrip('/')
+    args = [a for a in sys.argv[1:] if not a.startswith('--archive=')]
+    if len(args):
+        folder = args[0].rstrip('/')
+    for a in sys.argv[1:]:
+        if a.startswith('--archive='):
+            ARCHIVE = FeaturesArchive(a[len('--archive='):])
     print "working on folder:", folder
     output_name = "dtw_words"
     if folder != ".":
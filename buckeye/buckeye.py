@@ -1,4 +1,4 @@
-import joblib, glob, os, sys
+import joblib, glob, os, sys, atexit
 from joblib import Parallel, delayed
 from itertools import izip
 from functools import partial
@@ -6,8 +6,9 @@ from collections import defaultdict
 import numpy as np
 from multiprocessing import cpu_count
 from dtw import DTW
-from spectral import Spectral
-from scipy.io import wavfile
+from mel_fbanks import MelFbanks
+from read_audio import read_audio
+from feature_manifest import Manifest, MANIFEST_NAME, atomic_save
 
 MAX_LENGTH_WORDS = 6     # in phones
 MIN_LENGTH_WORDS = 6     # in phones
@@ -16,9 +17,14 @@ MIN_FRAMES = 5           # in speech frames
 FBANKS_WINDOW = 0.025    # 25ms
 FBANKS_RATE = 100        # 10ms
 N_FBANKS = 40 # number of filterbanks to use
+FBANKS_PARAMS = {'features': 'fbanks', 'nfilt': N_FBANKS, 'alpha': 0.97,
+        'frate': FBANKS_RATE, 'wlen': FBANKS_WINDOW, 'nfft': 1024}
 RATIO_SAME = 0.20
+SAVE_MANIFEST_EVERY = 100  # extracted files
 
 bdir = "/fhgfs/bootphon/scratch/gsynnaeve/BUCKEYE/buckeye_modified_split_devtest/"
+manifest = Manifest(bdir + MANIFEST_NAME)
+n_extracted = 0
 
 
 def do_dtw_pair(p1, p2):
@@ -42,24 +48,26 @@ class Memoize:
 
 @Memoize
 def do_fbank(fname):
-    try:
-        with open(fname[:-3] + 'npy', 'rb') as rfb:
+    global n_extracted
+    fbfname = fname[:-3] + 'npy'
+    if not manifest.outdated(fname, fbfname, FBANKS_PARAMS):
+        with open(fbfname, 'rb') as rfb:
             fb = np.load(rfb)
-    except IOError:
-        srate, sound = wavfile.read(fname)
-        fbanks = Spectral(nfilt=N_FBANKS,    # nb of filters in mel bank
-                     alpha=0.97,             # pre-emphasis
-                     do_dct=False,           # we do not want MFCCs
-                     fs=srate,               # sampling rate
-                     frate=FBANKS_RATE,      # frame rate
-                     wlen=FBANKS_WINDOW,     # window length
-                     nfft=1024,              # length of dft
-                     do_deltas=False,       # speed
-                     do_deltasdeltas=False  # acceleration
-                     )
+    else:
+        sound, srate = read_audio(fname)
+        fbanks = MelFbanks(nfilt=N_FBANKS,    # nb of filters in mel bank
+                      alpha=0.97,             # pre-emphasis
+                      fs=srate,               # sampling rate
+                      frate=FBANKS_RATE,      # frame rate
+                      wlen=FBANKS_WINDOW,     # window length
+                      nfft=1024               # length of dft
+                      )
         fb = np.array(fbanks.transform(sound), dtype='float32')
-        #with open(fname.split('.')[0] + '.npy', 'wb') as wfb:
-        #    np.save(wfb, fb)
+        atomic_save(fbfname, fb)
+        manifest.record(fname, fbfname, FBANKS_PARAMS)
+        n_extracted += 1
+        if n_extracted % SAVE_MANIFEST_EVERY == 0:
+            manifest.save()
     print "did:", fname
     #print fb.shape
     return fb
@@ -76,6 +84,7 @@ def extract_features(fname, word, talker, s, e, before_after=2):
 
 
 if __name__ == "__main__":
+    atexit.register(manifest.save)  # the last extracted files
     #for dset in ['test']:
     phndict = defaultdict(lambda: [])
     for dset in ['test', 'dev']:
@@ -6,26 +6,30 @@ from collections import defaultdict
 import numpy as np
 from multiprocessing import cpu_count
 from dtw import DTW
-from spectral import Spectral
-from scipy.io import wavfile
+from mel_fbanks import MelFbanks
+from read_audio import read_audio
+from feature_manifest import Manifest, MANIFEST_NAME, atomic_save
+from cmvn import CMVNStats, CMVN_NAME
+from features_archive import utterance_speaker
 
 FBANKS_WINDOW = 0.025    # 25ms
 FBANKS_RATE = 100        # 10ms
 N_FBANKS = 40 # number of filterbanks to use
+SPEAKER_PREFIX = 3 # the first 3 characters of the files names
+SAVE_MANIFEST_EVERY = 100 # extracted files
+FBANKS_PARAMS = {'features': 'fbanks', 'nfilt': N_FBANKS, 'alpha': 0.97,
+        'frate': FBANKS_RATE, 'wlen': FBANKS_WINDOW, 'nfft': 1024}
 basedir = "/fhgfs/bootphon/scratch/gsynnaeve/BUCKEYE/buckeye_modified_split_devtest/"
 
 def do_fbank(fname):
-    srate, sound = wavfile.read(fname)
-    fbanks = Spectral(nfilt=N_FBANKS,    # nb of filters in mel bank
-                 alpha=0.97,             # pre-emphasis
-                 do_dct=False,           # we do not want MFCCs
-                 fs=srate,               # sampling rate
-                 frate=FBANKS_RATE,      # frame rate
-                 wlen=FBANKS_WINDOW,     # window length
-                 nfft=1024,              # length of dft
-                 do_deltas=False,       # speed
-                 do_deltasdeltas=False  # acceleration
-                 )
+    sound, srate = read_audio(fname)
+    fbanks = MelFbanks(nfilt=N_FBANKS,    # nb of filters in mel bank
+                  alpha=0.97,             # pre-emphasis
+                  fs=srate,               # sampling rate
+                  frate=FBANKS_RATE,      # frame rate
+                  wlen=FBANKS_WINDOW,     # window length
+                  nfft=1024               # length of dft
+                  )
     fb = fbanks.transform(sound)
     print "did:", fname
     #print fbnk.shape
@@ -34,14 +38,32 @@ def do_fbank(fname):
 
 
 if __name__ == "__main__":
-    for dset in ['test', 'dev']:
-        for bdir, _, files in os.walk(basedir + 'wrd/' + dset + '/'):
-            for fname in files:
-                if fname[-4:] != '.wrd':
-                    continue
-                wrdfname = bdir + fname
-                wavfname = wrdfname.replace('wrd', 'wav')
-                with open(wavfname[:-3] + 'npy', 'wb') as wf:
-                    np.save(wf, do_fbank(wavfname))
-
-
+    # only the new or changed wav files are done, the per speaker mean and
+    # variance of the filterbanks are accumulated in basedir + CMVN_NAME
+    manifest = Manifest(basedir + MANIFEST_NAME)
+    cmvn_stats = CMVNStats(basedir + CMVN_NAME)
+    n_done = 0
+    try:
+        for dset in ['test', 'dev']:
+            for bdir, _, files in os.walk(basedir + 'wrd/' + dset + '/'):
+                for fname in files:
+                    if fname[-4:] != '.wrd':
+                        continue
+                    wrdfname = bdir + fname
+                    wavfname = wrdfname.replace('wrd', 'wav')
+                    fbfname = os.path.abspath(wavfname[:-3] + 'npy')
+                    speaker = utterance_speaker(fbfname, SPEAKER_PREFIX)
+                    if manifest.outdated(wavfname, fbfname, FBANKS_PARAMS):
+                        fb = do_fbank(wavfname)
+                        atomic_save(fbfname, fb)
+                        manifest.record(wavfname, fbfname, FBANKS_PARAMS)
+                        cmvn_stats.add(fbfname, speaker, fb)
+                        n_done += 1
+                        if n_done % SAVE_MANIFEST_EVERY == 0:
+                            manifest.save()
+                            cmvn_stats.save()
+                    elif fbfname not in cmvn_stats:
+                        cmvn_stats.add(fbfname, speaker, np.load(fbfname))
+    finally:
+        manifest.save()
+        cmvn_stats.save()
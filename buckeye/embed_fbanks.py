@@ -1,34 +1,11 @@
-"""python embed_fbanks.py nnet.pickle npz11_test npz_emb11_wrd_test npz_emb11_spkr_test
-"""
-
-import cPickle, sys, glob
-import numpy as np
-from nnet_archs import ABNeuralNet2Outputs
-
-NFEATURES = 40
+"""python embed_fbanks.py nnet.pickle npz11_test emb11_wrd_test.features emb11_spkr_test.features [--archive]
 
-with open(sys.argv[1], 'rb') as f:
-    nnet = cPickle.load(f)
-
-NFRAMES = nnet.layers_ins[0] / NFEATURES
-
-in_fldr = sys.argv[2].rstrip('/') + '/'
-out_fldr1 = sys.argv[3].rstrip('/') + '/'
-out_fldr2 = sys.argv[4].rstrip('/') + '/'
+npz11_test can also be a features archive (see features_archive.py), and
+with --archive the embeddings are written as features archives.
+"""
 
-transform = nnet.transform_x1()
-tmp = np.load('mean_std_spkr_word.npz')
-mean = np.tile(tmp['mean'], NFRAMES)
-std = np.tile(tmp['std'], NFRAMES)
+import sys
+from embedding_pipeline import embed_folder
 
-# TODO maybe normalize embedded features ???
-for fname in glob.iglob(in_fldr + "*.npz"):
-    npz = np.load(fname)
-    X = np.asarray((npz['features'] - mean) / std, dtype='float32')
-    emb_wrd, emb_spkr = transform(X)
-    np.savez(out_fldr1 + fname.split('/')[-1],
-            features=emb_wrd,
-            time=npz['time'])
-    np.savez(out_fldr2 + fname.split('/')[-1],
-            features=emb_spkr,
-            time=npz['time'])
+embed_folder(sys.argv[1], 'mean_std_spkr_word.npz', sys.argv[2],
+        [sys.argv[3], sys.argv[4]], archive='--archive' in sys.argv[5:])
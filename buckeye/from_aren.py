@@ -1,8 +1,8 @@
 from dtw import DTW
 import numpy as np
 import joblib, glob, os, sys
-from spectral import Spectral
-from scipy.io import wavfile
+from mel_fbanks import MelFbanks
+from read_audio import read_audio
 MAX_LENGTH_WORDS = 6     # in phones
 MIN_LENGTH_WORDS = 6     # in phones
 MIN_FRAMES = 5           # in speech frames
@@ -34,17 +34,14 @@ def do_fbank(fname):
         with open(fn[:-3] + 'npy', 'rb') as rfb:
             fb = np.load(rfb)
     except IOError:
-        srate, sound = wavfile.read(fn)
-        fbanks = Spectral(nfilt=N_FBANKS,    # nb of filters in mel bank
-                     alpha=0.97,             # pre-emphasis
-                     do_dct=False,           # we do not want MFCCs
-                     fs=srate,               # sampling rate
-                     frate=FBANKS_RATE,      # frame rate
-                     wlen=FBANKS_WINDOW,     # window length
-                     nfft=1024,              # length of dft
-                     do_deltas=False,       # speed
-                     do_deltasdeltas=False  # acceleration
-                     )
+        sound, srate = read_audio(fn)
+        fbanks = MelFbanks(nfilt=N_FBANKS,    # nb of filters in mel bank
+                      alpha=0.97,             # pre-emphasis
+                      fs=srate,               # sampling rate
+                      frate=FBANKS_RATE,      # frame rate
+                      wlen=FBANKS_WINDOW,     # window length
+                      nfft=1024               # length of dft
+                      )
         fb = np.array(fbanks.transform(sound), dtype='float32')
     print "did:", fn
     #print fb.shape
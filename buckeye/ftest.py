@@ -1,13 +1,36 @@
 import cPickle, sys, glob, os
 from collections import defaultdict
 import numpy as np
+from features_archive import FeaturesArchive, archive_exists
 
 NFRAMES_PER_SEC = 100
 #bdir = "deep_coscos2_buckeye_dtw_word_spkr_fbank11_ab_net_adadelta_emb_100/"
+# or the HDF5 file of embedding_pipeline.py --all-layers, or a folder of
+# features archives layer_0, layer_1, ... (see features_archive.py)
 bdir = sys.argv[1].rstrip('/') + '/'
+store = None
+if sys.argv[1].endswith('.h5'):
+    import h5py
+    store = h5py.File(sys.argv[1], 'r')
+    bdir = os.path.dirname(os.path.abspath(sys.argv[1])) + '/'
 phndir = "buckeye_modified_split_devtest/phn/*/"
 
 
+def layer_features(i):
+    """ Yields (npz file name, features) for the layer i. """
+    if store is None and archive_exists(bdir + "layer_" + str(i)):
+        archive = FeaturesArchive(bdir + "layer_" + str(i))
+        for name, _, features in archive.utterances():
+            yield name + '.npz', np.asarray(features, dtype='float32')
+    elif store is None:
+        for fname in glob.iglob(bdir + "layer_" + str(i) + '/' + "*.npz"):
+            yield fname.split('/')[-1], np.load(fname)['features']
+    else:
+        layer = store['layer_' + str(i)]
+        for name, (offset, n) in zip(store['files'], store['index']):
+            yield name + '.npz', layer[offset:offset+n]
+
+
 def parse(fn):
     try:
         with open(fn) as rf:
@@ -21,19 +44,14 @@ def parse(fn):
 
 
 for i in range(3):
-    dir = bdir + "layer_" + str(i) + '/'
-
     spkrs = defaultdict(lambda: [np.zeros(500), np.zeros(500), 0])  # {'sid':[500 (mean, mean**2, length)]}
     phns = defaultdict(lambda: [np.zeros(500), np.zeros(500), 0])
     all = [np.zeros(500), np.zeros(500), 0] # [500 (mean, mean**2, length)]
 
-    for fname in glob.iglob(dir + "*.npz"):
-        npz = np.load(fname)
-        npz_fn = fname.split('/')[-1]
+    for npz_fn, t in layer_features(i):
         phn_fn = [x for x in glob.iglob(phndir + npz_fn.split('.')[0] + '.phn')][0]
         phones = parse(phn_fn)
         spkr = npz_fn[:3]
-        t = npz['features']
         t2 = t**2
         s = np.sum(t, axis=0) # (length, 500)
         s2 = np.sum(t2, axis=0)
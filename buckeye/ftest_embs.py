@@ -1,6 +1,7 @@
 import cPickle, sys, glob, os
 from collections import defaultdict
 import numpy as np
+from features_archive import FeaturesArchive, archive_exists
 
 NFRAMES_PER_SEC = 100
 bdir = sys.argv[1].rstrip('/') + '/'
@@ -21,17 +22,26 @@ def parse(fn):
 
 dir = bdir
 
+
+def features():
+    """ Yields (npz file name, embeddings) of the folder of *.npz (or the
+    features archive, see features_archive.py) given. """
+    if archive_exists(dir.rstrip('/')):
+        for name, _, t in FeaturesArchive(dir.rstrip('/')).utterances():
+            yield name + '.npz', np.asarray(t, dtype='float32')
+    else:
+        for fname in glob.iglob(dir + "*.npz"):
+            yield fname.split('/')[-1], np.load(fname)['features']
+
+
 spkrs = defaultdict(lambda: [np.zeros(100), np.zeros(100), 0])  # {'sid':[100 (mean, mean**2, length)]}
 phns = defaultdict(lambda: [np.zeros(100), np.zeros(100), 0])
 all = [np.zeros(100), np.zeros(100), 0] # [100 (mean, mean**2, length)]
 
-for fname in glob.iglob(dir + "*.npz"):
-    npz = np.load(fname)
-    npz_fn = fname.split('/')[-1]
+for npz_fn, t in features():
     phn_fn = [x for x in glob.iglob(phndir + npz_fn.split('.')[0] + '.phn')][0]
     phones = parse(phn_fn)
     spkr = npz_fn[:3]
-    t = npz['features']
     t2 = t**2
     s = np.sum(t, axis=0) # (length, 100)
     s2 = np.sum(t2, axis=0)
@@ -1,6 +1,7 @@
 import cPickle, sys, glob, os
 from collections import defaultdict
 import numpy as np
+from features_archive import FeaturesArchive, archive_exists
 
 NFRAMES_PER_SEC = 100
 NFRAMES = 11
@@ -23,17 +24,26 @@ def parse(fn):
 
 dir = bdir + 'npz11_test/'
 
+
+def features():
+    """ Yields (npz file name, features) of npz11_test (a folder of *.npz
+    or a features archive, see features_archive.py). """
+    if archive_exists(dir.rstrip('/')):
+        for name, _, t in FeaturesArchive(dir.rstrip('/')).utterances():
+            yield name + '.npz', np.asarray(t, dtype='float32')
+    else:
+        for fname in glob.iglob(dir + "*.npz"):
+            yield fname.split('/')[-1], np.load(fname)['features']
+
+
 spkrs = defaultdict(lambda: [np.zeros(NFRAMES*NFBANKS), np.zeros(NFRAMES*NFBANKS), 0])  # {'sid':[NFRAMES*NFBANKS (mean, mean**2, length)]}
 phns = defaultdict(lambda: [np.zeros(NFRAMES*NFBANKS), np.zeros(NFRAMES*NFBANKS), 0])
 all = [np.zeros(NFRAMES*NFBANKS), np.zeros(NFRAMES*NFBANKS), 0] # [NFRAMES*NFBANKS (mean, mean**2, length)]
 
-for fname in glob.iglob(dir + "*.npz"):
-    npz = np.load(fname)
-    npz_fn = fname.split('/')[-1]
+for npz_fn, t in features():
     phn_fn = [x for x in glob.iglob(phndir + npz_fn.split('.')[0] + '.phn')][0]
     phones = parse(phn_fn)
     spkr = npz_fn[:3]
-    t = npz['features']
     t2 = t**2
     s = np.sum(t, axis=0) # (length, NFRAMES*NFBANKS)
     s2 = np.sum(t2, axis=0)
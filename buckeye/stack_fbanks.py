@@ -1,24 +1,36 @@
 """python stack_fbanks.py npz11_train/*.npy
+python stack_fbanks.py --archive buckeye_test_fbanks buckeye_test_fbanks7
+
+The second form stacks all the utterances of a features archive (see
+features_archive.py) into another archive.
 """
 
 import sys
 import numpy as np
+from features_archive import FeaturesArchive, ArchiveWriter
+from embedding_pipeline import stack as stack_nframes
 
 NFRAMES = 7
-b_a = (NFRAMES - 1) / 2
 FRAMES_PER_SEC = 100  # features frames per second
 FEATURES_RATE = 1. / FRAMES_PER_SEC
 
+
+def stack(fbanks):
+    return stack_nframes(fbanks, NFRAMES)
+
+
+if len(sys.argv) > 1 and sys.argv[1] == '--archive':
+    archive = FeaturesArchive(sys.argv[2])
+    with ArchiveWriter(sys.argv[3], archive.dim * NFRAMES,
+            archive.features.dtype) as writer:
+        for name, speaker, fbanks in archive.utterances():
+            print name
+            writer.write(name, stack(fbanks), speaker)
+    sys.exit(0)
+
 for fname in sys.argv[1:]:
     print fname
-    fbanks = np.load(fname)
-    fbanks7 = np.zeros((fbanks.shape[0], fbanks.shape[1] * NFRAMES),
-            dtype='float32')
-    for i in xrange(fbanks.shape[0]):
-        fbanks7[i] = np.pad(fbanks[max(0, i - b_a):i + b_a + 1].flatten(),
-                (max(0, (b_a - i) * fbanks.shape[1]),
-                    max(0, ((i+b_a+1) - fbanks.shape[0]) * fbanks.shape[1])),
-                'constant', constant_values=(0, 0))
+    fbanks7 = stack(np.load(fname))
 #    for i in xrange(b_a + 1):
 #        fbanks7[i] = np.pad(fbanks[max(0, i - b_a):i + b_a + 1].flatten(),
 #                (max(0, (b_a - i) * fbanks.shape[1]),
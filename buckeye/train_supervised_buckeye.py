@@ -7,6 +7,7 @@ from dataset_iterators import DatasetMiniBatchIterator, pad
 from layers import ReLU 
 from classifiers import LogisticRegression
 from nnet_archs import NeuralNet, DropoutNet
+from features_archive import FeaturesArchive, archive_exists
 from collections import defaultdict
 
 bdir = "/fhgfs/bootphon/scratch/gsynnaeve/BUCKEYE/buckeye_modified_split_devtest/" # wav/test/ or wav/dev/
@@ -109,9 +110,15 @@ else:
         tmp = defaultdict(lambda: {})
 
 
-# Load filterbanks of files
+# Load filterbanks of files (from the features archives fbanks_test and
+# fbanks_dev of bdir if they exist, see features_archive.py)
 fbanks = {}
 for dset in ['test', 'dev']:
+    if archive_exists(bdir + 'fbanks_' + dset):
+        archive = FeaturesArchive(bdir + 'fbanks_' + dset)
+        for name, _, fb in archive.utterances():
+            fbanks[name] = fb
+        continue
     for bd, _, files in os.walk(bdir + 'wav/' + dset + '/'):
         for fname in files:
             if ".npy" in fname:
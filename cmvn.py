@@ -0,0 +1,197 @@
+"""
+Per-speaker (and global) mean and variance normalization of features
+(CMVN), whose statistics are accumulated in one pass, as the features are
+extracted: the count, mean and sum of squared deviations of each utterance
+are merged (Welford's streaming update, by blocks of frames) into the ones
+of its speaker and of the whole corpus, so that no other pass over the
+features is needed.
+
+The stats file (CMVN_NAME in the extracted folder, written by
+extract_speech_features.py and parallel_extract_features.py --filterbanks)
+keeps the accumulators of each utterance, so that an incremental extraction
+only updates the new ones, and the resulting mean and std of each speaker
+and of all of them ('mean' and 'std', as in mean_std_spkr_word.npz). The
+normalization is applied when the features are gathered (per batch), for
+raw or stacked features:
+
+    cmvn = CMVN('TIMIT/train/fbanks_cmvn.npz')
+    x = cmvn.normalize(fbanks, 'fcjf0')
+    x = cmvn.normalize(stacked_fbanks, 'fcjf0')  # tiled on the stacked frames
+
+mean_std computes the global mean and std of many (e.g. words) features
+the same way, by chunks, instead of on their concatenation.
+"""
+
+import os, sys
+import numpy as np
+from feature_manifest import atomic_write
+
+CMVN_NAME = 'fbanks_cmvn.npz'
+MIN_STD = 1.E-5
+
+
+class RunningStats(object):
+    """ Count, mean and sum of squared deviations (m2) of vectors, updated
+    by blocks of vectors. """
+    def __init__(self, dim, n=0, mean=None, m2=None):
+        self.n = n
+        self.mean = np.zeros(dim) if mean is None else np.array(mean,
+                dtype='float64')
+        self.m2 = np.zeros(dim) if m2 is None else np.array(m2,
+                dtype='float64')
+
+    def merge(self, n, mean, m2):
+        """ Adds the statistics (n, mean, m2) of other vectors. """
+        if not n:
+            return self
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * (float(n) / total)
+        self.m2 += m2 + delta ** 2 * (float(self.n) * n / total)
+        self.n = total
+        return self
+
+    def update(self, x, block_frames=4096):
+        """ Adds the [n, dim] vectors x, by blocks of block_frames. """
+        for a in xrange(0, x.shape[0], block_frames):
+            block = np.asarray(x[a:a + block_frames], dtype='float64')
+            mean = block.mean(axis=0)
+            self.merge(block.shape[0], mean, ((block - mean) ** 2).sum(axis=0))
+        return self
+
+    @property
+    def var(self):
+        return self.m2 / max(self.n, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+
+def mean_std(arrays, block_frames=4096):
+    """ (mean, std) of the frames of the [n_frames, dim] arrays, accumulated
+    by chunks of about block_frames frames. """
+    stats = None
+    chunk = []
+    n = 0
+    for x in arrays:
+        chunk.append(x)
+        n += x.shape[0]
+        if n >= block_frames:
+            if stats is None:
+                stats = RunningStats(x.shape[1])
+            stats.update(np.concatenate(chunk), block_frames)
+            chunk = []
+            n = 0
+    if len(chunk):
+        if stats is None:
+            stats = RunningStats(chunk[0].shape[1])
+        stats.update(np.concatenate(chunk), block_frames)
+    return stats.mean, stats.std
+
+
+def normalize(x, mean, std, out=None):
+    """ (x - mean) / std, in a float32 copy of x (or in out). """
+    if out is None:
+        out = np.empty(x.shape, dtype='float32')
+    np.subtract(x, mean, out=out, casting='unsafe')
+    out /= std
+    return out
+
+
+class CMVNStats(object):
+    """ Accumulators of the features of each utterance and its speaker,
+    saved in (and loaded from, if it exists) the stats file fname. """
+    def __init__(self, fname):
+        self.fname = fname
+        self.utterances = {}  # {utterance: (speaker, RunningStats)}
+        if os.path.exists(fname):
+            stats = np.load(fname)
+            for u, s, n, mean, m2 in zip(stats['utterances'],
+                    stats['utterance_speakers'], stats['utterance_n'],
+                    stats['utterance_mean'], stats['utterance_m2']):
+                self.utterances[u] = (s, RunningStats(len(mean), n, mean, m2))
+
+    def __contains__(self, utterance):
+        return utterance in self.utterances
+
+    def add(self, utterance, speaker, features):
+        """ (Re)places the statistics of the [n_frames, dim] features of
+        utterance. """
+        self.utterances[utterance] = (speaker,
+                RunningStats(features.shape[1]).update(features))
+
+    def add_stats(self, utterance, speaker, n, mean, m2):
+        self.utterances[utterance] = (speaker,
+                RunningStats(len(mean), n, mean, m2))
+
+    def speakers(self):
+        """ ({speaker: RunningStats}, global RunningStats) """
+        speakers = {}
+        total = None
+        for speaker, stats in self.utterances.itervalues():
+            if speaker not in speakers:
+                speakers[speaker] = RunningStats(len(stats.mean))
+            speakers[speaker].merge(stats.n, stats.mean, stats.m2)
+            if total is None:
+                total = RunningStats(len(stats.mean))
+            total.merge(stats.n, stats.mean, stats.m2)
+        return speakers, total
+
+    def save(self):
+        if not len(self.utterances):
+            return
+        utterances = sorted(self.utterances)
+        speakers, total = self.speakers()
+        names = sorted(speakers)
+
+        def write(tmp):
+            with open(tmp, 'wb') as f:
+                np.savez(f, mean=total.mean, std=total.std, n=total.n,
+                    speakers=np.array(names),
+                    speaker_n=np.array([speakers[s].n for s in names]),
+                    speaker_mean=np.array([speakers[s].mean for s in names]),
+                    speaker_std=np.array([speakers[s].std for s in names]),
+                    utterances=np.array(utterances),
+                    utterance_speakers=np.array([self.utterances[u][0]
+                        for u in utterances]),
+                    utterance_n=np.array([self.utterances[u][1].n
+                        for u in utterances]),
+                    utterance_mean=np.array([self.utterances[u][1].mean
+                        for u in utterances]),
+                    utterance_m2=np.array([self.utterances[u][1].m2
+                        for u in utterances]))
+        atomic_write(self.fname, write)
+
+
+class CMVN(object):
+    """ Normalization of features by the mean and std of their speaker (or
+    the global ones for unknown speakers, that are counted in unknown and
+    reported on stderr) of the stats file fname. """
+    def __init__(self, fname):
+        self.unknown = {}  # {speaker: number of normalized features}
+        stats = np.load(fname)
+        self.mean = stats['mean']
+        self.std = np.maximum(stats['std'], MIN_STD)
+        self.speakers = dict((s, (m, np.maximum(sd, MIN_STD)))
+                for s, m, sd in zip(stats['speakers'], stats['speaker_mean'],
+                    stats['speaker_std']))
+
+    def mean_std(self, speaker=None, dim=None):
+        """ (mean, std) of speaker, tiled to dim (stacked features). """
+        if speaker is not None and speaker not in self.speakers:
+            if speaker not in self.unknown:
+                print >> sys.stderr, "WARNING: speaker", speaker, "is not in",
+                print >> sys.stderr, "the CMVN stats, using the global ones"
+                self.unknown[speaker] = 0
+            self.unknown[speaker] += 1
+        mean, std = self.speakers.get(speaker, (self.mean, self.std))
+        if dim is not None and dim != len(mean):
+            mean = np.tile(mean, dim / len(mean))
+            std = np.tile(std, dim / len(std))
+        return mean, std
+
+    def normalize(self, x, speaker=None, out=None):
+        """ Normalized float32 copy of x (or in out), by speaker. """
+        mean, std = self.mean_std(speaker, x.shape[1])
+        return normalize(x, mean, std, out)
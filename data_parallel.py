@@ -0,0 +1,349 @@
+"""
+Synchronous data-parallel training of the (AB) neural nets on CPU.
+
+N worker processes each hold a replica of the compiled gradient graph and
+compute the gradients on a disjoint shard of each (macro-)batch. The gradients
+are summed through shared memory by the master process, which then does a
+single Adadelta / Adagrad / SGD update on its own nnet (so that _accugrads and
+_accudeltas keep the exact same semantics as the get_*_trainer functions).
+
+A DataParallelTrainer is a drop-in replacement for the train_fn of the
+run_exp_* drivers:
+
+    train_fn = DataParallelTrainer(nnet, trainer_type="adadelta", n_workers=4)
+    for x, y in data_iterator:
+        avg_cost = train_fn(x[0], x[1], y[0], y[1])
+    train_fn.close()
+
+BLAS should be limited to one thread per worker (e.g. OMP_NUM_THREADS=1), or
+workers will compete for the cores.
+"""
+
+import sys, time, random
+import numpy
+import theano
+import theano.tensor as T
+from collections import OrderedDict
+from multiprocessing import Process, Pipe, cpu_count
+from multiprocessing.sharedctypes import RawArray
+from theano.tensor.shared_randomstreams import RandomStateSharedVariable
+
+
+def symbolic_inputs(nnet):
+    """ Returns the symbolic inputs of nnet in the order the train_fn of the
+    drivers takes them. """
+    if hasattr(nnet, 'y1'):  # ABNeuralNet2Outputs
+        return [nnet.x1, nnet.x2, nnet.y1, nnet.y2]
+    if hasattr(nnet, 'x1'):  # ABNeuralNet and DropoutABNeuralNet
+        return [nnet.x1, nnet.x2, nnet.y]
+    return [nnet.x, nnet.y]  # NeuralNet and DropoutNet
+
+
+def training_cost(nnet, trainer_type):
+    """ Returns (cost, is_mean) with the cost that the nnet.get_*_trainer
+    function for trainer_type differentiates. """
+    if not hasattr(nnet, 'mean_cost_training'):
+        return nnet.mean_cost, True
+    if "delta" in trainer_type and not hasattr(nnet, 'y1'):
+        # ABNeuralNet.get_adadelta_trainer uses the summed cost
+        return nnet.cost_training, False
+    return nnet.mean_cost_training, True
+
+
+def _max_norm(nnet, W):
+    col_norms = W.norm(2, axis=0)
+    desired_norms = T.clip(col_norms, 0, nnet.max_norm)
+    return W * (desired_norms / (1e-6 + col_norms))
+
+
+def sgd_updates(nnet, gparams, learning_rate):
+    """ Same updates as nnet.get_SGD_trainer. """
+    updates = OrderedDict()
+    for param, gparam in zip(nnet.params, gparams):
+        W = param - gparam * learning_rate
+        if nnet.max_norm and not hasattr(nnet, 'x1'):
+            # the AB nets' SGD trainers do not renormalize
+            updates[param] = _max_norm(nnet, W)
+        else:
+            updates[param] = W
+    return updates
+
+
+def adagrad_updates(nnet, gparams, learning_rate):
+    """ Same updates as nnet.get_adagrad_trainer. """
+    updates = OrderedDict()
+    for accugrad, param, gparam in zip(nnet._accugrads, nnet.params, gparams):
+        agrad = accugrad + gparam * gparam
+        dx = - (learning_rate / T.sqrt(agrad + nnet._eps)) * gparam
+        if nnet.max_norm:
+            updates[param] = _max_norm(nnet, param + dx)
+        else:
+            updates[param] = param + dx
+        updates[accugrad] = agrad
+    return updates
+
+
+def adadelta_updates(nnet, gparams):
+    """ Same updates as nnet.get_adadelta_trainer. """
+    updates = OrderedDict()
+    for accugrad, accudelta, param, gparam in zip(nnet._accugrads,
+            nnet._accudeltas, nnet.params, gparams):
+        # c.f. Algorithm 1 in the Adadelta paper (Zeiler 2012)
+        agrad = nnet._rho * accugrad + (1 - nnet._rho) * gparam * gparam
+        dx = - T.sqrt((accudelta + nnet._eps) / (agrad + nnet._eps)) * gparam
+        updates[accudelta] = nnet._rho * accudelta + (1 - nnet._rho) * dx * dx
+        if nnet.max_norm:
+            updates[param] = _max_norm(nnet, param + dx)
+        else:
+            updates[param] = param + dx
+        updates[accugrad] = agrad
+    return updates
+
+
+def get_gradients_fn(nnet, trainer_type):
+    """ Returns a function computing [cost] + gradients on a shard, both
+    summed over the shard's rows if the trainer uses a mean cost (so that
+    shards of different sizes can be reduced exactly). """
+    cost, is_mean = training_cost(nnet, trainer_type)
+    inputs = symbolic_inputs(nnet)
+    batch_inputs = [v.type('batch_' + v.name) for v in inputs]
+    gparams = T.grad(cost, nnet.params)
+    if is_mean:
+        n_rows = T.cast(inputs[0].shape[0], theano.config.floatX)
+        cost = cost * n_rows
+        gparams = [g * n_rows for g in gparams]
+    return theano.function(inputs=[theano.Param(b) for b in batch_inputs],
+            outputs=[cost] + gparams,
+            givens=dict(zip(inputs, batch_inputs)))
+
+
+def get_apply_gradients_fn(nnet, trainer_type):
+    """ Returns a function taking the reduced gradients (and the learning
+    rate for SGD/adagrad) and doing one update of nnet. """
+    gparams = [T.TensorType(p.dtype, p.broadcastable)('g_' + str(p.name))
+            for p in nnet.params]
+    inputs = list(gparams)
+    if "delta" in trainer_type:
+        updates = adadelta_updates(nnet, gparams)
+    else:
+        learning_rate = T.fscalar('lr')
+        inputs.append(learning_rate)
+        if trainer_type == "adagrad":
+            updates = adagrad_updates(nnet, gparams, learning_rate)
+        else:
+            updates = sgd_updates(nnet, gparams, learning_rate)
+    return theano.function(inputs=inputs, outputs=[], updates=updates)
+
+
+def _views(buf, shapes):
+    """ float32 numpy views of consecutive arrays of the given shapes in buf.
+    """
+    views = []
+    offset = 0
+    for shape in shapes:
+        size = int(numpy.prod(shape))
+        views.append(numpy.frombuffer(buf, dtype='float32', count=size,
+            offset=offset * 4).reshape(shape))
+        offset += size
+    return views
+
+
+def _reseed(fn, seed):
+    """ Gives its own RandomStreams states (dropout masks) to a replica. """
+    rng = numpy.random.RandomState(seed)
+    for v in _random_streams(fn):
+        v.set_value(numpy.random.RandomState(rng.randint(2 ** 30)),
+                borrow=True)
+
+
+def _random_streams(fn):
+    """ The RandomStreams (dropout) shared variables of a compiled fn. """
+    return [inp.variable for inp in fn.maker.inputs
+            if isinstance(inp.variable, RandomStateSharedVariable)]
+
+
+def _worker_loop(wid, conn, grad_fn, params, params_buf, grads_buf, seed):
+    numpy.random.seed(seed)
+    random.seed(seed)
+    _reseed(grad_fn, seed)
+    streams = _random_streams(grad_fn)
+    shapes = [p.get_value(borrow=True).shape for p in params]
+    params_views = _views(params_buf, shapes)
+    grads_views = _views(grads_buf, shapes)
+    while True:
+        cmd, shard = conn.recv()
+        if cmd == 'stop':
+            break
+        if cmd == 'get_streams':
+            conn.send([v.get_value() for v in streams])
+            continue
+        if cmd == 'set_streams':
+            for v, value in zip(streams, shard):
+                v.set_value(value, borrow=True)
+            conn.send(None)
+            continue
+        timer = time.time()
+        for param, view in zip(params, params_views):
+            param.set_value(view, borrow=True)
+        res = grad_fn(*shard)
+        for view, g in zip(grads_views, res[1:]):
+            view[...] = g
+        conn.send((float(res[0]), time.time() - timer))
+    conn.close()
+
+
+class DataParallelTrainer(object):
+    """ Callable with the same signature as the nnet.get_*_trainer()
+    functions, that shards each batch over n_workers processes. """
+
+    def __init__(self, nnet, trainer_type="adadelta", n_workers=None,
+            seed=1234):
+        assert theano.config.floatX == 'float32'
+        if n_workers == None:
+            n_workers = cpu_count()
+        self.nnet = nnet
+        self.trainer_type = trainer_type
+        self.n_workers = n_workers
+        _, self._is_mean = training_cost(nnet, trainer_type)
+        self._n_inputs = len(symbolic_inputs(nnet))
+        self._shapes = [p.get_value(borrow=True).shape for p in nnet.params]
+        size = sum(int(numpy.prod(s)) for s in self._shapes)
+        self._params_buf = RawArray('f', size)
+        self._params_views = _views(self._params_buf, self._shapes)
+        self._grads_bufs = [RawArray('f', size) for _ in xrange(n_workers)]
+        self._grads_views = [_views(b, self._shapes)
+                for b in self._grads_bufs]
+        self._sync_params()
+        self._apply_fn = get_apply_gradients_fn(nnet, trainer_type)
+        # compiled once here, the forked workers inherit their own replica
+        grad_fn = get_gradients_fn(nnet, trainer_type)
+        self._conns = []
+        self._workers = []
+        for wid in xrange(n_workers):
+            parent_conn, child_conn = Pipe()
+            w = Process(target=_worker_loop, args=(wid, child_conn, grad_fn,
+                nnet.params, self._params_buf, self._grads_bufs[wid],
+                seed + wid))
+            w.daemon = True
+            w.start()
+            self._conns.append(parent_conn)
+            self._workers.append(w)
+        self.reset_stats()
+
+    def _sync_params(self):
+        for param, view in zip(self.nnet.params, self._params_views):
+            view[...] = param.get_value(borrow=True)
+
+    def get_random_streams(self):
+        """ The states of the RandomStreams (dropout) of each worker. """
+        for conn in self._conns:
+            conn.send(('get_streams', None))
+        return [conn.recv() for conn in self._conns]
+
+    def set_random_streams(self, states):
+        """ Restores states from get_random_streams() (with the same number
+        of workers). """
+        assert len(states) == self.n_workers
+        for conn, values in zip(self._conns, states):
+            conn.send(('set_streams', values))
+        for conn in self._conns:
+            conn.recv()
+
+    def reset_stats(self):
+        self.n_batches = 0
+        self.n_rows = 0
+        self.wall_time = 0.
+        self.workers_time = numpy.zeros(self.n_workers)
+
+    def __call__(self, *args):
+        timer = time.time()
+        batch, lr = args[:self._n_inputs], args[self._n_inputs:]
+        n_rows = batch[0].shape[0]
+        bounds = numpy.linspace(0, n_rows, self.n_workers + 1).astype('int')
+        active = []
+        for wid, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+            if end > start:
+                self._conns[wid].send(('grads',
+                    [b[start:end] for b in batch]))
+                active.append(wid)
+        cost = 0.
+        for wid in active:
+            c, t = self._conns[wid].recv()
+            cost += c
+            self.workers_time[wid] += t
+        gparams = []
+        for k in xrange(len(self._shapes)):
+            g = self._grads_views[active[0]][k].copy()
+            for wid in active[1:]:
+                g += self._grads_views[wid][k]
+            if self._is_mean:
+                g /= n_rows
+            gparams.append(g)
+        self._apply_fn(*(gparams + list(lr)))
+        self._sync_params()
+        self.n_batches += 1
+        self.n_rows += n_rows
+        self.wall_time += time.time() - timer
+        if self._is_mean:
+            return cost / n_rows
+        return cost
+
+    def report(self):
+        """ Returns a dict of throughput statistics since reset_stats(). """
+        wall = max(self.wall_time, 1.E-9)
+        return {'n_workers': self.n_workers,
+                'batches': self.n_batches,
+                'frames': self.n_rows,
+                'seconds': self.wall_time,
+                'frames_per_sec': self.n_rows / wall,
+                'workers_utilization': list(self.workers_time / wall)}
+
+    def close(self):
+        for conn in self._conns:
+            conn.send(('stop', None))
+        for w in self._workers:
+            w.join()
+        self._conns = []
+        self._workers = []
+
+
+def flatten_batch(x, y):
+    """ (x, y) as yielded by the iterators -> list of train_fn arguments. """
+    args = list(x) if type(x) in (list, tuple) else [x]
+    args += list(y) if type(y) in (list, tuple) else [y]
+    return args
+
+
+def benchmark_scaling(nnet, trainer_type, data_iterator, worker_counts,
+        n_batches=20, lr=numpy.float32(0.01), out=sys.stdout):
+    """ Times n_batches updates of data_iterator for each number of workers
+    in worker_counts and prints how the throughput scales. The parameters and
+    accumulators of nnet are restored afterwards. """
+    state = [v.get_value() for v in
+            nnet.params + nnet._accugrads + nnet._accudeltas]
+    batches = []
+    for x, y in data_iterator:
+        batches.append(flatten_batch(x, y))
+        if len(batches) >= n_batches:
+            break
+    extra = [] if "delta" in trainer_type else [lr]
+    results = []
+    for n_workers in worker_counts:
+        trainer = DataParallelTrainer(nnet, trainer_type, n_workers)
+        trainer(*(batches[0] + extra))  # warm-up
+        trainer.reset_stats()
+        for batch in batches:
+            trainer(*(batch + extra))
+        results.append(trainer.report())
+        trainer.close()
+        for v, s in zip(nnet.params + nnet._accugrads + nnet._accudeltas,
+                state):
+            v.set_value(s)
+    base = results[0]
+    print >> out, "workers  frames/sec  speedup  efficiency"
+    for r in results:
+        speedup = r['frames_per_sec'] / base['frames_per_sec']
+        print >> out, "%7i  %10.1f  %7.2f  %10.2f" % (r['n_workers'],
+                r['frames_per_sec'], speedup,
+                speedup * base['n_workers'] / r['n_workers'])
+    return results
@@ -3,36 +3,43 @@ BATCH_SIZE = 100
 import numpy, theano
 from collections import defaultdict
 import random, joblib, math, sys
-from multiprocessing import cpu_count
+from multiprocessing import cpu_count, Pool
 from itertools import izip
 from random import shuffle
+from cmvn import mean_std, normalize
 
 
 def pad(x, nf, ma=0):
-    """ pad x for nf frames with margin ma. """
+    """ pad x for nf frames with margin ma: each frame but the ma first and
+    last ones, stacked with the (nf-1)/2 frames before/after it (zero padded).
+    """
     ba = (nf - 1) / 2  # before/after
-    if ma:
-        ret = numpy.zeros((x.shape[0] - 2 * ma, x.shape[1] * nf),
-                dtype=theano.config.floatX)
-        if ba <= ma:
-            for j in xrange(ret.shape[0]):
-                ret[j] = x[j:j + 2*ma + 1].flatten()
-        else:
-            for j in xrange(ret.shape[0]):
-                ret[j] = numpy.pad(x[max(0, j - ba):j + ba +1].flatten(),
-                        (max(0, (ba - j) * x.shape[1]),
-                            max(0, ((j + ba + 1) - x.shape[0]) * x.shape[1])),
-                        'constant', constant_values=(0, 0))
-        return ret
-    else:
-        ret = numpy.zeros((x.shape[0], x.shape[1] * nf),
-                dtype=theano.config.floatX)
-        for j in xrange(x.shape[0]):
-            ret[j] = numpy.pad(x[max(0, j - ba):j + ba +1].flatten(),
-                    (max(0, (ba - j) * x.shape[1]),
-                        max(0, ((j + ba + 1) - x.shape[0]) * x.shape[1])),
-                    'constant', constant_values=(0, 0))
-        return ret
+    padded = numpy.pad(x, ((ba, ba), (0, 0)), 'constant', constant_values=0)
+    ret = numpy.hstack([padded[k:k + x.shape[0]] for k in xrange(nf)])
+    return numpy.asarray(ret[ma:max(ma, x.shape[0] - ma)],
+            dtype=theano.config.floatX)
+
+
+def transform_chunks(transform_f, xs, prep=None, chunk_frames=20000):
+    """ Applies transform_f (e.g. nnet.transform_x1()) to each of the
+    [nframes, nfeatures] arrays of xs (after prep(x), if given), calling it
+    on concatenations of about chunk_frames frames rather than once per
+    array. Yields the transformed arrays. """
+    i = 0
+    while i < len(xs):
+        chunk = []
+        n = 0
+        while i < len(xs) and n < chunk_frames:
+            chunk.append(xs[i] if prep is None else prep(xs[i]))
+            n += chunk[-1].shape[0]
+            i += 1
+        out = transform_f(numpy.asarray(numpy.concatenate(chunk),
+            dtype=theano.config.floatX))
+        if type(out) == list:  # ABNeuralNet2Outputs: [words, speakers]
+            out = out[0]
+        for e in numpy.split(out,
+                numpy.cumsum([x.shape[0] for x in chunk[:-1]])):
+            yield e
 
 
 from dtw import DTW
@@ -41,6 +48,13 @@ def do_dtw(x1, x2):
     return dtw[0], dtw[-1][1], dtw[-1][2]
 
 
+_DTW_SHARED = {}  # inherited (not copied) by the forked DTW workers
+
+
+def _dtw_shared(i):
+    return do_dtw(_DTW_SHARED['xes1'][i], _DTW_SHARED['xes2'][i])
+
+
 class DatasetMiniBatchIterator(object):
     """ Basic mini-batch iterator """
     def __init__(self, x, y, batch_size=BATCH_SIZE, randomize=False):
@@ -51,6 +65,9 @@ class DatasetMiniBatchIterator(object):
         from sklearn.utils import check_random_state
         self.rng = check_random_state(42)
 
+    def set_batch_size(self, batch_size):
+        self.batch_size = batch_size
+
     def __iter__(self):
         n_samples = self.x.shape[0]
         if self.randomize:
@@ -68,6 +85,29 @@ class DatasetMiniBatchIterator(object):
                        self.y[i*self.batch_size:(i+1)*self.batch_size])
 
 
+class DatasetSubsetIterator(object):
+    """ A fixed random subset of n_batches batches of another iterator, drawn
+    once (reservoir sampling, one pass) so that the scores of successive
+    epochs are computed on the same batches. """
+    def __init__(self, given_set, n_batches, seed=1234):
+        rng = random.Random(seed)
+        self._batches = []
+        for i, batch in enumerate(given_set):
+            if i < n_batches:
+                self._batches.append(batch)
+            else:
+                j = rng.randint(0, i)
+                if j < n_batches:
+                    self._batches[j] = batch
+
+    def __len__(self):
+        return len(self._batches)
+
+    def __iter__(self):
+        for batch in self._batches:
+            yield batch
+
+
 class DatasetSentencesIterator(object):
     """ An iterator on sentences of the dataset. """
 
@@ -89,16 +129,7 @@ class DatasetSentencesIterator(object):
         """ Method because of the memoization. """
         if start in self._memoized_x and end in self._memoized_x[start]:
             return self._memoized_x[start][end]
-        x = self._x[start:end]
-        nf = self._nframes
-        ret = numpy.zeros((x.shape[0], x.shape[1] * nf),
-                dtype=theano.config.floatX)
-        ba = (nf - 1) / 2  # before/after
-        for i in xrange(x.shape[0]):
-            ret[i] = numpy.pad(x[max(0, i - ba):i + ba +1].flatten(),
-                    (max(0, (ba - i) * x.shape[1]),
-                        max(0, ((i + ba + 1) - x.shape[0]) * x.shape[1])),
-                    'constant', constant_values=(0, 0))
+        ret = pad(self._x[start:end], self._nframes)
         self._memoized_x[start][end] = ret
         return ret
 
@@ -141,6 +172,9 @@ class DatasetABIterator(object):
         assert(self.x1.shape[0] == self.y.shape[0])
         self.batch_size = batch_size
 
+    def set_batch_size(self, batch_size):
+        self.batch_size = batch_size
+
     def __iter__(self):
         n_samples = self.x1.shape[0]
         for i in xrange((n_samples + self.batch_size - 1)
@@ -284,10 +318,14 @@ class DatasetAB2OSamplingIteratorFromLabels(object):
 
 
 class DatasetDTWIterator(object):
-    """ An iterator over dynamic time warped words of the dataset. """
+    """ An iterator over dynamic time warped words of the dataset (normalized
+    by mean and std, if given, as the mini-batches are made). """
 
-    def __init__(self, x1, x2, y, nframes=1, batch_size=1, marginf=0):
+    def __init__(self, x1, x2, y, nframes=1, batch_size=1, marginf=0,
+            mean=None, std=None):
         # x1 and x2 are tuples or arrays that are [nframes, nfeatures]
+        self._mean = mean
+        self._std = std
         self._x1 = x1
         self._x2 = x2
         self._y = [numpy.zeros(x.shape[0], dtype='int8') for x in self._x1]
@@ -312,63 +350,57 @@ class DatasetDTWIterator(object):
             return [[self._x1_mem[ind], self._x2_mem[ind]], self._y_mem[ind]]
 
         nf = self._nframes
-        def local_pad(x):  # TODO replace with pad global function
+        def local_pad(x):
             if nf <= 1:
                 return x
-            if self._margin:
-                ma = self._margin
-                ba = (nf - 1) / 2  # before/after
-                if x.shape[0] - 2*ma <= 0:
-                    print >> sys.stderr, "shape[0]:", x.shape[0]
-                    print >> sys.stderr, "ma:", ma
-                if x.shape[1] * nf <= 0:
-                    print >> sys.stderr, "shape[1]:", x.shape[1]
-                    print >> sys.stderr, "nf:", nf
-                ret = numpy.zeros((max(0, x.shape[0] - 2 * ma),
-                    x.shape[1] * nf),
-                    dtype=theano.config.floatX)
-                if ba <= ma:
-                    for j in xrange(ret.shape[0]):
-                        ret[j] = x[j + ma - ba:j + ma + ba + 1].flatten()
-                else:
-                    for j in xrange(ret.shape[0]):
-                        ret[j] = numpy.pad(x[max(0, j - ba + ma):j + ba + ma + 1].flatten(),
-                                (max(0, (ba - j - ma) * x.shape[1]),
-                                    max(0, ((j + ba + ma + 1) - x.shape[0]) * x.shape[1])),
-                                'constant', constant_values=(0, 0))
-                return ret
-            else:
-                ret = numpy.zeros((x.shape[0], x.shape[1] * nf),
-                        dtype=theano.config.floatX)
-                ba = (nf - 1) / 2  # before/after
-                for j in xrange(x.shape[0]):
-                    ret[j] = numpy.pad(x[max(0, j - ba):j + ba +1].flatten(),
-                            (max(0, (ba - j) * x.shape[1]),
-                                max(0, ((j + ba + 1) - x.shape[0]) * x.shape[1])),
-                            'constant', constant_values=(0, 0))
-                return ret
-        
+            ma = self._margin
+            if ma and x.shape[0] - 2*ma <= 0:
+                print >> sys.stderr, "shape[0]:", x.shape[0]
+                print >> sys.stderr, "ma:", ma
+            return pad(x, nf, ma)
+
         def cut_y(y):
             ma = self._margin
             if nf <= 1 or ma == 0:
                 return numpy.asarray(y, dtype='int8')
-            ret = numpy.zeros(max(0, (y.shape[0] - 2 * ma)), dtype='int8')
-            for j in xrange(ret.shape[0]):
-                ret[j] = y[j+ma]
-            return ret
+            return numpy.asarray(y[ma:max(ma, y.shape[0] - ma)], dtype='int8')
 
-        x1_padded = [local_pad(self._x1[i+k]) for k 
+        x1_padded = [local_pad(self._scale(self._x1[i+k])) for k 
                 in xrange(self._nwords) if i+k < len(self._x1)]
-        x2_padded = [local_pad(self._x2[i+k]) for k
+        x2_padded = [local_pad(self._scale(self._x2[i+k])) for k
                 in xrange(self._nwords) if i+k < len(self._x2)]
         assert x1_padded[0].shape[0] == x2_padded[0].shape[0]
         y_padded = [cut_y(self._y[i+k]) for k in
             xrange(self._nwords) if i+k < len(self._y)]
         assert x1_padded[0].shape[0] == len(y_padded[0])
-        self._x1_mem.append(numpy.concatenate(x1_padded))
-        self._x2_mem.append(numpy.concatenate(x2_padded))
-        self._y_mem.append(numpy.concatenate(y_padded))
-        return [[self._x1_mem[ind], self._x2_mem[ind]], self._y_mem[ind]]
+        xx1 = numpy.concatenate(x1_padded)
+        xx2 = numpy.concatenate(x2_padded)
+        yy = numpy.concatenate(y_padded)
+        if self._memoized():
+            self._x1_mem.append(xx1)
+            self._x2_mem.append(xx2)
+            self._y_mem.append(yy)
+        return [[xx1, xx2], yy]
+
+    def _scale(self, x):
+        """ float32 (x - mean) / std, or x without mean and std. """
+        if self._mean is None:
+            return x
+        return normalize(x, self._mean, self._std)
+
+    def _memoized(self):
+        """ Whether the mini-batches are kept: not if they are scaled (only
+        the raw words are kept then, the mini-batches being made again at
+        each epoch). """
+        return self._mean is None
+
+    def set_batch_size(self, batch_size):
+        """ Changes the number of words per mini-batch (and forgets the
+        memoized mini-batches). """
+        self._nwords = batch_size
+        for mem in ('_x1_mem', '_x2_mem', '_y_mem', '_y1_mem', '_y2_mem'):
+            if hasattr(self, mem):
+                setattr(self, mem, [])
 
     def __iter__(self):
         for i in xrange(0, len(self._y), self._nwords):
@@ -376,17 +408,21 @@ class DatasetDTWIterator(object):
 
 
 class DatasetDTWWrdSpkrIterator(DatasetDTWIterator):
-    """ TODO """
+    """ TODO
+    The words are kept as they are and scaled (see _scale) when the
+    mini-batches are gathered; with a cmvn (see cmvn.py), by the mean and
+    std of their speaker instead of the global ones of prep_data. """
 
     def __init__(self, data_same, normalize=True, min_max_scale=False,
             scale_f1=None, scale_f2=None,
             nframes=1, batch_size=1, marginf=0, only_same=False,
-            cache_to_disk=False):
+            cache_to_disk=False, cmvn=None):
         self.print_mean_DTW_costs(data_same)
         self.ratio_same = 0.5  # init
         self.ratio_same = self.compute_ratio_speakers(data_same)
         self._nframes = nframes
         print "nframes:", self._nframes
+        self._cmvn = cmvn
 
         (self._x1, self._x2, self._y_word, self._y_spkr,
                 self._scale_f1, self._scale_f2) = self.prep_data(data_same,
@@ -407,6 +443,9 @@ class DatasetDTWWrdSpkrIterator(DatasetDTWIterator):
         self._x2_mem = []
         self._y1_mem = []
         self._y2_mem = []
+        self._data_same = data_same  # for mine_hard_negatives
+        self._normalize = normalize
+        self._min_max_scale = min_max_scale
         self.cache_to_disk = cache_to_disk
         if self.cache_to_disk:
             from joblib import Memory
@@ -423,55 +462,26 @@ class DatasetDTWWrdSpkrIterator(DatasetDTWIterator):
                     [self._y1_mem[ind], self._y2_mem[ind]]]
 
         nf = self._nframes
-        def local_pad(x):  # TODO replace with pad global function
+        def local_pad(x):
             if nf <= 1:
                 return x
-            if self._margin:
-                ma = self._margin
-                ba = (nf - 1) / 2  # before/after
-                if x.shape[0] - 2*ma <= 0:
-                    print >> sys.stderr, "shape[0]:", x.shape[0]
-                    print >> sys.stderr, "ma:", ma
-                if x.shape[1] * nf <= 0:
-                    print >> sys.stderr, "shape[1]:", x.shape[1]
-                    print >> sys.stderr, "nf:", nf
-                ret = numpy.zeros((max(0, x.shape[0] - 2 * ma),
-                    x.shape[1] * nf),
-                    dtype=theano.config.floatX)
-                if ba <= ma:
-                    for j in xrange(ret.shape[0]):
-                        ret[j] = x[j + ma - ba:j + ma + ba + 1].flatten()
-                else:
-                    for j in xrange(ret.shape[0]):
-                        ret[j] = numpy.pad(x[max(0, j - ba + ma):j + ba + ma + 1].flatten(),
-                                (max(0, (ba - j - ma) * x.shape[1]),
-                                    max(0, ((j + ba + ma + 1) - x.shape[0]) * x.shape[1])),
-                                'constant', constant_values=(0, 0))
-                return ret
-            else:
-                ret = numpy.zeros((x.shape[0], x.shape[1] * nf),
-                        dtype=theano.config.floatX)
-                ba = (nf - 1) / 2  # before/after
-                for j in xrange(x.shape[0]):
-                    ret[j] = numpy.pad(x[max(0, j - ba):j + ba +1].flatten(),
-                            (max(0, (ba - j) * x.shape[1]),
-                                max(0, ((j + ba + 1) - x.shape[0]) * x.shape[1])),
-                            'constant', constant_values=(0, 0))
-                return ret
-        
+            ma = self._margin
+            if ma and x.shape[0] - 2*ma <= 0:
+                print >> sys.stderr, "shape[0]:", x.shape[0]
+                print >> sys.stderr, "ma:", ma
+            return pad(x, nf, ma)
+
         def cut_y(y):
             ma = self._margin
             if nf <= 1 or ma == 0:
                 return numpy.asarray(y, dtype='int8')
-            ret = numpy.zeros(max(0, (y.shape[0] - 2 * ma)), dtype='int8')
-            for j in xrange(ret.shape[0]):
-                ret[j] = y[j+ma]
-            return ret
+            return numpy.asarray(y[ma:max(ma, y.shape[0] - ma)], dtype='int8')
 
-        x1_padded = [local_pad(self._x1[i+k]) for k 
-                in xrange(self._nwords) if i+k < len(self._x1)]
-        x2_padded = [local_pad(self._x2[i+k]) for k
-                in xrange(self._nwords) if i+k < len(self._x2)]
+        # scaled here, only the words of this mini-batch
+        x1_padded = [local_pad(self._scale(self._x1[i+k], self._spkrs1[i+k]))
+                for k in xrange(self._nwords) if i+k < len(self._x1)]
+        x2_padded = [local_pad(self._scale(self._x2[i+k], self._spkrs2[i+k]))
+                for k in xrange(self._nwords) if i+k < len(self._x2)]
         assert x1_padded[0].shape[0] == x2_padded[0].shape[0]
         y1_padded = [cut_y(self._y1[i+k]) for k in
             xrange(self._nwords) if i+k < len(self._y1)]
@@ -483,7 +493,7 @@ class DatasetDTWWrdSpkrIterator(DatasetDTWIterator):
         xx2 = numpy.concatenate(x2_padded)
         yy1 = numpy.concatenate(y1_padded)
         yy2 = numpy.concatenate(y2_padded)
-        if not self.cache_to_disk:
+        if not self.cache_to_disk and self._memoized():
             self._x1_mem.append(xx1)
             self._x2_mem.append(xx2)
             self._y1_mem.append(yy1)
@@ -583,7 +593,7 @@ class DatasetDTWWrdSpkrIterator(DatasetDTWIterator):
                 p2 = data_same[word_2][3+wt2]
                 r1 = p1[:min(len(p1), len(p2))]
                 r2 = p2[:min(len(p1), len(p2))]
-                data_diff.append((r1, r2))
+                data_diff.append((r1, r2, spkr1, spkr2))
                 #if spkr1[0] == spkr2[0]:  # TODO TODO speaker sex/genre
                 if spkr1 == spkr2:
                     #print "same spkr diff word"
@@ -594,65 +604,41 @@ class DatasetDTWWrdSpkrIterator(DatasetDTWIterator):
             ratio = numpy.mean(y_spkrs_diff)
             print "ratio same spkr / all for diff:", ratio
 
-        x_arr_same = numpy.r_[numpy.concatenate([e[3] for e in data_same]),
-            numpy.concatenate([e[4] for e in data_same])]
-        print x_arr_same.shape
-        if SAMPLE_DIFF_WORDS:
-            x_arr_diff = numpy.r_[numpy.concatenate([e[0] for e in data_diff]),
-                    numpy.concatenate([e[1] for e in data_diff])]
-            print x_arr_diff.shape
-        else:
-            x_arr_diff = None
-
-        if normalize:
+        def all_words():
+            # the words of the dataset, without concatenating them
+            for e in data_same:
+                yield e[3]
+                yield e[4]
+            for e in data_diff:
+                yield e[0]
+                yield e[1]
+
+        if self._cmvn is not None:
+            pass  # per speaker, see _scale
+        elif normalize:
             # Normalizing
-            if scale_f1 == None or scale_f2 == None:
-                if x_arr_diff != None:
-                    x_arr_all = numpy.concatenate([x_arr_same, x_arr_diff])
-                else:
-                    x_arr_all = x_arr_same
-                scale_f1 = numpy.mean(x_arr_all, 0)
-                scale_f2 = numpy.std(x_arr_all, 0)
+            if scale_f1 is None or scale_f2 is None:
+                scale_f1, scale_f2 = mean_std(all_words())
                 numpy.savez("mean_std_spkr_word.npz", mean=scale_f1, std=scale_f2)
-
-            x_same = [((e[3][e[-2]] - scale_f1) / scale_f2,
-                (e[4][e[-1]] - scale_f1) / scale_f2)
-                    for e in data_same]
         elif min_max_scale:
             # Min-max scaling
-            if scale_f1 == None or scale_f2 == None:
-                if x_arr_diff != None:
-                    x_arr_all = numpy.concatenate([x_arr_same, x_arr_diff])
-                else:
-                    x_arr_all = x_arr_same
-                scale_f1 = x_arr_all.min(axis=0)
-                scale_f2 = x_arr_all.max(axis=0)
+            if scale_f1 is None or scale_f2 is None:
+                scale_f1 = numpy.min([x.min(axis=0) for x in all_words()], 0)
+                scale_f2 = numpy.max([x.max(axis=0) for x in all_words()], 0)
                 numpy.savez("min_max_spkr_word.npz", min=scale_f1, max=scale_f2)
-
-            x_same = [((e[3][e[-2]] - scale_f1) / 10*(scale_f2 - scale_f1),
-                (e[4][e[-1]] - scale_f1) / 10*(scale_f2 - scale_f1))
-                    for e in data_same]
-        else:
-            x_same = [(e[3][e[-2]], e[4][e[-1]]) for e in data_same]
-        zipped = zip(x_same, y_spkrs_same)
+        # scaled in _memoize, mini-batch by mini-batch
+        x_same = [(e[3][e[-2]], e[4][e[-1]]) for e in data_same]
+        spkrs_same = [(e[1], e[2]) for e in data_same]
+        zipped = zip(x_same, y_spkrs_same, spkrs_same)
         shuffle(zipped)
-        x_same, y_sprks_same = zip(*zipped)
+        x_same, y_sprks_same, spkrs_same = zip(*zipped)
         y_same = [[1 for _ in xrange(len(e[0]))] for e in x_same]
         y_same_spkr = [[y_spkrs_same[i] for _ in xrange(len(e[0]))] for i, e
                 in enumerate(x_same)]
         assert(len(y_same) == len(y_same_spkr))
 
         if SAMPLE_DIFF_WORDS:
-            if normalize:
-                x_diff = [((e[0] - scale_f1) / scale_f2,
-                    (e[1] - scale_f1) / scale_f2)
-                        for e in data_diff]
-            elif min_max_scale:
-                x_diff = [((e[0] - scale_f1) / 10*(scale_f2 - scale_f1),
-                    (e[1] - scale_f1) / 10*(scale_f2 - scale_f1))
-                        for e in data_diff]
-            else:
-                x_diff = [(e[0], e[1]) for e in data_diff]
+            x_diff = [(e[0], e[1]) for e in data_diff]
             y_diff = [[0 for _ in xrange(len(e[0]))] for e in x_diff]
             y_diff_spkr = [[y_spkrs_diff[i] for _ in xrange(len(e[0]))] for i, e
                     in enumerate(x_diff)]
@@ -662,10 +648,14 @@ class DatasetDTWWrdSpkrIterator(DatasetDTWIterator):
             y_spkr = [j for i in zip(y_same_spkr, y_diff_spkr) for j in i]
             x = [j for i in zip(x_same, x_diff) for j in i]
             x1, x2 = zip(*x)
+            spkrs = [j for i in zip(spkrs_same, [(e[2], e[3])
+                for e in data_diff]) for j in i]
         else:
             x1, x2 = zip(*x_same)
             y_word = y_same
             y_spkr = y_same_spkr
+            spkrs = spkrs_same
+        self._spkrs1, self._spkrs2 = map(list, zip(*spkrs))
         #print x1[0]
         #print x2[0]
         #print y_word[0]
@@ -684,6 +674,98 @@ class DatasetDTWWrdSpkrIterator(DatasetDTWIterator):
 
         return x1, x2, y_word, y_spkr, scale_f1, scale_f2
 
+    def _scale(self, x, speaker=None):
+        """ Scales the filterbanks x (of speaker) with the scale_f1/f2 of
+        prep_data (or with the cmvn), in a float32 copy if normalized. """
+        if self._cmvn is not None:
+            return self._cmvn.normalize(x, speaker)
+        elif self._normalize:
+            return normalize(x, self._scale_f1, self._scale_f2)
+        elif self._min_max_scale:
+            return (x - self._scale_f1) / 10*(self._scale_f2 - self._scale_f1)
+        return x
+
+    def _memoized(self):
+        return (self._cmvn is None and not self._normalize and
+                not self._min_max_scale)
+
+    def embed_words(self, transform_f, tokens):
+        """ Mean-pooled (over frames) embeddings of the tokens, that are
+        (index in data_same, 0|1 for the first|second word of the pair),
+        computed with transform_f (nnet.transform_x1()). """
+        prep = lambda (d, side): pad(self._scale(self._data_same[d][3+side],
+            self._data_same[d][1+side]), self._nframes)
+        return numpy.array([e.mean(axis=0) for e in transform_chunks(
+            transform_f, tokens, prep)])
+
+    def mine_hard_negatives(self, transform_f, n_neighbours=10,
+            ratio_hard=1.):
+        """ Replaces the (randomly sampled) pairs of different words by pairs
+        of confusable different words: all the word tokens are embedded with
+        transform_f (see embed_words), and for a random token, the second
+        word is drawn among its n_neighbours nearest (cosine) tokens of a
+        different word. ratio_hard is the proportion of the pairs of
+        different words that are replaced (the others are kept). Can be
+        called again (e.g. every few epochs) with the current transform_f.
+        """
+        tokens = [(d, side) for d in xrange(len(self._data_same))
+                for side in (0, 1)]
+        word_ids = {}
+        labels = numpy.array([word_ids.setdefault(self._data_same[d][0],
+            len(word_ids)) for d, _ in tokens])
+        embs = self.embed_words(transform_f, tokens)
+        embs /= numpy.maximum(numpy.sqrt((embs ** 2).sum(axis=1)),
+                1.E-8)[:, None]
+        n = len(tokens)
+        k = min(n_neighbours, n - 1)
+        neighbours = numpy.zeros((n, k), dtype='int64')
+        similarities = numpy.zeros((n, k), dtype=embs.dtype)
+        block = max(1, 2**24 / n)  # rows of the similarity matrix at once
+        for b in xrange(0, n, block):
+            sim = numpy.dot(embs[b:b+block], embs.T)
+            sim[labels[b:b+block, None] == labels[None, :]] = -numpy.inf
+            ind = numpy.argpartition(-sim, k - 1, axis=1)[:, :k]
+            neighbours[b:b+block] = ind
+            similarities[b:b+block] = sim[numpy.arange(sim.shape[0])[:, None],
+                    ind]
+
+        x1 = list(self._x1)
+        x2 = list(self._x2)
+        hard = []
+        for j in xrange(1, len(x1), 2):  # pairs of different words
+            if random.random() >= ratio_hard:
+                continue
+            t1 = random.randint(0, n - 1)
+            c = random.randint(0, k - 1)
+            if similarities[t1, c] == -numpy.inf:  # only this word left
+                continue
+            hard.append(similarities[t1, c])
+            d1, side1 = tokens[t1]
+            d2, side2 = tokens[neighbours[t1, c]]
+            p1 = self._data_same[d1][3+side1]
+            p2 = self._data_same[d2][3+side2]
+            l = min(len(p1), len(p2))
+            spkr1 = self._data_same[d1][1+side1]
+            spkr2 = self._data_same[d2][1+side2]
+            same_spkr = int(spkr1 == spkr2)
+            x1[j] = p1[:l]  # scaled in _memoize
+            x2[j] = p2[:l]
+            self._spkrs1[j] = spkr1
+            self._spkrs2[j] = spkr2
+            self._y_word[j] = [0 for _ in xrange(l)]
+            self._y_spkr[j] = [same_spkr for _ in xrange(l)]
+            self._y1[j] = numpy.zeros(l, dtype='int8')
+            self._y2[j] = numpy.zeros(l, dtype='int8') + same_spkr
+        rand = numpy.random.randint(0, n, size=(2, min(10000, n)))
+        rand = rand[:, labels[rand[0]] != labels[rand[1]]]
+        print "mined", len(hard), "hard negatives, mean cosine similarity",\
+                numpy.mean(hard) if len(hard) else numpy.nan,\
+                "(random different words:",\
+                numpy.mean((embs[rand[0]] * embs[rand[1]]).sum(axis=1)), ")"
+        self._x1 = x1
+        self._x2 = x2
+        self.set_batch_size(self._nwords)  # forgets the memoized batches
+
 
 
 class DatasetDTReWIterator(DatasetDTWIterator):
@@ -691,6 +773,7 @@ class DatasetDTReWIterator(DatasetDTWIterator):
 
     def __init__(self, data_same, mean, std, nframes=1, batch_size=1, marginf=0, only_same=False):
         dtw_costs = zip(*data_same)[5]
+        self._dtw_costs = numpy.array(dtw_costs)
         self._orig_x1s = zip(*data_same)[3]
         self._orig_x2s = zip(*data_same)[4]
         self._words_frames = numpy.asarray([fb.shape[0] for fb in self._orig_x1s])
@@ -734,6 +817,8 @@ class DatasetDTReWIterator(DatasetDTWIterator):
 
         self._data_same = zip(zip(*data_same)[3], zip(*data_same)[4],
                 zip(*data_same)[-2], zip(*data_same)[-1])
+        self._aligned_on = [None for _ in data_same]
+        # embeddings of the pairs at their last recompute_DTW
         self._data_diff = data_diff
 
         self.remix()
@@ -749,12 +834,11 @@ class DatasetDTReWIterator(DatasetDTWIterator):
 
 
     def remix(self):
-        x_same = [((e[0][e[-2]] - self._mean) / self._std, (e[1][e[-1]] - self._mean) / self._std)
-                for e in self._data_same]
+        # normalized by _memoize (see DatasetDTWIterator._scale)
+        x_same = [(e[0][e[-2]], e[1][e[-1]]) for e in self._data_same]
         y_same = [[1 for _ in xrange(len(e[0]))] for i, e in enumerate(x_same)]
         if not self._only_same:
-            x_diff = [((e[0] - self._mean) / self._std, (e[1] - self._mean) / self._std)
-                    for e in self._data_diff]
+            x_diff = list(self._data_diff)
             random.shuffle(x_diff)
             y_diff = [[0 for _ in xrange(len(e[0]))] for i, e in enumerate(x_diff)]
             y = [j for i in zip(y_same, y_diff) for j in i]
@@ -774,25 +858,41 @@ class DatasetDTReWIterator(DatasetDTWIterator):
         self._x2_mem = []
         self._y_mem = []
 
-    def recompute_DTW(self, transform_f):
-        from itertools import izip
-        xes1 = map(transform_f, self._orig_x1s)
-        xes2 = map(transform_f, self._orig_x2s)
-        res = joblib.Parallel(n_jobs=cpu_count()-3)(joblib.delayed(do_dtw)
-                (x1, x2) for x1, x2 in izip(xes1, xes2))
-        dtw_costs = zip(*res)[0]
-        self.print_mean_DTW_costs(dtw_costs)
-        ds = zip(*self._data_same)
-        rs = zip(*res)
-        data_same_00shapes = self._data_same[0][0].shape
-        data_same_01shapes = self._data_same[0][1].shape
-        print data_same_00shapes
-        print data_same_01shapes
-        self._data_same = zip(ds[0], ds[1], rs[-2], rs[-1])
-        data_same_00shapes = self._data_same[0][0].shape
-        data_same_01shapes = self._data_same[0][1].shape
-        print data_same_00shapes
-        print data_same_01shapes
+    def recompute_DTW(self, transform_f, threshold=0., n_jobs=None):
+        """ Realigns the pairs of same words by DTW on their embeddings by
+        transform_f, but only the pairs for which the embeddings of one of
+        the words moved (norm of the difference relative to the norm of the
+        embeddings) by more than threshold since their last realignment.
+        The DTWs are done by n_jobs forked processes that share the
+        embeddings (default: all cores but 3). """
+        xes1 = list(transform_chunks(transform_f, self._orig_x1s))
+        xes2 = list(transform_chunks(transform_f, self._orig_x2s))
+
+        def moved(new, old):
+            return (numpy.sqrt(((new - old) ** 2).sum())
+                    / max(numpy.sqrt((old ** 2).sum()), 1.E-8))
+        todo = [i for i, old in enumerate(self._aligned_on) if old is None
+                or max(moved(xes1[i], old[0]), moved(xes2[i], old[1]))
+                > threshold]
+        print "realigning", len(todo), "pairs out of", len(xes1)
+        if n_jobs is None:
+            n_jobs = max(1, cpu_count() - 3)
+        _DTW_SHARED['xes1'] = xes1
+        _DTW_SHARED['xes2'] = xes2
+        if n_jobs > 1 and len(todo) > 1:
+            pool = Pool(n_jobs)
+            res = pool.map(_dtw_shared, todo,
+                    chunksize=max(1, len(todo) / (4 * n_jobs)))
+            pool.close()
+            pool.join()
+        else:
+            res = map(_dtw_shared, todo)
+        _DTW_SHARED.clear()
+        for i, (cost, path1, path2) in izip(todo, res):
+            self._dtw_costs[i] = cost
+            self._data_same[i] = self._data_same[i][:2] + (path1, path2)
+            self._aligned_on[i] = (xes1[i], xes2[i])
+        self.print_mean_DTW_costs(self._dtw_costs)
         self._margin = 0  # TODO CORRECT THAT IF NEEDED
         self.remix()
 
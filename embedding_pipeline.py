@@ -0,0 +1,402 @@
+"""
+Embeds many utterances with a trained nnet, straight into h5features files.
+
+The features files (*.npz with 'features' and 'time', as made by
+stack_fbanks.py, or raw *.npy filterbanks that are stacked here) are read by
+a pool of threads, normalized, and packed into batches of about batch_frames
+frames for the transform function, whose outputs are split back by utterance
+and written (with their times and the files names) to one h5features file
+per output of the transform (e.g. words and speakers embeddings for
+ABNeuralNet2Outputs):
+
+    python embedding_pipeline.py nnet.pickle mean_std_spkr_word.npz npz11_test emb11_wrd_test.features emb11_spkr_test.features
+
+With --all-layers, the outputs of all the layers (and both heads of
+ABNeuralNet2Outputs) are computed in the same forward pass and written in
+one HDF5 file, with one dataset per layer (layer_0, layer_1, ..., words,
+spkrs) and an index of the files (see export_layers), e.g. for
+buckeye/ftest.py:
+
+    python embedding_pipeline.py nnet.pickle mean_std_spkr_word.npz npz11_test layers_test.h5 --all-layers
+
+The input can also be a features archive (see features_archive.py) of
+stacked features or of raw filterbanks, and with --archive the outputs are
+written as features archives (with the speakers of the input archive):
+
+    python embedding_pipeline.py nnet.pickle mean_std_spkr_word.npz buckeye_test_fbanks emb11_wrd_test emb11_spkr_test --archive
+
+With --cmvn=STATS (the fbanks_cmvn.npz of the extraction, see cmvn.py),
+the features of each utterance are normalized by the mean and std of its
+speaker (from the features archive, or else the start of the names, e.g.
+'fcjf0' for 'fcjf0_sa1') as they are packed in batches, instead of the
+global mean and std.
+
+OnlineEmbedder embeds a signal given by chunks of samples (live audio, or a
+recording too long to hold its features in memory) with a bounded latency
+((nframes-1)/2 frames plus one filterbanks window) and a constant memory:
+
+    nnet, nframes, mean, std = load_nnet(nnet_fname, mean_std_fname)
+    embedder = OnlineEmbedder(nnet.transform_x1(), MelFbanks(lowerf=50),
+            nframes, mean, std)
+    for chunk in chunks:
+        out = embedder.feed(chunk)
+        if out is not None:
+            time, embs = out
+    out = embedder.finish()
+"""
+
+import os, glob, cPickle
+import numpy as np
+from multiprocessing.pool import ThreadPool
+import h5py
+from nnet_archs import ABNeuralNet2Outputs
+from npz2h5features import H5FeaturesWriter, bounded_imap
+from mel_fbanks import OnlineFbanks
+from features_archive import FeaturesArchive, ArchiveWriter, archive_exists
+from cmvn import CMVN
+
+NFEATURES = 40
+FRAMES_PER_SEC = 100  # features frames per second
+FEATURES_RATE = 1. / FRAMES_PER_SEC
+
+
+def stack(fbanks, nframes):
+    """ Stacks nframes frames around each frame of fbanks (zero padded), as
+    stack_fbanks.py does. """
+    b_a = (nframes - 1) / 2
+    padded = np.pad(fbanks, ((b_a, b_a), (0, 0)), 'constant',
+            constant_values=0)
+    return np.hstack([padded[k:k + fbanks.shape[0]]
+        for k in xrange(nframes)]).astype('float32')
+
+
+class OnlineStacker(object):
+    """ Stacks nframes frames around each frame of filterbanks given by
+    chunks, as stack does (zero padded) and normalized by the (stacked) mean
+    and std: feed(fbanks) returns the stacked frames whose (nframes-1)/2
+    next frames are known, and finish() the last ones. Only the last
+    nframes-1 frames are kept between the calls. """
+    def __init__(self, nframes, mean=None, std=None):
+        self.nframes = nframes
+        self.mean = mean
+        self.std = std
+        self.reset()
+
+    def reset(self):
+        self._frames = None
+
+    def _stack(self):
+        n = self._frames.shape[0] - (self.nframes - 1)
+        if n <= 0:
+            return np.zeros((0, self._frames.shape[1] * self.nframes),
+                    dtype='float32')
+        X = np.hstack([self._frames[k:k + n] for k in xrange(self.nframes)])
+        self._frames = self._frames[n:]
+        if self.mean is not None:
+            X = (X - self.mean) / self.std
+        return np.asarray(X, dtype='float32')
+
+    def feed(self, fbanks):
+        if self._frames is None:  # the zero padding of the first frames
+            self._frames = np.zeros(((self.nframes - 1) / 2, fbanks.shape[1]))
+        self._frames = np.r_[self._frames, fbanks]
+        return self._stack()
+
+    def finish(self):
+        """ The last stacked frames (zero padded), then resets for a new
+        utterance. """
+        if self._frames is None:
+            return None
+        self._frames = np.r_[self._frames, np.zeros(((self.nframes - 1) / 2,
+            self._frames.shape[1]))]
+        X = self._stack()
+        self.reset()
+        return X
+
+
+class OnlineEmbedder(object):
+    """ Embeds a signal given by chunks of samples with transform (e.g.
+    nnet.transform_x1()): the filterbanks (of the MelFbanks fbanks) of the
+    new complete windows are stacked (OnlineStacker) and only the new
+    stacked frames go through transform, so that each frame is embedded
+    once, as soon as its (nframes-1)/2 next frames are known. """
+    def __init__(self, transform, fbanks, nframes, mean=None, std=None):
+        self.transform = transform
+        self.fbanks = OnlineFbanks(fbanks)
+        self.stacker = OnlineStacker(nframes, mean, std)
+        self._n = 0  # frames embedded so far
+
+    def _embed(self, X):
+        if X is None or not X.shape[0]:
+            return None
+        embs = self.transform(X)
+        if type(embs) != list:
+            embs = [embs]
+        time = (self._n + np.arange(X.shape[0])) * FEATURES_RATE + \
+                FEATURES_RATE / 2
+        self._n += X.shape[0]
+        return time, embs
+
+    def feed(self, samples):
+        """ (time, [outputs of transform]) of the frames that can be
+        embedded with samples, or None if there is none yet. """
+        return self._embed(self.stacker.feed(self.fbanks.feed(samples)))
+
+    def finish(self):
+        """ (time, [outputs of transform]) of the last frames of the signal,
+        then resets for a new signal. """
+        X = self.stacker.feed(self.fbanks.finish())
+        last = self.stacker.finish()
+        out = self._embed(np.r_[X, last])
+        self._n = 0
+        return out
+
+
+def read_features(fname, nframes=1):
+    """ (name, features, time) of a *.npz (already stacked) or *.npy (raw
+    filterbanks, stacked on nframes) file. """
+    name = os.path.splitext(os.path.basename(fname))[0]
+    if fname.endswith('.npy'):
+        fbanks = np.load(fname)
+        if nframes > 1:
+            fbanks = stack(fbanks, nframes)
+        time = np.arange(fbanks.shape[0]) * FEATURES_RATE + FEATURES_RATE / 2
+        return name, fbanks, time
+    npz = np.load(fname)
+    return name, npz['features'], npz['time']
+
+
+def archive_features(archive, nframes=1):
+    """ Yields the (name, features, time) of the utterances of a
+    FeaturesArchive, stacked on nframes if they are raw filterbanks. """
+    for name, _, features in archive.utterances():
+        if nframes > 1 and archive.dim == NFEATURES:
+            features = stack(features, nframes)
+        time = np.arange(features.shape[0]) * FEATURES_RATE + \
+                FEATURES_RATE / 2
+        yield name, features, time
+
+
+def utterance_speaker(fnames, name):
+    """ Speaker of the utterance name of fnames (a FeaturesArchive or a list
+    of files named speaker_utterance). """
+    if isinstance(fnames, FeaturesArchive):
+        return fnames.speaker(name)
+    return name.split('_')[0]
+
+
+def packed_batches(fnames, nframes=1, mean=None, std=None,
+        batch_frames=20000, n_readers=4, cmvn=None):
+    """ Reads fnames with n_readers threads, at most 2 * n_readers files
+    ahead (or the utterances of fnames if it is a FeaturesArchive), and
+    yields (utterances, X): X is the
+    (normalized by mean and std) concatenation of the features of
+    consecutive utterances, of about batch_frames frames, and utterances
+    their [(name, features, time)]. With a CMVN, each utterance is
+    normalized by the mean and std of its speaker instead. """
+    pool = ThreadPool(n_readers)
+
+    def pack(batch):
+        if cmvn is not None:
+            X = np.empty((sum(x.shape[0] for _, x, _ in batch),
+                batch[0][1].shape[1]), dtype='float32')
+            n = 0
+            for name, x, _ in batch:
+                cmvn.normalize(x, utterance_speaker(fnames, name),
+                        out=X[n:n + x.shape[0]])
+                n += x.shape[0]
+            return batch, X
+        X = np.concatenate([x for _, x, _ in batch])
+        if mean is not None:
+            X = (X - mean) / std
+        return batch, np.asarray(X, dtype='float32')
+
+    batch = []
+    n = 0
+    if isinstance(fnames, FeaturesArchive):
+        utterances = archive_features(fnames, nframes)
+    else:
+        utterances = bounded_imap(pool, lambda f: read_features(f, nframes),
+                fnames, 2 * n_readers)
+    for utt in utterances:
+        batch.append(utt)
+        n += utt[1].shape[0]
+        if n >= batch_frames:
+            yield pack(batch)
+            batch = []
+            n = 0
+    if len(batch):
+        yield pack(batch)
+    pool.close()
+    pool.join()
+
+
+def split_outputs(transform, batch, X):
+    """ [[output of transform for each utterance of batch] for each output
+    of transform] """
+    embs = transform(X)
+    if type(embs) != list:
+        embs = [embs]
+    splits = np.cumsum([x.shape[0] for _, x, _ in batch[:-1]])
+    return [np.split(emb, splits) for emb in embs]
+
+
+def embeddings(transform, fnames, mean=None, std=None, nframes=1,
+        batch_frames=20000, n_readers=4, cmvn=None):
+    """ Yields (name, time, [outputs of transform]) for each of fnames. """
+    for batch, X in packed_batches(fnames, nframes, mean, std, batch_frames,
+            n_readers, cmvn):
+        outputs = split_outputs(transform, batch, X)
+        for k, (name, _, time) in enumerate(batch):
+            yield name, time, [out[k] for out in outputs]
+
+
+def embed_files(transform, fnames, h5_filenames, mean=None, std=None,
+        nframes=1, batch_frames=20000, n_readers=4, float16=False,
+        h5_groupname='/features/', archive=False, cmvn=None):
+    """ Embeds the features of fnames (or of a FeaturesArchive) with
+    transform (e.g. nnet.transform_x1()) and writes its outputs in
+    h5features files (one of h5_filenames per output), or in features
+    archives if archive.
+    mean and std are the (stacked) normalization vectors (or cmvn the per
+    speaker ones), nframes is only used for raw filterbanks. """
+    writers = None
+    for name, time, embs in embeddings(transform, fnames, mean, std, nframes,
+            batch_frames, n_readers, cmvn):
+        if writers is None and archive:
+            writers = [ArchiveWriter(fname, e.shape[1],
+                'float16' if float16 else 'float32')
+                for fname, e in zip(h5_filenames, embs)]
+        elif writers is None:
+            writers = [H5FeaturesWriter(h5_filename, h5_groupname,
+                e.shape[1], float16=float16)
+                for h5_filename, e in zip(h5_filenames, embs)]
+        for writer, e in zip(writers, embs):
+            if archive:
+                writer.write(name, e, fnames.speaker(name)
+                        if isinstance(fnames, FeaturesArchive) else '-')
+            else:
+                writer.write(name, time, e)
+    for writer in writers or []:
+        writer.close()
+
+
+def export_layers(transform, names, fnames, out_fname, mean=None, std=None,
+        nframes=1, batch_frames=20000, n_readers=4, chunk_frames=4096,
+        cmvn=None):
+    """ Writes all the outputs of transform (e.g.
+    nnet.transform_x1_all_layers()) for fnames in one pass, in the HDF5 file
+    out_fname with one chunked [frames, units] dataset per output (named
+    names), and 'files', 'index' ([offset, n_frames] in these datasets, per
+    file) and 'time' datasets. """
+    with h5py.File(out_fname, 'w') as f:
+        time = f.create_dataset('time', (0,), maxshape=(None,),
+                dtype='float64', chunks=(chunk_frames,))
+        datasets = None
+        files = []
+        index = []
+        n = 0
+        for batch, X in packed_batches(fnames, nframes, mean, std,
+                batch_frames, n_readers, cmvn):
+            outputs = split_outputs(transform, batch, X)
+            if datasets is None:
+                datasets = [f.create_dataset(name, (0, out[0].shape[1]),
+                    maxshape=(None, out[0].shape[1]), dtype='float32',
+                    chunks=(chunk_frames, out[0].shape[1]))
+                    for name, out in zip(names, outputs)]
+            m = n + X.shape[0]
+            for dataset, out in zip(datasets, outputs):
+                dataset.resize(m, axis=0)
+                dataset[n:m] = np.concatenate(out)
+            time.resize(m, axis=0)
+            time[n:m] = np.concatenate([t for _, _, t in batch])
+            for name, x, _ in batch:
+                files.append(name)
+                index.append((n, x.shape[0]))
+                n += x.shape[0]
+        f.create_dataset('files', data=np.array(files))
+        f.create_dataset('index', data=np.array(index, dtype='int64'))
+
+
+def load_nnet(nnet_fname, mean_std_fname):
+    """ (nnet, nframes, stacked mean, stacked std) """
+    with open(nnet_fname, 'rb') as f:
+        nnet = cPickle.load(f)
+    nframes = nnet.layers_ins[0] / NFEATURES
+    tmp = np.load(mean_std_fname)
+    return (nnet, nframes, np.tile(tmp['mean'], nframes),
+            np.tile(tmp['std'], nframes))
+
+
+def list_features(in_fldr):
+    """ The *.npz (or else *.npy) files of in_fldr, or the FeaturesArchive
+    in_fldr. """
+    if archive_exists(in_fldr):
+        return FeaturesArchive(in_fldr)
+    fnames = sorted(glob.glob(os.path.join(in_fldr, "*.npz")))
+    if not len(fnames):
+        fnames = sorted(glob.glob(os.path.join(in_fldr, "*.npy")))
+    return fnames
+
+
+def layers_names(nnet):
+    """ Names of the outputs of nnet.transform_x1_all_layers(). """
+    if isinstance(nnet, ABNeuralNet2Outputs):
+        return ['layer_' + str(i) for i in xrange(nnet.n_layers - 1)] + [
+                'words', 'spkrs']
+    return ['layer_' + str(i) for i in xrange(nnet.n_layers)]
+
+
+def embed_folder(nnet_fname, mean_std_fname, in_fldr, h5_filenames,
+        n_readers=4, float16=False, archive=False, cmvn=None):
+    """ Embeds all the *.npz (or else *.npy) files of in_fldr (or the
+    features archive in_fldr) with the transform_x1 of the pickled nnet. """
+    nnet, nframes, mean, std = load_nnet(nnet_fname, mean_std_fname)
+    embed_files(nnet.transform_x1(), list_features(in_fldr), h5_filenames,
+            mean=mean, std=std, nframes=nframes, n_readers=n_readers,
+            float16=float16, archive=archive, cmvn=cmvn)
+
+
+def export_folder(nnet_fname, mean_std_fname, in_fldr, out_fname,
+        n_readers=4, cmvn=None):
+    """ Exports the outputs of all the layers of the pickled nnet for all
+    the *.npz (or else *.npy) files of in_fldr (see export_layers). """
+    nnet, nframes, mean, std = load_nnet(nnet_fname, mean_std_fname)
+    export_layers(nnet.transform_x1_all_layers(), layers_names(nnet),
+            list_features(in_fldr), out_fname, mean=mean, std=std,
+            nframes=nframes, n_readers=n_readers, cmvn=cmvn)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('nnet', help='pickled trained nnet')
+    parser.add_argument('mean_std', help='npz with the mean and std used '
+            'for training (e.g. mean_std_spkr_word.npz)')
+    parser.add_argument('in_folder', help='folder of *.npz stacked features '
+            '(or *.npy filterbanks), or features archive')
+    parser.add_argument('h5_filenames', nargs='+', help='output h5features '
+            'files, one per output of the nnet (words [speakers]), or with '
+            '--all-layers the output HDF5 file')
+    parser.add_argument('--readers', type=int, default=4,
+            help='number of reader threads')
+    parser.add_argument('--all-layers', action='store_true',
+            help='export the outputs of all the layers in one file')
+    parser.add_argument('--float16', action='store_true',
+            help='write the embeddings as float16 in the h5features files')
+    parser.add_argument('--archive', action='store_true',
+            help='write the embeddings in features archives')
+    parser.add_argument('--cmvn', default=None, help='per speaker '
+            'normalization statistics (fbanks_cmvn.npz of the extraction)')
+    args = parser.parse_args()
+    cmvn = None
+    if args.cmvn is not None:
+        cmvn = CMVN(args.cmvn)
+    if args.all_layers:
+        export_folder(args.nnet, args.mean_std, args.in_folder,
+                args.h5_filenames[0], n_readers=args.readers, cmvn=cmvn)
+    else:
+        embed_folder(args.nnet, args.mean_std, args.in_folder,
+                args.h5_filenames, n_readers=args.readers,
+                float16=args.float16, archive=args.archive, cmvn=cmvn)
@@ -5,7 +5,7 @@ License: WTFPL http://www.wtfpl.net
 Copyright: Gabriel Synnaeve 2013
 """
 
-import os, shutil, sys
+import os, shutil, sys, hashlib
 import numpy as np
 from subprocess import call
 try:
@@ -19,28 +19,41 @@ except ImportError:
     print >> sys.stderr, "ERROR: You don't have scipy"
     sys.exit(-1)
 from scipy.io import wavfile
+from mel_fbanks import MelFbanks, GammatoneFbanks
+from read_audio import read_audio
+from feature_manifest import Manifest, MANIFEST_NAME, atomic_write, atomic_save
+from cmvn import CMVNStats, CMVN_NAME
+from features_archive import utterance_speaker
 
 
 USAGE = """
 Usage:
     python mfcc_and_gammatones.py [$folder_path] [--debug] [--htk_mfcc] 
-        [--gammatones] [--spectrograms] [--filterbanks] [--stereo] [--no-sox]
+        [--gammatones] [--spectrograms] [--filterbanks] [--stereo] [--sox]
+        [--speaker-prefix=N]
 
 You may need:
     - HCopy from HTK
     - wav_config (for HCopy, 25ms window, 10ms slide, 12 coefficiens, and 
         MFCC_0_D_A means we want the energy (0), first derivative (D) 
         and second derivative (A, acceleration).
-    - Brian hears http://www.briansimulator.org/docs/hears.html
     - this python file
 
-For all file.wav wav files in the dataset, what this script does is eqvlt to:
-    - mv file.wav file.rawaudio (because the wav in TIMIT is w/o headers)
-    - sox file.rawaudio file.wav (to reconstruct the headers)
+The RIFF WAVE and NIST SPHERE (TIMIT) files are read directly (see
+read_audio.py). For all file.wav wav files in the dataset, what this script
+does is eqvlt to:
+    - with --sox (only needed by HCopy on TIMIT):
+      mv file.wav file.rawaudio (because the wav in TIMIT is w/o headers)
+      sox file.rawaudio file.wav (to reconstruct the headers)
     - HCopy -A -D -T 1 -C wav_config file.wav file.mfc_unnorm
-    - outputing the gammatones in file_gamma.npy
+    - outputing the log energies of gammatone filters (ERB spaced, on the
+      frames of the filterbanks, see mel_fbanks.py) in file_gamma.npy
     - outputing the spectrograms in file_specgram.npy
     - outputing the log filterbanks in file_fbanks.npy
+With --filterbanks, the per speaker (the folders of the wav files, or with
+--speaker-prefix=N the first N characters of their names, e.g. 3 for
+Buckeye) mean and variance of the filterbanks are accumulated in
+$folder_path/fbanks_cmvn.npz (see cmvn.py).
 """
 
 SPECGRAM_WINDOW = 0.020 # 20ms
@@ -48,17 +61,8 @@ SPECGRAM_OVERLAP = 0.010 # 10ms
 FBANKS_WINDOW = 0.025 # 25ms
 FBANKS_RATE = 100 # 10ms
 N_FBANKS = 40
-N_GAMMATONES_FILTERS = 1000
-
-
-import wave, struct
-def readwav(fname):
-    fid = wave.open(fname, 'r')
-    _, _, fs, nframes, _, _ = fid.getparams()
-    sig = np.array(struct.unpack_from("%dh" % nframes,
-    fid.readframes(nframes)))
-    fid.close()
-    return sig, fs
+N_GAMMATONES_FILTERS = 50
+SAVE_MANIFEST_EVERY = 100  # files
 
 
 def process(folder,
@@ -69,7 +73,8 @@ def process(folder,
         gammatones=False,
         spectrograms=False,
         filterbanks=False,
-        sox=True):
+        sox=False,
+        speaker_prefix=None):
     """ applies to all *.wav in folder """
 
     # first find if we produce normalized MFCC, otherwise note it in the ext
@@ -84,91 +89,120 @@ def process(folder,
     if forcemfcext:
         mfc_extension = '.mfc'
     print "MFC extension:", mfc_extension
-    if gammatones:
-        try:
-            from brian import Hz, kHz
-            from brian.hears import loadsound, erbspace, Gammatone
-        except ImportError:
-            print >> sys.stderr, "You need Brian Hears"
-            print >> sys.stderr, "http://www.briansimulator.org/docs/\
-                    hears.html"
-            sys.exit(-1)
     if spectrograms:
         try:
             from pylab import specgram
         except ImportError:
             print >> sys.stderr, "You need Pylab"
             sys.exit(-1)
-    fbanks = None
+
+    # the parameters of each kind of features (by suffix of the file name),
+    # only the files that are not in the manifest with these are extracted
+    params = {}
+    if htk_mfc:
+        with open('wav_config') as f:
+            params[mfc_extension] = {'features': 'htk_mfc',
+                    'config_md5': hashlib.md5(f.read()).hexdigest()}
+    if gammatones:
+        params['_gamma.npy'] = {'features': 'gammatones',
+                'n_filters': N_GAMMATONES_FILTERS, 'lowerf': 50,
+                'frate': FBANKS_RATE, 'wlen': FBANKS_WINDOW, 'nfft': 1024,
+                'stereo': stereo_wav, 'normalize': 'max'}
+    if spectrograms:
+        params['_specgram.npy'] = {'features': 'specgram',
+                'window': SPECGRAM_WINDOW, 'overlap': SPECGRAM_OVERLAP,
+                'stereo': stereo_wav}
     if filterbanks:
-        try:
-            sys.path.append('../spectral')
-            from spectral import Spectral
-        except ImportError:
-            print >> sys.stderr, "You need spectral (in the parent folder)"
-            print >> sys.stderr, "https://github.com/mwv/spectral"
-            sys.exit(-1)
+        params['_fbanks.npy'] = {'features': 'fbanks', 'nfilt': N_FBANKS,
+                'alpha': 0.97, 'frate': FBANKS_RATE, 'wlen': FBANKS_WINDOW,
+                'nfft': 1024, 'stereo': stereo_wav}
+    manifest = Manifest(os.path.join(folder, MANIFEST_NAME))
+    cmvn_stats = CMVNStats(os.path.join(folder, CMVN_NAME))
+    n_done = 0
 
     # run through all the folders and files in the path "folder"
     # and put a header to the waves, save the originals as .rawaudio
     # use HCopy to produce MFCC files according to "wav_config" file
-    for bdir, _, files in os.walk(folder):
-        for fname in files:
-            if fname[-4:] != '.wav':
-                continue
-            rawfname = bdir+'/'+fname[:-4]+'.rawaudio'
-            wavfname = bdir+'/'+fname
-            tempfname = bdir+'/'+fname[:-4]+'_temp.wav'
-            # temp fname with .wav for sox
-            mfccfname = bdir+'/'+fname[:-4]+mfc_extension
-            if sox:
-                shutil.move(wavfname, tempfname)
-                call(['sox', tempfname, wavfname])
-                #call(['sox', '-G', tempfname, '-r 16k', wavfname])
-                # w/o headers, sox uses extension
-                shutil.move(tempfname, rawfname)
-            if htk_mfc:
-                call(['HCopy', '-C', 'wav_config', wavfname, mfccfname])
-            srate = 16000
-            #srate, sound = wavfile.read(wavfname)
-            sound, srate = readwav(wavfname)
-            if stereo_wav and len(sound.shape) == 2: # in mono sound is a list
-                sound = sound[:, 0] + sound[:, 1]
-                # for stereo wav, sum both channels
-            if gammatones:
-                gammatonefname = bdir+'/'+fname[:-4]+'_gamma.npy'
-                tmp_snd = loadsound(wavfname)
-                gamma_cf = erbspace(20*Hz, 20*kHz, N_GAMMATONES_FILTERS)
-                gamma_fb = Gammatone(tmp_snd, gamma_cf)
-                with open(gammatonefname, 'w') as o_f:
-                    npsave(o_f, gamma_fb.process())
-            if spectrograms:
-                powerspec, _, _, _ = specgram(sound, NFFT=int(srate
-                    * SPECGRAM_WINDOW), Fs=srate, noverlap=int(srate
-                        * SPECGRAM_OVERLAP)) # TODO
-                specgramfname = bdir+'/'+fname[:-4]+'_specgram.npy'
-                with open(specgramfname, 'w') as o_f:
-                    npsave(o_f, powerspec.T)
-            if filterbanks:
-                # convert to Mel filterbanks
-                fbanks = Spectral(nfilt=N_FBANKS,      # nb of filters in mel bank
-                             alpha=0.97,               # pre-emphasis
-                             do_dct=False,             # we do not want MFCCs
-                             compression='log',
-                             fs=srate,                 # sampling rate
-                             #lowerf=50,                # lower frequency
-                             frate=FBANKS_RATE,        # frame rate
-                             wlen=FBANKS_WINDOW,       # window length
-                             nfft=1024,                # length of dft
-                             do_deltas=False,          # speed
-                             do_deltasdeltas=False     # acceleration
-                             )
-                fbank = fbanks.transform(sound)
-                fbanksfname = bdir+'/'+fname[:-4]+'_fbanks.npy'
-                with open(fbanksfname, 'w') as o_f:
-                    npsave(o_f, fbank)
-            # TODO wavelets scattergrams / scalograms
-            print "dealt with file", wavfname
+    try:
+        for bdir, _, files in os.walk(folder):
+            for fname in files:
+                if fname[-4:] != '.wav':
+                    continue
+                rawfname = bdir+'/'+fname[:-4]+'.rawaudio'
+                wavfname = bdir+'/'+fname
+                tempfname = bdir+'/'+fname[:-4]+'_temp.wav'
+                # temp fname with .wav for sox
+                mfccfname = bdir+'/'+fname[:-4]+mfc_extension
+                if sox and not os.path.exists(rawfname):  # not already done
+                    shutil.move(wavfname, tempfname)
+                    call(['sox', tempfname, wavfname])
+                    #call(['sox', '-G', tempfname, '-r 16k', wavfname])
+                    # w/o headers, sox uses extension
+                    shutil.move(tempfname, rawfname)
+                todo = [suffix for suffix, p in params.iteritems()
+                        if manifest.outdated(wavfname,
+                            bdir+'/'+fname[:-4]+suffix, p)]
+                fbanksfname = os.path.abspath(bdir+'/'+fname[:-4]+'_fbanks.npy')
+                speaker = utterance_speaker(fbanksfname, speaker_prefix)
+                if (filterbanks and '_fbanks.npy' not in todo and
+                        fbanksfname not in cmvn_stats):
+                    # extracted before the statistics were kept
+                    cmvn_stats.add(fbanksfname, speaker, np.load(fbanksfname))
+                if not len(todo):
+                    continue
+                if mfc_extension in todo:
+                    atomic_write(mfccfname, lambda tmp: call(['HCopy', '-C',
+                        'wav_config', wavfname, tmp]))
+                srate = 16000
+                #srate, sound = wavfile.read(wavfname)
+                sound, srate = read_audio(wavfname)
+                if stereo_wav and len(sound.shape) == 2: # in mono sound is a list
+                    sound = sound[:, 0] + sound[:, 1].astype('float64')
+                    # for stereo wav, sum both channels
+                if '_gamma.npy' in todo:
+                    gammatonefname = bdir+'/'+fname[:-4]+'_gamma.npy'
+                    gamma_fb = GammatoneFbanks(nfilt=N_GAMMATONES_FILTERS,
+                                 fs=srate,
+                                 lowerf=50,
+                                 frate=FBANKS_RATE,
+                                 wlen=FBANKS_WINDOW,
+                                 nfft=1024
+                                 )
+                    # max normalized, as in parallel_extract_features.py
+                    atomic_save(gammatonefname, gamma_fb.transform(
+                        sound / float(np.abs(sound).max())))
+                if '_specgram.npy' in todo:
+                    powerspec, _, _, _ = specgram(sound, NFFT=int(srate
+                        * SPECGRAM_WINDOW), Fs=srate, noverlap=int(srate
+                            * SPECGRAM_OVERLAP)) # TODO
+                    specgramfname = bdir+'/'+fname[:-4]+'_specgram.npy'
+                    atomic_save(specgramfname, powerspec.T)
+                if '_fbanks.npy' in todo:
+                    # convert to Mel filterbanks
+                    fbanks = MelFbanks(nfilt=N_FBANKS,     # nb of filters in mel bank
+                                 alpha=0.97,               # pre-emphasis
+                                 fs=srate,                 # sampling rate
+                                 #lowerf=50,                # lower frequency
+                                 frate=FBANKS_RATE,        # frame rate
+                                 wlen=FBANKS_WINDOW,       # window length
+                                 nfft=1024                 # length of dft
+                                 )
+                    fbank = fbanks.transform(sound)
+                    atomic_save(fbanksfname, fbank)
+                    cmvn_stats.add(fbanksfname, speaker, fbank)
+                # TODO wavelets scattergrams / scalograms
+                for suffix in todo:
+                    manifest.record(wavfname, bdir+'/'+fname[:-4]+suffix,
+                            params[suffix])
+                n_done += 1
+                if n_done % SAVE_MANIFEST_EVERY == 0:
+                    manifest.save()
+                    cmvn_stats.save()
+                print "dealt with file", wavfname
+    finally:
+        manifest.save()
+        cmvn_stats.save()
+    print "extracted the features of", n_done, "files"
 
 
 if __name__ == '__main__':
@@ -183,7 +217,7 @@ if __name__ == '__main__':
         dogammatones = False
         dospectrograms = False
         dofilterbanks = False
-        dosox = True
+        dosox = False
         if '--debug' in sys.argv:
             printdebug = True
         if '--forcemfcext' in sys.argv:
@@ -198,13 +232,18 @@ if __name__ == '__main__':
             dospectrograms = True
         if '--filterbanks' in sys.argv:
             dofilterbanks = True
-        if '--no-sox' in sys.argv:
-            dosox = False
+        if '--sox' in sys.argv:
+            dosox = True
+        speaker_prefix = None
+        for arg in sys.argv:
+            if arg.startswith('--speaker-prefix='):
+                speaker_prefix = int(arg.split('=')[1])
         l = filter(lambda x: not '--' in x[0:2], sys.argv)
         foldername = '.'
         if len(l) > 1:
             foldername = l[1]
         process(foldername, printdebug, dohtk_mfcc, doforcemfcext, isstereo,
-                dogammatones, dospectrograms, dofilterbanks, dosox)
+                dogammatones, dospectrograms, dofilterbanks, dosox,
+                speaker_prefix)
     else:
         process('.') # default
@@ -0,0 +1,76 @@
+"""
+Incremental features extraction.
+
+A manifest (a JSON file) records, for each features file, the input file it
+was made from (path, size and mtime) and the parameters of the extraction,
+so that re-running an extraction only processes the new or changed inputs
+(or the ones that were extracted with other parameters). The features files
+and the manifest are written atomically (to a temporary file in the same
+folder, then renamed), so that an interrupted extraction never leaves
+truncated files behind:
+
+    manifest = Manifest(os.path.join(folder, MANIFEST_NAME))
+    if manifest.outdated(wavfname, fbanksfname, params):
+        atomic_save(fbanksfname, fbanks)
+        manifest.record(wavfname, fbanksfname, params)
+    manifest.save()
+"""
+
+import os, json
+import numpy as np
+
+MANIFEST_NAME = '.features_manifest.json'
+
+
+def atomic_write(fname, write):
+    """ Calls write(tmp_fname), then renames tmp_fname to fname. """
+    folder, name = os.path.split(os.path.abspath(fname))
+    tmp = os.path.join(folder, '.' + name + '.tmp' + str(os.getpid()))
+    try:
+        write(tmp)
+        os.rename(tmp, fname)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def atomic_save(fname, array):
+    """ numpy.save(fname, array), atomically. """
+    def write(tmp):
+        with open(tmp, 'wb') as f:
+            np.save(f, array)
+    atomic_write(fname, write)
+
+
+class Manifest(object):
+    """ {features file: {'input', 'size', 'mtime', 'params'}} stored in
+    the JSON file fname. The paths are absolute. """
+    def __init__(self, fname):
+        self.fname = fname
+        self.entries = {}
+        if os.path.exists(fname):
+            with open(fname) as f:
+                self.entries = json.load(f)
+
+    def entry(self, input_fname, params):
+        st = os.stat(input_fname)
+        return {'input': os.path.abspath(input_fname), 'size': st.st_size,
+                'mtime': st.st_mtime, 'params': params}
+
+    def outdated(self, input_fname, output_fname, params):
+        """ Whether output_fname has to be (re)made from input_fname. """
+        output_fname = os.path.abspath(output_fname)
+        return (not os.path.exists(output_fname) or
+                self.entries.get(output_fname) !=
+                self.entry(input_fname, params))
+
+    def record(self, input_fname, output_fname, params):
+        self.entries[os.path.abspath(output_fname)] = self.entry(input_fname,
+                params)
+
+    def save(self):
+        def write(tmp):
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+        atomic_write(self.fname, write)
@@ -0,0 +1,214 @@
+"""
+One archive of features per corpus split, instead of thousands of small
+*_fbanks.npy (or stacked *.npz) files: ARCHIVE.npy is the [frames, dim]
+float32 (or float16) matrix of the features of all the utterances, one
+after the other, and ARCHIVE.index is a text file with a line
+'name offset n_frames speaker' per utterance. The matrix is memory-mapped,
+so that the features of an utterance are a view of it (no file to open,
+contiguous reads):
+
+    python features_archive.py timit_train_fbanks TIMIT/train [--float16]
+
+archives all the *_fbanks.npy of TIMIT/train (the speakers being their
+folders and the names speaker_utterance, e.g. 'fcjf0_sa1', as in the npz7_*
+folders, whose flat speaker_utterance files keep their names), or with
+--speaker-prefix=3 the *.npy of the Buckeye folders (the names being the
+files names and the speakers their first 3 characters):
+
+    archive = FeaturesArchive('timit_train_fbanks')
+    fbanks = archive['fcjf0_sa1']
+    speaker = archive.speaker('fcjf0_sa1')
+    for name, speaker, fbanks in archive.utterances():
+        ...
+"""
+
+import os, sys
+import numpy as np
+from feature_manifest import atomic_write
+
+HEADER_LEN = 128  # of the .npy, rewritten with the final shape on close
+
+
+def archive_exists(fname):
+    return os.path.exists(fname + '.index') and os.path.exists(fname + '.npy')
+
+
+def npy_header(shape, dtype):
+    """ .npy (version 1.0) header of HEADER_LEN bytes. """
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+            np.dtype(dtype).descr[0][1], tuple(shape))
+    header = header.ljust(HEADER_LEN - 10 - 1) + '\n'
+    assert len(header) == HEADER_LEN - 10, "shape too long for the header"
+    return '\x93NUMPY\x01\x00' + np.array(len(header), '<u2').tostring() + \
+            header
+
+
+class ArchiveWriter(object):
+    """ Writes the features of utterances (as they come) in the archive
+    fname (fname.npy and fname.index, renamed on close). """
+    def __init__(self, fname, dim, dtype='float32'):
+        self.fname = fname
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.index = []  # [(name, offset, n_frames, speaker)]
+        self.n = 0
+        self._tmp = fname + '.npy.tmp' + str(os.getpid())
+        self._f = open(self._tmp, 'wb')
+        self._f.write(npy_header((0, dim), self.dtype))
+
+    def write(self, name, features, speaker):
+        features = np.asarray(features, dtype=self.dtype)
+        if features.ndim != 2 or features.shape[1] != self.dim:
+            raise ValueError("features of %s are not [n_frames, %d]" %
+                    (name, self.dim))
+        self._f.write(np.ascontiguousarray(features).tostring())
+        self.index.append((name, self.n, features.shape[0], speaker))
+        self.n += features.shape[0]
+
+    def close(self):
+        self._f.seek(0)
+        self._f.write(npy_header((self.n, self.dim), self.dtype))
+        self._f.close()
+        os.rename(self._tmp, self.fname + '.npy')
+
+        def write(tmp):
+            with open(tmp, 'w') as f:
+                for name, offset, n, speaker in self.index:
+                    f.write("%s %d %d %s\n" % (name, offset, n, speaker))
+        atomic_write(self.fname + '.index', write)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._f.close()
+            os.remove(self._tmp)
+
+
+class FeaturesArchive(object):
+    """ Reads the archive fname: archive[name] is the [n_frames, dim]
+    features of the utterance name (a view of the memory-mapped matrix). """
+    def __init__(self, fname):
+        self.fname = fname
+        self.features = np.load(fname + '.npy', mmap_mode='r')
+        self.names = []
+        self.index = {}  # {name: (offset, n_frames, speaker)}
+        with open(fname + '.index') as f:
+            for line in f:
+                name, offset, n, speaker = line.split()
+                self.names.append(name)
+                self.index[name] = (int(offset), int(n), speaker)
+
+    @property
+    def dim(self):
+        return self.features.shape[1]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        offset, n, _ = self.index[name]
+        return np.asarray(self.features[offset:offset + n])
+
+    def speaker(self, name):
+        return self.index[name][2]
+
+    def speakers(self):
+        return sorted(set(s for _, _, s in self.index.itervalues()))
+
+    def utterances(self, names=None):
+        """ Yields (name, speaker, features) for names (default: all of
+        them, in the order of the matrix). """
+        for name in (self.names if names is None else names):
+            yield name, self.speaker(name), self[name]
+
+
+def utterance_name(fname):
+    """ 'fcjf0_sa1' for '.../fcjf0/sa1_fbanks.npy' (the npz7_* names). """
+    fname = os.path.splitext(fname)[0]
+    if fname.endswith('_fbanks'):
+        fname = fname[:-len('_fbanks')]
+    return "_".join(fname.split('/')[-2:])
+
+
+def features_name(fname, speaker_prefix=None):
+    """ Name of the utterance of the features file fname in an archive:
+    utterance_name for the *_fbanks.npy of the extraction, or else the name
+    of the file (e.g. 'fcjf0_sa1' for 'npz7_train/fcjf0_sa1.npz'). """
+    name = os.path.basename(fname).split('.')[0]
+    if speaker_prefix is None and name.endswith('_fbanks'):
+        return utterance_name(fname)
+    return name
+
+
+def utterance_speaker(fname, speaker_prefix=None):
+    """ Speaker of the features (e.g. '.../fcjf0/sa1_fbanks.npy') file
+    fname: the first speaker_prefix characters of its name (e.g. 's01' for
+    Buckeye's 's0101a.npy'), or else its folder for the *_fbanks.npy of the
+    extraction, or the start of the speaker_utterance names of flat folders
+    (e.g. 'fcjf0' for 'npz7_train/fcjf0_sa1.npz'). """
+    name = os.path.basename(fname).split('.')[0]
+    if speaker_prefix is not None:
+        return name[:speaker_prefix]
+    if name.endswith('_fbanks'):
+        return os.path.basename(os.path.dirname(os.path.abspath(fname)))
+    return name.split('_')[0]
+
+
+def find_features(folders, suffix='_fbanks.npy'):
+    """ Sorted features files (ending with suffix) in folders. """
+    fnames = []
+    for folder in folders:
+        for d, _, fs in os.walk(folder):
+            fnames.extend(os.path.join(d, f) for f in fs if f.endswith(suffix))
+    return sorted(fnames)
+
+
+def archive_files(fname, fnames, dtype='float32', speaker_prefix=None):
+    """ Archives the features files fnames (*.npy, or stacked *.npz) in
+    fname, with the names of features_name and the speakers of
+    utterance_speaker. """
+    writer = None
+    for f in fnames:
+        features = np.load(f)
+        if f.endswith('.npz'):
+            features = features['features']
+        if writer is None:
+            writer = ArchiveWriter(fname, features.shape[1], dtype)
+        writer.write(features_name(f, speaker_prefix), features,
+                utterance_speaker(f, speaker_prefix))
+    if writer is not None:
+        writer.close()
+    return writer
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('archive', help='output archive (ARCHIVE.npy and '
+            'ARCHIVE.index)')
+    parser.add_argument('folders', nargs='+', help='folders of features')
+    parser.add_argument('--suffix', default='_fbanks.npy',
+            help='suffix of the features files (e.g. .npy or .npz)')
+    parser.add_argument('--speaker-prefix', type=int, default=None,
+            help='the speakers are the first N characters of the files '
+            'names (default: the folders of the *_fbanks.npy, or else the '
+            'start of the speaker_utterance names)')
+    parser.add_argument('--float16', action='store_true',
+            help='store the features as float16')
+    args = parser.parse_args()
+    fnames = find_features(args.folders, args.suffix)
+    writer = archive_files(args.archive, fnames,
+            'float16' if args.float16 else 'float32', args.speaker_prefix)
+    if writer is None:
+        print >> sys.stderr, "no *" + args.suffix, "in", " ".join(args.folders)
+        sys.exit(1)
+    print >> sys.stderr, "archived", len(writer.index), "utterances,",
+    print >> sys.stderr, writer.n, "frames"
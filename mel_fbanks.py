@@ -0,0 +1,252 @@
+"""
+Log Mel filterbanks, vectorized over the frames of (many) utterances.
+
+Computes the same features as the spectral.Spectral(do_dct=False,
+compression='log', do_deltas=False, do_deltasdeltas=False) that was used to
+make the *_fbanks.npy (https://github.com/mwv/spectral): same framing (the
+last frames being filled by repeating the end of the signal), same
+pre-emphasis (whose prior sample is the last one of the previous frame),
+Hamming window, power spectrum and triangular Mel filters, but the frames
+are strided views of the signal, pre-emphasized and windowed by blocks, and
+the rfft and the Mel filters (one matrix product) are applied on blocks of
+block_frames frames of several utterances at once:
+
+    fbanks = MelFbanks(nfilt=40, alpha=0.97, fs=16000, frate=100,
+            wlen=0.025, nfft=1024, lowerf=50)
+    fb = fbanks.transform(sound)
+    fbs = fbanks.transform_many([sound1, sound2, sound3])
+
+OnlineFbanks computes them on a signal given by chunks (e.g. live audio),
+with a latency of one window.
+
+GammatoneFbanks gives, on the same frames (the same 10ms grid), the log
+energies of gammatone-like filters spaced on the ERB-rate scale: the power
+responses of the gammatone filters are weights on the power spectrum of the
+frames (as the Mel filters are), instead of time domain filters (as
+brian.hears.Gammatone) at the sampling rate.
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+LOG_FLOOR = 1.E-5
+
+
+def mel(f):
+    return 2595. * np.log10(1. + f / 700.)
+
+
+def melinv(m):
+    return 700. * (np.power(10., m / 2595.) - 1.)
+
+
+def mel_filters(nfilt, nfft, fs, lowerf, upperf):
+    """ [nfft/2+1, nfilt] matrix of the triangular Mel filters. """
+    if upperf > fs / 2.:
+        raise ValueError("upper frequency %f exceeds Nyquist %f" %
+                (upperf, fs / 2.))
+    filters = np.zeros((nfft / 2 + 1, nfilt))
+    dfreq = float(fs) / nfft
+    melmax = mel(upperf)
+    melmin = mel(lowerf)
+    dmelbw = (melmax - melmin) / (nfilt + 1)
+    # filters edges, in Hz
+    filt_edge = melinv(melmin + dmelbw * np.arange(nfilt + 2, dtype='d'))
+    for k in xrange(nfilt):
+        # filters triangles, in DFT points
+        leftfr = int(round(filt_edge[k] / dfreq))
+        centerfr = int(round(filt_edge[k + 1] / dfreq))
+        rightfr = int(round(filt_edge[k + 2] / dfreq))
+        height = 2. / ((rightfr - leftfr) * dfreq)
+        if centerfr != leftfr:
+            freqs = np.arange(leftfr + 1, centerfr)
+            filters[freqs, k] = (freqs - leftfr) * height / (centerfr - leftfr)
+        filters[centerfr, k] = height
+        if centerfr != rightfr:
+            freqs = np.arange(centerfr + 1, rightfr)
+            filters[freqs, k] = (freqs - rightfr) * height / (centerfr
+                    - rightfr)
+    return filters
+
+
+def erb(f):
+    """ Equivalent rectangular bandwidth (Glasberg & Moore) at f Hz. """
+    return 24.7 * (4.37 * f / 1000. + 1.)
+
+
+def erbspace(lowf, highf, n):
+    """ n frequencies evenly spaced on the ERB-rate scale. """
+    erb_rate = lambda f: 21.4 * np.log10(4.37 * f / 1000. + 1.)
+    return (np.power(10., np.linspace(erb_rate(lowf), erb_rate(highf), n)
+        / 21.4) - 1.) * 1000. / 4.37
+
+
+def gammatone_filters(nfilt, nfft, fs, lowerf, upperf, order=4):
+    """ [nfft/2+1, nfilt] matrix of the power responses (of unit peak) of
+    order order gammatone filters, with ERB spaced center frequencies. """
+    if upperf > fs / 2.:
+        raise ValueError("upper frequency %f exceeds Nyquist %f" %
+                (upperf, fs / 2.))
+    freqs = np.arange(nfft / 2 + 1) * float(fs) / nfft
+    cf = erbspace(lowerf, upperf, nfilt)
+    bandwidth = 1.019 * erb(cf)
+    return np.power(1. + ((freqs[:, None] - cf) / bandwidth) ** 2, -order)
+
+
+class MelFbanks(object):
+    """ Log Mel filterbanks of signals sampled at fs, with frate frames per
+    second of wlen seconds. """
+    def __init__(self, nfilt=40, alpha=0.97, fs=16000, frate=100, wlen=0.025,
+            nfft=1024, lowerf=133.3333, upperf=6855.4976, block_frames=4096):
+        self.nfilt = nfilt
+        self.alpha = alpha
+        self.fs = fs
+        self.nfft = nfft
+        self.fshift = float(fs) / frate
+        self.wlen = int(wlen * fs)
+        self.win = np.hamming(self.wlen)
+        self.filters = mel_filters(nfilt, nfft, fs, lowerf, upperf)
+        self.block_frames = block_frames
+
+    def n_frames(self, n_samples):
+        return int(n_samples / self.fshift + 1)
+
+    def _emphasize(self, frames, prior):
+        """ Pre-emphasized and windowed copy of frames, prior being the
+        last sample of the frame before the first one. """
+        ret = np.empty(frames.shape)
+        ret[:, 1:] = frames[:, 1:] - self.alpha * frames[:, :-1]
+        ret[:, 0] = frames[:, 0] - self.alpha * np.r_[prior, frames[:-1, -1]]
+        ret *= self.win
+        return ret
+
+    def _blocks(self, sig):
+        """ Yields the pre-emphasized and windowed frames of sig, by blocks
+        of at most block_frames frames. """
+        sig = np.asarray(sig, dtype='float64')
+        n = sig.shape[0]
+        starts = np.floor(np.arange(self.n_frames(n)) * self.fshift + 0.5
+                ).astype('int64')
+        n_full = int(np.sum(starts + self.wlen <= n))
+        if self.fshift == int(self.fshift):
+            full = as_strided(sig, shape=(n_full, self.wlen),
+                    strides=(int(self.fshift) * sig.strides[0],
+                        sig.strides[0]))
+        else:
+            full = sig[starts[:n_full, None] + np.arange(self.wlen)]
+        prior = 0.
+        for a in xrange(0, n_full, self.block_frames):
+            frames = full[a:a + self.block_frames]
+            yield self._emphasize(frames, prior)
+            prior = frames[-1, -1]
+        if n_full < len(starts):
+            # the last frames are filled by repeating what is left
+            yield self._emphasize(np.array([np.resize(sig[s:], self.wlen)
+                for s in starts[n_full:]]), prior)
+
+    def _logspec(self, frames):
+        fft = np.fft.rfft(frames, self.nfft, axis=1)
+        power = fft.real * fft.real + fft.imag * fft.imag
+        return np.log(np.dot(power, self.filters).clip(LOG_FLOOR, np.inf))
+
+    def transform_many(self, sigs):
+        """ [[n_frames, nfilt] log Mel filterbanks of each of sigs]. """
+        outputs = []
+        pending = []  # [(utterance, frames)]
+        n = 0
+        for i, sig in enumerate(sigs):
+            outputs.append([])
+            for frames in self._blocks(sig):
+                pending.append((i, frames))
+                n += frames.shape[0]
+                if n >= self.block_frames:
+                    self._flush(pending, outputs)
+                    pending = []
+                    n = 0
+        self._flush(pending, outputs)
+        return [np.concatenate(o) for o in outputs]
+
+    def _flush(self, pending, outputs):
+        if not len(pending):
+            return
+        logspec = self._logspec(np.concatenate([f for _, f in pending]))
+        splits = np.cumsum([f.shape[0] for _, f in pending[:-1]])
+        for (i, _), l in zip(pending, np.split(logspec, splits)):
+            outputs[i].append(l)
+
+    def transform(self, sig):
+        """ [n_frames, nfilt] log Mel filterbanks of sig. """
+        return self.transform_many([sig])[0]
+
+
+class OnlineFbanks(object):
+    """ Log Mel filterbanks (of a MelFbanks) of a signal given by chunks:
+    feed(samples) returns the frames whose window is complete, and finish()
+    the last ones (filled as MelFbanks.transform does), so that their
+    concatenation is the MelFbanks.transform of the whole signal. Only the
+    samples of the next window are kept between the calls. """
+    def __init__(self, fbanks):
+        self.fbanks = fbanks
+        self.reset()
+
+    def reset(self):
+        self._buffer = np.zeros(0)
+        self._offset = 0  # index of the first sample of the buffer
+        self._frame = 0  # next frame
+        self._prior = 0.
+
+    def _starts(self, first, last):
+        return np.floor(np.arange(first, last) * self.fbanks.fshift + 0.5
+                ).astype('int64')
+
+    def _logspec(self, frames):
+        ret = self.fbanks._logspec(self.fbanks._emphasize(frames,
+            self._prior))
+        self._prior = frames[-1, -1]
+        return ret
+
+    def feed(self, samples):
+        """ [n_frames, nfilt] log Mel filterbanks of the new frames. """
+        self._buffer = np.r_[self._buffer, np.asarray(samples,
+            dtype='float64')]
+        n = self._offset + self._buffer.shape[0]
+        wlen = self.fbanks.wlen
+        starts = self._starts(self._frame,
+                max(self._frame, int((n - wlen) / self.fbanks.fshift) + 2))
+        starts = starts[starts + wlen <= n]
+        if not len(starts):
+            return np.zeros((0, self.fbanks.nfilt))
+        ret = self._logspec(self._buffer[(starts - self._offset)[:, None] +
+            np.arange(wlen)])
+        self._frame += len(starts)
+        next_start = self._starts(self._frame, self._frame + 1)[0]
+        self._buffer = self._buffer[next_start - self._offset:]
+        self._offset = next_start
+        return ret
+
+    def finish(self):
+        """ The last frames (that go beyond the end of the signal), then
+        resets for a new signal. """
+        n = self._offset + self._buffer.shape[0]
+        starts = self._starts(self._frame, self.fbanks.n_frames(n))
+        ret = np.zeros((0, self.fbanks.nfilt))
+        if len(starts):
+            ret = self._logspec(np.array([np.resize(
+                self._buffer[s - self._offset:], self.fbanks.wlen)
+                for s in starts]))
+        self.reset()
+        return ret
+
+
+class GammatoneFbanks(MelFbanks):
+    """ Log energies of nfilt gammatone-like filters (of order order, ERB
+    spaced from lowerf to upperf, by default the Nyquist frequency) on the
+    frames of MelFbanks. """
+    def __init__(self, nfilt=50, alpha=0., fs=16000, frate=100, wlen=0.025,
+            nfft=1024, lowerf=50., upperf=None, order=4, block_frames=4096):
+        if upperf is None:
+            upperf = fs / 2.
+        super(GammatoneFbanks, self).__init__(nfilt, alpha, fs, frate, wlen,
+                nfft, lowerf, upperf, block_frames)
+        self.filters = gammatone_filters(nfilt, nfft, fs, lowerf, upperf,
+                order)
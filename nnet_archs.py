@@ -587,6 +587,15 @@ class ABNeuralNet(object):  #NeuralNet):
                 givens={self.x1: batch_x1})
         return transform
 
+    def transform_x1_all_layers(self):
+        """ Returns a function that computes the outputs of all the layers
+        (the last one being the embedding) for x1 in one forward pass. """
+        batch_x1 = T.fmatrix('batch_x1')
+        transform = theano.function(inputs=[theano.Param(batch_x1)],
+                outputs=[layer.output for layer in self.layers[0::2]],
+                givens={self.x1: batch_x1})
+        return transform
+
 
 class ABClustNeuralNet(ABNeuralNet):
     def __init__(self, numpy_rng, theano_rng=None, 
@@ -1121,6 +1130,36 @@ class ABNeuralNet2Outputs(object):  #NeuralNet):
 
         return scoref2
 
+    def score_classif_same_diff_word_spkr(self, given_set):
+        """ Returns a function that scans given_set once and returns, for
+        each batch, the sums and counts of the cosine similarities of the
+        same/diff words and same/diff speakers pairs:
+        [sum same w, n same w, sum diff w, n diff w,
+         sum same s, n same s, sum diff s, n diff s]
+        so that the means over the whole set can be computed exactly. """
+        batch_x1 = T.fmatrix('batch_x1')
+        batch_x2 = T.fmatrix('batch_x2')
+        batch_y1 = T.ivector('batch_y1')
+        batch_y2 = T.ivector('batch_y2')
+        outputs = []
+        for cos_sim, y in [(self.cos_sim1, self.y1), (self.cos_sim2, self.y2)]:
+            for label in [1, 0]:
+                mask = T.eq(y, label)
+                outputs.append(T.sum(cos_sim[mask.nonzero()]))
+                outputs.append(T.sum(mask))
+        score = theano.function(inputs=[theano.Param(batch_x1),
+            theano.Param(batch_x2), theano.Param(batch_y1),
+            theano.Param(batch_y2)],
+                outputs=outputs,
+                givens={self.x1: batch_x1, self.x2: batch_x2,
+                    self.y1: batch_y1, self.y2: batch_y2})
+
+        # Create a function that scans the entire set given as input
+        def scoref():
+            return [score(x[0], x[1], y[0], y[1]) for (x, y) in given_set]
+
+        return scoref
+
     def transform_x1_x2(self):
         batch_x1 = T.fmatrix('batch_x1')
         batch_x2 = T.fmatrix('batch_x2')
@@ -1138,4 +1177,15 @@ class ABNeuralNet2Outputs(object):  #NeuralNet):
                 givens={self.x1: batch_x1})
         return transform
 
+    def transform_x1_all_layers(self):
+        """ Returns a function that computes the outputs of all the hidden
+        layers, then of the words and of the speakers embeddings, for x1 in
+        one forward pass. """
+        batch_x1 = T.fmatrix('batch_x1')
+        transform = theano.function(inputs=[theano.Param(batch_x1)],
+                outputs=[layer.output for layer in self.layers[0:-4:2]] +
+                    [self.layers[-4].output, self.layers[-2].output],
+                givens={self.x1: batch_x1})
+        return transform
+
 
@@ -1,44 +1,170 @@
-# -*- coding: utf-8 -*-
-"""
-Created on Fri May  2 09:33:20 2014
-
-@author: Thomas Schatz
-"""
-import h5features
-import os
-import numpy as np
-
-def npz_to_h5features(path, files, h5_filename, h5_groupname, batch_size=500):
-        features = []
-        times = []
-        internal_files = []
-        i = 0
-        for f in files:
-            if i == batch_size:
-                h5features.write(h5_filename, h5_groupname, internal_files, times, features)
-                features = []
-                times = []
-                internal_files = []   
-                i = 0
-            i = i+1
-            data = np.load(os.path.join(path, f))
-            features.append(data['features'])
-            times.append(data['time'])
-            internal_files.append(os.path.splitext(f)[0])
-        if features:
-            h5features.write(h5_filename, h5_groupname, internal_files, times, features)
-
-def convert(npz_folder, h5_filename = './features.features'):
-    files = os.listdir(npz_folder)        
-    npz_to_h5features(npz_folder, files, h5_filename, '/features/')
-    
-if __name__ == '__main__': # detects whether the script was called from command-line
-    
-    import argparse
-    
-    parser = argparse.ArgumentParser()
-    parser.add_argument('npz_folder', help='folder containing the npz files to be converted')
-    parser.add_argument('h5_filename', help='desired path for the h5features file')
-    args = parser.parse_args()  
-    convert(args.npz_folder, args.h5_filename)
-       
\ No newline at end of file
+# -*- coding: utf-8 -*-
+"""
+Created on Fri May  2 09:33:20 2014
+
+@author: Thomas Schatz
+
+Converts folders of *.npz (features and time) files to h5features files.
+The npz files are read by a pool of threads, the sizes of the output datasets
+are computed beforehand from the headers of the npz files, and the features
+are written by one writer in large contiguous blocks, optionally as float16.
+H5FeaturesWriter can also be fed directly by a generator (e.g. of
+embeddings, see embedding_pipeline.py).
+"""
+import os
+import zipfile
+from collections import deque
+import numpy as np
+import h5py
+from multiprocessing.pool import ThreadPool
+
+H5FEATURES_VERSION = "1.0"  # version of the h5features file format
+
+
+def nb_lines(item_size, n_columns, size_in_mem):
+    # item_size given in bytes, size_in_mem given in kilobytes
+    return max(10, int(round(size_in_mem * 1000. / (item_size * n_columns))))
+
+
+class H5FeaturesWriter(object):
+    """ Writes (name, times, features) items in a new group of a h5features
+    file (that can be read with h5features.read), buffering buffer_frames
+    frames between the writes. If n_frames and n_files are given, the
+    datasets are created with these sizes, otherwise they are grown. """
+    def __init__(self, filename, group, dim, n_frames=0, n_files=0,
+            float16=False, chunk_size=0.1, buffer_frames=100000):
+        self.dtype = np.dtype('float16' if float16 else 'float32')
+        self.buffer_frames = buffer_frames
+        self._f = h5py.File(filename, 'a')
+        g = self._f.create_group(group)  # fails if the group exists
+        g.attrs['version'] = H5FEATURES_VERSION
+        g.attrs['format'] = 'dense'
+        nb_frames_by_chunk = nb_lines(self.dtype.itemsize, dim,
+                chunk_size * 1000)
+        self._features = g.create_dataset('features', (n_frames, dim),
+                dtype=self.dtype, chunks=(nb_frames_by_chunk, dim),
+                maxshape=(None, dim))
+        self._times = g.create_dataset('times', (n_frames,), dtype=np.float64,
+                chunks=(nb_frames_by_chunk,), maxshape=(None,))
+        self._files = g.create_dataset('files', (n_files,),
+                dtype=h5py.special_dtype(vlen=unicode),
+                chunks=(nb_lines(20, 1, chunk_size * 1000),),
+                maxshape=(None,))
+        self._file_index = g.create_dataset('file_index', (n_files,),
+                dtype=np.int64,
+                chunks=(nb_lines(np.dtype(np.int64).itemsize, 1,
+                    chunk_size * 1000),), maxshape=(None,))
+        self._n_frames = 0  # written
+        self._n_files = 0
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, name, times, features):
+        assert features.shape[0] > 0, "all files must be non-empty"
+        self._buffer.append((name, times, features))
+        self._buffered += features.shape[0]
+        if self._buffered >= self.buffer_frames:
+            self.flush()
+
+    def flush(self):
+        if not len(self._buffer):
+            return
+        names, times, features = zip(*self._buffer)
+        a, b = self._n_frames, self._n_frames + self._buffered
+        i, j = self._n_files, self._n_files + len(names)
+        if self._features.shape[0] < b:
+            self._features.resize(b, axis=0)
+            self._times.resize(b, axis=0)
+        if self._files.shape[0] < j:
+            self._files.resize(j, axis=0)
+            self._file_index.resize(j, axis=0)
+        self._features[a:b] = np.concatenate(features).astype(self.dtype)
+        self._times[a:b] = np.concatenate(times)
+        self._files[i:j] = [unicode(n) for n in names]
+        self._file_index[i:j] = a - 1 + np.cumsum(
+                [x.shape[0] for x in features])  # last frame of each file
+        self._n_frames, self._n_files = b, j
+        self._buffer = []
+        self._buffered = 0
+
+    def close(self):
+        self.flush()
+        # in case the datasets were created bigger than what was written
+        self._features.resize(self._n_frames, axis=0)
+        self._times.resize(self._n_frames, axis=0)
+        self._files.resize(self._n_files, axis=0)
+        self._file_index.resize(self._n_files, axis=0)
+        self._f.close()
+
+
+def bounded_imap(pool, f, items, n_ahead):
+    """ pool.imap(f, items), but with at most n_ahead results read ahead of
+    the consumer (that pool.imap does not bound). """
+    pending = deque()
+    for item in items:
+        if len(pending) >= n_ahead:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(f, (item,)))
+    while len(pending):
+        yield pending.popleft().get()
+
+
+def npz_shape(fname):
+    """ Shape of the features of a npz file, from the header of the array
+    only. """
+    with zipfile.ZipFile(fname) as z:
+        f = z.open('features.npy')
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, _, _ = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, _, _ = np.lib.format.read_array_header_2_0(f)
+        f.close()
+    return shape
+
+
+def read_npz(fname):
+    data = np.load(fname)
+    return (os.path.splitext(os.path.basename(fname))[0], data['time'],
+            data['features'])
+
+
+def npz_to_h5features(path, files, h5_filename, h5_groupname, n_readers=8,
+        float16=False):
+    fnames = [os.path.join(path, f) for f in files]
+    if not len(fnames):  # nothing to write (no dimension to create it with)
+        return
+    pool = ThreadPool(n_readers)
+    shapes = pool.map(npz_shape, fnames)
+    writer = H5FeaturesWriter(h5_filename, h5_groupname, shapes[0][1],
+            n_frames=sum(s[0] for s in shapes), n_files=len(fnames),
+            float16=float16)
+    for name, times, features in bounded_imap(pool, read_npz, fnames,
+            2 * n_readers):
+        writer.write(name, times, features)
+    writer.close()
+    pool.close()
+    pool.join()
+
+
+def convert(npz_folder, h5_filename='./features.features', n_readers=8,
+        float16=False):
+    files = sorted(f for f in os.listdir(npz_folder) if f.endswith('.npz'))
+    npz_to_h5features(npz_folder, files, h5_filename, '/features/',
+            n_readers=n_readers, float16=float16)
+
+
+if __name__ == '__main__': # detects whether the script was called from command-line
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('npz_folder', help='folder containing the npz files to be converted')
+    parser.add_argument('h5_filename', help='desired path for the h5features file')
+    parser.add_argument('--readers', type=int, default=8,
+            help='number of reader threads')
+    parser.add_argument('--float16', action='store_true',
+            help='write the features as float16')
+    args = parser.parse_args()
+    convert(args.npz_folder, args.h5_filename, n_readers=args.readers,
+            float16=args.float16)
@@ -5,12 +5,11 @@ License: WTFPL http://www.wtfpl.net
 Copyright: Gabriel Synnaeve 2013
 """
 
-import os, shutil, sys
+import os, shutil, sys, hashlib, time
 import numpy as np
 from subprocess import call
-from functools import partial
-import joblib
-from multiprocessing import cpu_count
+from collections import defaultdict
+from multiprocessing import cpu_count, Pool
 try:
     from numpy import save as npsave
 except ImportError:
@@ -27,23 +26,35 @@ from scipy.io import wavfile
 USAGE = """
 Usage:
     python mfcc_and_gammatones.py [$folder_path] [--debug] [--htk_mfcc] 
-        [--gammatones] [--spectrograms] [--filterbanks] [--stereo] [--no-sox]
+        [--gammatones] [--spectrograms] [--filterbanks] [--stereo] [--sox]
+        [--jobs=N] [--speaker-prefix=N]
 
 You may need:
     - HCopy from HTK
     - wav_config (for HCopy, 25ms window, 10ms slide, 12 coefficiens, and 
         MFCC_0_D_A means we want the energy (0), first derivative (D) 
         and second derivative (A, acceleration).
-    - Brian hears http://www.briansimulator.org/docs/hears.html
     - this python file
 
-For all file.wav wav files in the dataset, what this script does is eqvlt to:
-    - mv file.wav file.rawaudio (because the wav in TIMIT is w/o headers)
-    - sox file.rawaudio file.wav (to reconstruct the headers)
+The RIFF WAVE and NIST SPHERE (TIMIT) files are read directly (see
+read_audio.py). For all file.wav wav files in the dataset, what this script
+does is eqvlt to:
+    - with --sox (only needed by HCopy on TIMIT):
+      mv file.wav file.rawaudio (because the wav in TIMIT is w/o headers)
+      sox file.rawaudio file.wav (to reconstruct the headers)
     - HCopy -A -D -T 1 -C wav_config file.wav file.mfc_unnorm
-    - outputing the gammatones in file_gamma.npy
+    - outputing the log energies of gammatone filters (ERB spaced, on the
+      frames of the filterbanks, see mel_fbanks.py) in file_gamma.npy
     - outputing the spectrograms in file_specgram.npy
     - outputing the log filterbanks in file_fbanks.npy
+
+The files are extracted by N worker processes (default: the number of cores
+minus 3), the biggest ones first and the small ones by chunks (whose
+filterbanks and gammatones are computed together), and the busy time of each worker is
+reported at the end. With --filterbanks, the per speaker (the folders of
+the wav files, or with --speaker-prefix=N the first N characters of their
+names) mean and variance of the filterbanks are accumulated by the workers
+in $folder_path/fbanks_cmvn.npz (see cmvn.py).
 """
 
 SPECGRAM_WINDOW = 0.020 # 20ms
@@ -51,98 +62,178 @@ SPECGRAM_OVERLAP = 0.010 # 10ms
 FBANKS_WINDOW = 0.025 # 25ms
 FBANKS_RATE = 100 # 10ms
 N_FBANKS = 40
-N_GAMMATONES_FILTERS = 1000
+N_GAMMATONES_FILTERS = 50
+CHUNK_BYTES = 8 * 2**20  # the smaller wav files are extracted by chunks
+SAVE_MANIFEST_EVERY = 100  # files
 
-try:
-    from brian import Hz, kHz
-    from brian.hears import loadsound, erbspace, Gammatone
-except ImportError:
-    print >> sys.stderr, "You need Brian Hears"
-    print >> sys.stderr, "http://www.briansimulator.org/docs/\
-            hears.html"
-    sys.exit(-1)
 try:
     from pylab import specgram
 except ImportError:
     print >> sys.stderr, "You need Pylab"
     sys.exit(-1)
-try:
-    from spectral import Spectral
-except ImportError:
-    print >> sys.stderr, "You need spectral (in the parent folder)"
-    print >> sys.stderr, "https://github.com/mwv/spectral"
-    sys.exit(-1)
+from mel_fbanks import MelFbanks, GammatoneFbanks
+from read_audio import read_audio
+from feature_manifest import Manifest, MANIFEST_NAME, atomic_write, atomic_save
+from cmvn import RunningStats, CMVNStats, CMVN_NAME
+from features_archive import utterance_speaker
 
 
-import wave, struct
-def readwav(fname):
-    fid = wave.open(fname, 'r')
-    _, _, fs, nframes, _, _ = fid.getparams()
-    sig = np.array(struct.unpack_from("%dh" % nframes,
-    fid.readframes(nframes)))
-    fid.close()
-    return sig, fs
+def features_params(htk_mfc, mfc_extension, stereo_wav, gammatones,
+        spectrograms, filterbanks):
+    """ {suffix of the features files: parameters of the extraction} """
+    params = {}
+    if htk_mfc:
+        with open('wav_config') as f:
+            params[mfc_extension] = {'features': 'htk_mfc',
+                    'config_md5': hashlib.md5(f.read()).hexdigest()}
+    if gammatones:
+        params['_gamma.npy'] = {'features': 'gammatones',
+                'n_filters': N_GAMMATONES_FILTERS, 'lowerf': 50,
+                'frate': FBANKS_RATE, 'wlen': FBANKS_WINDOW, 'nfft': 1024,
+                'stereo': stereo_wav, 'normalize': 'max'}
+    if spectrograms:
+        params['_specgram.npy'] = {'features': 'specgram',
+                'window': SPECGRAM_WINDOW, 'overlap': SPECGRAM_OVERLAP,
+                'stereo': stereo_wav}
+    if filterbanks:
+        params['_fbanks.npy'] = {'features': 'fbanks', 'nfilt': N_FBANKS,
+                'alpha': 0.97, 'lowerf': 50, 'frate': FBANKS_RATE,
+                'wlen': FBANKS_WINDOW, 'nfft': 1024, 'stereo': stereo_wav,
+                'normalize': 'max'}
+    return params
 
 
-def extract_features(fname, bdir, sox, htk_mfc, mfc_extension, stereo_wav,
-        gammatones, spectrograms, filterbanks):
-#def extract_features(fname, bdir):
-    if fname[-4:] != '.wav':
-        return
+_WORKER = {}  # the options and the extractors of each worker process
+
+
+def init_worker(sox, mfc_extension, stereo_wav):
+    _WORKER.update({'sox': sox, 'mfc_extension': mfc_extension,
+        'stereo_wav': stereo_wav, 'fbanks': {}})
+
+
+def fbanks_extractor(srate, suffix='_fbanks.npy'):
+    """ The (only) MelFbanks (or GammatoneFbanks for '_gamma.npy') of this
+    worker for this sampling rate. """
+    if (suffix, srate) in _WORKER['fbanks']:
+        return _WORKER['fbanks'][(suffix, srate)]
+    if suffix == '_gamma.npy':
+        fbanks = GammatoneFbanks(nfilt=N_GAMMATONES_FILTERS,
+                     fs=srate,
+                     lowerf=50,
+                     frate=FBANKS_RATE,
+                     wlen=FBANKS_WINDOW,
+                     nfft=1024
+                     )
+    else:
+        fbanks = MelFbanks(nfilt=N_FBANKS, # nb of filters in mel bank
+                     alpha=0.97,               # pre-emphasis
+                     fs=srate,                 # sampling rate
+                     lowerf=50,                # lower frequency
+                     frate=FBANKS_RATE,        # frame rate
+                     wlen=FBANKS_WINDOW,       # window length
+                     nfft=1024                 # length of dft
+                     )
+    _WORKER['fbanks'][(suffix, srate)] = fbanks
+    return fbanks
+
+
+def extract_features(fname, bdir, todo):
+    """ Extracts the features of bdir/fname whose suffixes are in todo,
+    except the filterbanks and gammatones, returns (sound, srate). """
     rawfname = bdir+'/'+fname[:-4]+'.rawaudio'
     wavfname = bdir+'/'+fname
     tempfname = bdir+'/'+fname[:-4]+'_temp.wav'
     # temp fname with .wav for sox
+    mfc_extension = _WORKER['mfc_extension']
     mfccfname = bdir+'/'+fname[:-4]+mfc_extension
-    if sox:
+    if _WORKER['sox'] and not os.path.exists(rawfname):  # not already done
         shutil.move(wavfname, tempfname)
         call(['sox', tempfname, wavfname])
         #call(['sox', '-G', tempfname, '-r 16k', wavfname])
         # w/o headers, sox uses extension
         shutil.move(tempfname, rawfname)
-    if htk_mfc:
-        call(['HCopy', '-C', 'wav_config', wavfname, mfccfname])
+    if mfc_extension in todo:
+        atomic_write(mfccfname, lambda tmp: call(['HCopy', '-C',
+            'wav_config', wavfname, tmp]))
     srate = 16000
     #srate, sound = wavfile.read(wavfname)
-    sound, srate = readwav(wavfname)
-    if stereo_wav and len(sound.shape) == 2: # in mono sound is a list
-        sound = 0.5 * (sound[:, 0] + sound[:, 1])
+    sound, srate = read_audio(wavfname)
+    if _WORKER['stereo_wav'] and len(sound.shape) == 2: # in mono sound is a list
+        sound = 0.5 * (sound[:, 0] + sound[:, 1].astype('float64'))
         # for stereo wav, sum both channels
-    if gammatones:
-        gammatonefname = bdir+'/'+fname[:-4]+'_gamma.npy'
-        tmp_snd = loadsound(wavfname)
-        gamma_cf = erbspace(20*Hz, 20*kHz, N_GAMMATONES_FILTERS)
-        gamma_fb = Gammatone(tmp_snd, gamma_cf)
-        with open(gammatonefname, 'w') as o_f:
-            npsave(o_f, gamma_fb.process())
-    if spectrograms:
+    if '_specgram.npy' in todo:
         powerspec, _, _, _ = specgram(sound, NFFT=int(srate
             * SPECGRAM_WINDOW), Fs=srate, noverlap=int(srate
                 * SPECGRAM_OVERLAP)) # TODO
         specgramfname = bdir+'/'+fname[:-4]+'_specgram.npy'
-        with open(specgramfname, 'w') as o_f:
-            npsave(o_f, powerspec.T)
-    if filterbanks:
-        # convert to Mel filterbanks
-        fbanks = Spectral(nfilt=N_FBANKS,      # nb of filters in mel bank
-                     alpha=0.97,               # pre-emphasis
-                     do_dct=False,             # we do not want MFCCs
-                     compression='log',
-                     fs=srate,                 # sampling rate
-                     lowerf=50,                # lower frequency
-                     frate=FBANKS_RATE,        # frame rate
-                     wlen=FBANKS_WINDOW,       # window length
-                     nfft=1024,                # length of dft
-                     do_deltas=False,          # speed
-                     do_deltasdeltas=False     # acceleration
-                     )
-        sound /= np.abs(sound).max(axis=0)  # TODO put that as option
-        fbank = fbanks.transform(sound)
-        fbanksfname = bdir+'/'+fname[:-4]+'_fbanks.npy'
-        with open(fbanksfname, 'w') as o_f:
-            npsave(o_f, fbank)
+        atomic_save(specgramfname, powerspec.T)
     # TODO wavelets scattergrams / scalograms
-    print "dealt with file", wavfname
+    return sound, srate
+
+
+def extract_chunk(jobs):
+    """ Extracts the features of the [(bdir, fname, todo)] jobs, the
+    filterbanks (and gammatones) of all the files of the same sampling rate
+    at once. Returns (worker pid, seconds, jobs, [(filterbanks fname, n,
+    mean, m2)] statistics of the filterbanks). """
+    t0 = time.time()
+    sounds = defaultdict(list)  # (suffix, srate): [(features fname, sound)]
+    stats = []
+    for bdir, fname, todo in jobs:
+        sound, srate = extract_features(fname, bdir, todo)
+        if '_fbanks.npy' in todo or '_gamma.npy' in todo:
+            sound = sound / float(np.abs(sound).max())  # TODO put that as option
+        for suffix in ('_fbanks.npy', '_gamma.npy'):
+            if suffix in todo:
+                sounds[(suffix, srate)].append((bdir+'/'+fname[:-4]+suffix,
+                    sound))
+    for (suffix, srate), l in sounds.iteritems():
+        fbanksfnames, sigs = zip(*l)
+        # convert to Mel filterbanks (or gammatones)
+        for fbanksfname, fbank in zip(fbanksfnames,
+                fbanks_extractor(srate, suffix).transform_many(sigs)):
+            atomic_save(fbanksfname, fbank)
+            if suffix == '_fbanks.npy':
+                rs = RunningStats(fbank.shape[1]).update(fbank)
+                stats.append((fbanksfname, rs.n, rs.mean, rs.m2))
+    for bdir, fname, _ in jobs:
+        print "dealt with file", bdir+'/'+fname
+    return os.getpid(), time.time() - t0, jobs, stats
+
+
+def schedule(jobs, chunk_bytes=CHUNK_BYTES):
+    """ Sorts the [(bdir, fname, todo)] jobs by decreasing size of the wav
+    file (the longest first) and groups the files smaller than chunk_bytes
+    in chunks of about chunk_bytes. Returns the list of chunks. """
+    sized = sorted(((os.path.getsize(bdir+'/'+fname), (bdir, fname, todo))
+        for bdir, fname, todo in jobs), reverse=True)
+    chunks = []
+    chunk = []
+    size = 0
+    for s, job in sized:
+        if s >= chunk_bytes:
+            chunks.append([job])
+            continue
+        chunk.append(job)
+        size += s
+        if size >= chunk_bytes:
+            chunks.append(chunk)
+            chunk = []
+            size = 0
+    if len(chunk):
+        chunks.append(chunk)
+    return chunks
+
+
+def report_utilization(busy, n_files, wall_time):
+    """ Prints the busy time and utilization of each worker. """
+    print "worker  files  busy (s)  utilization"
+    for pid in sorted(busy):
+        print "%6d  %5d  %8.1f  %10.1f%%" % (pid, n_files[pid], busy[pid],
+                100. * busy[pid] / max(wall_time, 1.E-9))
+    if len(busy):
+        print "mean utilization %.1f%% over %.1fs" % (100. * sum(
+            busy.values()) / (len(busy) * max(wall_time, 1.E-9)), wall_time)
 
 
 def process(folder,
@@ -153,7 +244,9 @@ def process(folder,
         gammatones=False,
         spectrograms=False,
         filterbanks=False,
-        sox=True):
+        sox=False,
+        n_jobs=None,
+        speaker_prefix=None):
     """ applies to all *.wav in folder """
 
     # first find if we produce normalized MFCC, otherwise note it in the ext
@@ -169,16 +262,80 @@ def process(folder,
         mfc_extension = '.mfc'
     print "MFC extension:", mfc_extension
 
+    # only the files that are not in the manifest with these parameters are
+    # extracted
+    params = features_params(htk_mfc, mfc_extension, stereo_wav, gammatones,
+            spectrograms, filterbanks)
+    manifest = Manifest(os.path.join(folder, MANIFEST_NAME))
+    cmvn_stats = CMVNStats(os.path.join(folder, CMVN_NAME))
+    speaker = lambda fbanksfname: utterance_speaker(fbanksfname,
+            speaker_prefix)
+
     # run through all the folders and files in the path "folder"
     # and put a header to the waves, save the originals as .rawaudio
     # use HCopy to produce MFCC files according to "wav_config" file
+    jobs = []
     for bdir, _, files in os.walk(folder):
-        ef = partial(extract_features, bdir=bdir, sox=sox, htk_mfc=htk_mfc,
-                mfc_extension=mfc_extension, stereo_wav=stereo_wav,
-                gammatones=gammatones, spectrograms=spectrograms,
-                filterbanks=filterbanks)
-        #ef = partial(extract_features, bdir=bdir)
-        joblib.Parallel(n_jobs=cpu_count()-3)(joblib.delayed(ef)(fname) for fname in files)
+        for fname in files:
+            if fname[-4:] != '.wav':
+                continue
+            if sox and not os.path.exists(bdir+'/'+fname[:-4]+'.rawaudio'):
+                todo = params.keys()  # its headers are not written yet
+            else:
+                todo = [suffix for suffix, p in params.iteritems()
+                        if manifest.outdated(bdir+'/'+fname,
+                            bdir+'/'+fname[:-4]+suffix, p)]
+            if len(todo):
+                jobs.append((bdir, fname, todo))
+            fbanksfname = os.path.abspath(bdir+'/'+fname[:-4]+'_fbanks.npy')
+            if (filterbanks and '_fbanks.npy' not in todo and
+                    fbanksfname not in cmvn_stats):
+                # extracted before the statistics were kept
+                cmvn_stats.add(fbanksfname, speaker(fbanksfname),
+                        np.load(fbanksfname))
+    if not len(jobs):
+        cmvn_stats.save()
+        print "extracted the features of 0 files"
+        return
+
+    # the biggest files first, and the small ones by chunks, to a pool of
+    # workers that each have their own extractors
+    if n_jobs is None:
+        n_jobs = max(1, cpu_count() - 3)
+    chunks = schedule(jobs)
+    busy = defaultdict(float)
+    n_files = defaultdict(int)
+    n_done = 0
+    t0 = time.time()
+    pool = Pool(n_jobs, initializer=init_worker,
+            initargs=(sox, mfc_extension, stereo_wav))
+    try:
+        for pid, seconds, done, stats in pool.imap_unordered(extract_chunk,
+                chunks):
+            busy[pid] += seconds
+            n_files[pid] += len(done)
+            for bdir, fname, todo in done:
+                for suffix in todo:
+                    manifest.record(bdir+'/'+fname,
+                            bdir+'/'+fname[:-4]+suffix, params[suffix])
+            for fbanksfname, n, mean, m2 in stats:
+                fbanksfname = os.path.abspath(fbanksfname)
+                cmvn_stats.add_stats(fbanksfname, speaker(fbanksfname), n,
+                        mean, m2)
+            n_done += len(done)
+            if n_done % SAVE_MANIFEST_EVERY < len(done):
+                manifest.save()
+                cmvn_stats.save()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        manifest.save()
+        cmvn_stats.save()
+    print "extracted the features of", n_done, "files"
+    report_utilization(busy, n_files, time.time() - t0)
 
 
 if __name__ == '__main__':
@@ -193,7 +350,8 @@ if __name__ == '__main__':
         dogammatones = False
         dospectrograms = False
         dofilterbanks = False
-        dosox = True
+        dosox = False
+        n_jobs = None
         if '--debug' in sys.argv:
             printdebug = True
         if '--forcemfcext' in sys.argv:
@@ -208,13 +366,20 @@ if __name__ == '__main__':
             dospectrograms = True
         if '--filterbanks' in sys.argv:
             dofilterbanks = True
-        if '--no-sox' in sys.argv:
-            dosox = False
+        if '--sox' in sys.argv:
+            dosox = True
+        speaker_prefix = None
+        for arg in sys.argv:
+            if arg.startswith('--jobs='):
+                n_jobs = int(arg.split('=')[1])
+            if arg.startswith('--speaker-prefix='):
+                speaker_prefix = int(arg.split('=')[1])
         l = filter(lambda x: not '--' in x[0:2], sys.argv)
         foldername = '.'
         if len(l) > 1:
             foldername = l[1]
         process(foldername, printdebug, dohtk_mfcc, doforcemfcext, isstereo,
-                dogammatones, dospectrograms, dofilterbanks, dosox)
+                dogammatones, dospectrograms, dofilterbanks, dosox, n_jobs,
+                speaker_prefix)
     else:
         process('.') # default
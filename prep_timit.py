@@ -1,7 +1,7 @@
-import theano, copy, sys, json, cPickle, socket
+import theano, sys, json, cPickle, socket
 import theano.tensor as T
 import numpy as np
-from numpy import zeros, pad
+from numpy import zeros
 
 BORROW = True # True makes it faster with the GPU
 USE_CACHING = True # beware if you use RBM / GRBM or gammatones /
@@ -14,34 +14,44 @@ if socket.gethostname() == "syhws-MacBook-Pro.local":
     prefix_path = '/Users/gabrielsynnaeve/postdoc/datasets/tmp_npy/'
 
 def padding(nframes, x, y):
-    """ Dirty hacky padding for a minimum of nframes """
+    """ [n_frames, nframes * dim] float32 stacks of the nframes frames around
+    each frame of x, zero padded, and zeroed across the sentences boundaries
+    ('!ENTER[2]' and '!EXIT' labels of y). x is only read (e.g. a memmap). """
     b_a = (nframes - 1) / 2 # before // after
-    x_2 = copy.deepcopy(x)
-    on_x_2 = False
-    x_f = zeros((x.shape[0], nframes * x.shape[1]), dtype='float32')
-    for i in xrange(x.shape[0]):
-        if y[i] == '!ENTER[2]' and y[i-1] != '!ENTER[2]': # TODO general case
-            on_x_2 = not on_x_2
-            if on_x_2:
-                x_2[i - b_a:i, :] = 0.0
-            else:
-                x[i - b_a:i, :] = 0.0
-        if i+b_a < y.shape[0] and '!EXIT' in y[i] and not '!EXIT' in y[i+b_a]:
-            # TODO general case
-            if on_x_2:
-                x_2[i+b_a:i+2*b_a+1, :] = 0.0
-            else:
-                x[i+b_a:i+2*b_a+1, :] = 0.0
-        if on_x_2:
-            x_f[i] = pad(x_2[max(0, i - b_a):i + b_a + 1].flatten(),
-                    (max(0, (b_a - i) * x.shape[1]),
-                        max(0, ((i+b_a+1) - x.shape[0]) * x.shape[1])),
-                    'constant', constant_values=(0, 0))
-        else:
-            x_f[i] = pad(x[max(0, i - b_a):i + b_a + 1].flatten(),
-                    (max(0, (b_a - i) * x.shape[1]),
-                        max(0, ((i+b_a+1) - x.shape[0]) * x.shape[1])),
-                    'constant', constant_values=(0, 0))
+    n, dim = x.shape
+    y = np.asarray(y, dtype=str)
+    frames = np.arange(n)
+    # every other sentence is read from its own copy of x (side[i]), whose
+    # rows get zeroed at the boundaries: row r of the copy c is zero from
+    # the frame zeroed_from[c, r] on (n: never)
+    enters = (y == '!ENTER[2]') & (np.roll(y, 1) != '!ENTER[2]') # TODO general case
+    side = np.cumsum(enters) % 2
+    in_exit = np.char.find(y, '!EXIT') >= 0
+    exits = np.zeros(n, dtype=bool)
+    m = max(0, n - b_a) # frames i with i + b_a < n
+    exits[:m] = in_exit[:m] & ~in_exit[b_a:b_a + m] # TODO general case
+    zeroed_from = np.empty((2, n), dtype='int64')
+    zeroed_from.fill(n)
+    for i in np.flatnonzero(enters | exits):
+        if enters[i]:
+            rows = frames[i - b_a:i]
+            zeroed_from[side[i], rows] = np.minimum(zeroed_from[side[i],
+                rows], i)
+        if exits[i]:
+            rows = frames[i + b_a:i + 2 * b_a + 1]
+            zeroed_from[side[i], rows] = np.minimum(zeroed_from[side[i],
+                rows], i)
+    x_f = zeros((n, nframes * dim), dtype='float32')
+    for k in xrange(nframes):  # k-th frame of the stacks: x[i - b_a + k]
+        # frames i in [0, n) whose source frame i - b_a + k is in [0, n)
+        first = min(n, max(0, b_a - k))
+        last = max(0, min(n, n + b_a - k))
+        if first >= last:
+            continue
+        out = x_f[first:last, k * dim:(k + 1) * dim]
+        out[:] = x[first - b_a + k:last - b_a + k]
+        i = frames[first:last]
+        out[zeroed_from[side[i], i - b_a + k] <= i] = 0.
     return x_f
 
 def train_classifiers(train_x, train_y, test_x, test_y, articulatory=False,
@@ -159,6 +169,8 @@ def prep_data(dataset, nframes=1, features='MFCC', scaling='normalize',
         print >> sys.stderr, "you need the .npy python arrays"
         print >> sys.stderr, "you can produce them with src/timit_to_numpy.py"
         print >> sys.stderr, "applied to the HTK force-aligned MLF train/test files"
+        if features == 'gamma':
+            print >> sys.stderr, "from the *_gamma.npy of extract_speech_features.py --gammatones"
         print >> sys.stderr, dataset + "/aligned_train_" + xname + ".npy"
         print >> sys.stderr, dataset + "/aligned_train_ylabels.npy"
         print >> sys.stderr, dataset + "/aligned_test_" + xname + ".npy"
@@ -319,7 +331,8 @@ def load_data(dataset, nframes=13, features='MFCC', scaling='normalize',
      - dataset: folder
      - nframes: number of frames to replicate/pad
      - features: 'MFCC' (13 + D + A = 39) || 'fbank' (40 coeffs filterbanks) 
-                 || 'gamma' (50 coeffs gammatones)
+                 || 'gamma' (50 coeffs gammatones, log energies on the
+                 frames of the filterbanks, see mel_fbanks.GammatoneFbanks)
      - scaling: 'none' || 'unit' (put all the data into [0-1])
                 || 'normalize' ((X-mean(X))/std(X))
                 || student ((X-mean(X))/std(X, deg_of_liberty=1))
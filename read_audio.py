@@ -0,0 +1,96 @@
+"""
+Reads the samples of RIFF WAVE and NIST SPHERE (e.g. the TIMIT *.wav) files
+without decoding them: the header is parsed and the samples are a (read
+only) numpy.memmap of the data of the file, so there is no need to rewrite
+the TIMIT headers with sox beforehand:
+
+    sound, srate = read_audio('train/dr1/fcjf0/sa1.wav')
+
+sound is [n_samples] for mono files and [n_samples, n_channels] otherwise.
+"""
+
+import struct
+import numpy as np
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def _samples(fname, dtype, offset, n_samples, n_channels):
+    if n_samples * n_channels == 0:
+        return np.zeros((0,) if n_channels == 1 else (0, n_channels), dtype)
+    shape = (n_samples,) if n_channels == 1 else (n_samples, n_channels)
+    return np.memmap(fname, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+
+def read_riff(fname):
+    """ (samples, sampling rate) of a RIFF WAVE file (PCM or float). """
+    with open(fname, 'rb') as f:
+        riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff != 'RIFF' or wave != 'WAVE':
+            raise IOError(fname + " is not a RIFF WAVE file")
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise IOError("no data chunk in " + fname)
+            chunk, size = struct.unpack('<4sI', header)
+            if chunk == 'fmt ':
+                fmt = struct.unpack('<HHIIHH', f.read(16))
+                f.seek(size - 16 + size % 2, 1)
+            elif chunk == 'data':
+                offset = f.tell()
+                f.seek(0, 2)  # the size can be wrong in streamed files
+                size = min(size, f.tell() - offset)
+                break
+            else:
+                f.seek(size + size % 2, 1)  # chunks are word aligned
+    if fmt is None:
+        raise IOError("no fmt chunk in " + fname)
+    tag, n_channels, srate, _, block_align, bits = fmt
+    if tag == WAVE_FORMAT_IEEE_FLOAT:
+        dtype = '<f%d' % (bits / 8)
+    elif tag in (WAVE_FORMAT_PCM, WAVE_FORMAT_EXTENSIBLE) and bits in (16, 32):
+        dtype = '<i%d' % (bits / 8)
+    elif tag in (WAVE_FORMAT_PCM, WAVE_FORMAT_EXTENSIBLE) and bits == 8:
+        dtype = 'u1'
+    else:
+        raise IOError("unsupported WAVE format %d (%d bits) in %s" %
+                (tag, bits, fname))
+    return _samples(fname, dtype, offset, size / block_align,
+            n_channels), srate
+
+
+def read_sphere(fname):
+    """ (samples, sampling rate) of a NIST SPHERE file (uncompressed PCM). """
+    with open(fname, 'rb') as f:
+        if f.readline().strip() != 'NIST_1A':
+            raise IOError(fname + " is not a NIST SPHERE file")
+        header_size = int(f.readline())
+        fields = {}
+        for line in f.read(header_size - f.tell()).split('\n'):
+            tmp = line.split(None, 2)
+            if len(tmp) and tmp[0] == 'end_head':
+                break
+            if len(tmp) == 3:
+                fields[tmp[0]] = int(tmp[2]) if tmp[1] == '-i' else tmp[2]
+    coding = fields.get('sample_coding', 'pcm')
+    if coding != 'pcm':
+        raise IOError("unsupported sample coding %s in %s" % (coding, fname))
+    n_bytes = fields.get('sample_n_bytes', 2)
+    byte_order = '>' if fields.get('sample_byte_format', '01') == '10' else '<'
+    return _samples(fname, byte_order + 'i%d' % n_bytes, header_size,
+            fields['sample_count'], fields.get('channel_count', 1)), \
+                    fields['sample_rate']
+
+
+def read_audio(fname):
+    """ (samples, sampling rate) of a RIFF WAVE or NIST SPHERE file. """
+    with open(fname, 'rb') as f:
+        magic = f.read(4)
+    if magic == 'RIFF':
+        return read_riff(fname)
+    if magic == 'NIST':
+        return read_sphere(fname)
+    raise IOError("unknown audio file format for " + fname)
@@ -6,7 +6,7 @@ Usage:
     [--features=fbank] [--init-lr=0.001] [--epochs=500] 
     [--network-type=dropout_net] [--trainer-type=adadelta] 
     [--prefix-output-fname=my_prefix_42] [--debug-test] [--debug-print=0] 
-    [--debug-time] [--debug-plot=0]
+    [--debug-time] [--debug-plot=0] [--resume]
 
 
 Options:
@@ -40,6 +40,8 @@ Options:
     default is False, using it makes it True
     --debug-plot=int           Level of debug plotting, 1: costs
     default is 0               >= 2: gradients & updates
+    --resume                   Flag that resumes training from the last
+    default is False           resumable checkpoint of this output file name
 """
 
 import socket, docopt, cPickle, time, sys, os
@@ -58,8 +60,9 @@ from random import shuffle
 from prep_timit import load_data
 from layers import Linear, ReLU, SigmoidLayer, SoftPlus
 from nnet_archs import ABXNeuralNet2Outputs
+from training_engine import TrainingEngine, same_diff_word_spkr
+from training_engine import load_resume_state, data_rng_state
 
-DEBUG = False
 DIM_EMBEDDING = 100
 
 class ABX2OIterator(object):
@@ -77,7 +80,8 @@ def run(dataset_path=DEFAULT_DATASET, dataset_name='timit',
         prefix_fname='',
         debug_print=0,
         debug_time=False,
-        debug_plot=0):
+        debug_plot=0,
+        resume=False):
     """
     FIXME TODO
     """
@@ -89,6 +93,10 @@ def run(dataset_path=DEFAULT_DATASET, dataset_name='timit',
     output_file_name += "_" + network_type + "_" + trainer_type
     output_file_name += "_emb_" + str(DIM_EMBEDDING)
     print "output file name:", output_file_name
+    resume_state = None
+    if resume:
+        resume_state = load_resume_state(output_file_name)
+    data_rng = data_rng_state(resume_state)
 
     n_ins = None
     n_outs = None
@@ -217,135 +225,24 @@ def run(dataset_path=DEFAULT_DATASET, dataset_name='timit',
         else:
             train_fn = nnet.get_SGD_trainer()
 
-    train_scoref_w = nnet.score_classif_same_diff_word_separated(train_set_iterator)
-    valid_scoref_w = nnet.score_classif_same_diff_word_separated(valid_set_iterator)
-    test_scoref_w = nnet.score_classif_same_diff_word_separated(test_set_iterator)
-    train_scoref_s = nnet.score_classif_same_diff_spkr_separated(train_set_iterator)
-    valid_scoref_s = nnet.score_classif_same_diff_spkr_separated(valid_set_iterator)
-    test_scoref_s = nnet.score_classif_same_diff_spkr_separated(test_set_iterator)
-    data_iterator = train_set_iterator
-
-    print '... training the model'
-    # early-stopping parameters
-    patience = 1000  # look as this many examples regardless TODO
-    patience_increase = 2.  # wait this much longer when a new best is
-                            # found
-    improvement_threshold = 0.995  # a relative improvement of this much is
-                                   # considered significant
-
-    best_validation_loss = numpy.inf
-    test_score = 0.
-    start_time = time.clock()
-
-    done_looping = False
-    epoch = 0
-    lr = init_lr
-    timer = None
-    if debug_plot:
-        print_mean_weights_biases(nnet.params)
-    #with open(output_file_name + 'epoch_0.pickle', 'wb') as f:
-    #    cPickle.dump(nnet, f, protocol=-1)
-
-    while (epoch < max_epochs) and (not done_looping):
-        epoch = epoch + 1
-        avg_costs = []
-        avg_params_gradients_updates = []
-        if debug_time:
-            timer = time.time()
-        for iteration, (x, y) in enumerate(data_iterator):
-            #print "x[0][0]", x[0][0]
-            #print "x[1][0]", x[1][0]
-            #print "y[0][0]", y[0][0]
-            #print "y[1][0]", y[1][0]
-            avg_cost = 0.
-            if "delta" in trainer_type:  # TODO remove need for this if
-                avg_cost = train_fn(x[0], x[1], y[0], y[1])
-            else:
-                avg_cost = train_fn(x[0], x[1], y[0], y[1], lr)
-            if debug_print >= 3:
-                print "cost:", avg_cost[0]
-            if debug_plot >= 2:
-                plot_costs(avg_cost[0])
-                if not len(avg_params_gradients_updates):
-                    avg_params_gradients_updates = map(numpy.asarray, avg_cost[1:])
-                else:
-                    avg_params_gradients_updates = rolling_avg_pgu(
-                            iteration, avg_params_gradients_updates,
-                            map(numpy.asarray, avg_cost[1:]))
-            if debug_plot >= 3:
-                plot_params_gradients_updates(iteration, avg_cost[1:])
-            if type(avg_cost) == list:
-                avg_costs.append(avg_cost[0])
-            else:
-                avg_costs.append(avg_cost)
-        if debug_print >= 2:
-            print_mean_weights_biases(nnet.params)
-        if debug_plot >= 2:
-            plot_params_gradients_updates(epoch, avg_params_gradients_updates)
-        if debug_time:
-            print('  epoch %i took %f seconds' % (epoch, time.time() - timer))
-        avg_cost = numpy.mean(avg_costs)
-        if numpy.isnan(avg_cost):
-            print("avg costs is NaN so we're stopping here!")
-            break
-        print('  epoch %i, avg costs %f' % \
-              (epoch, avg_cost))
-        tmp_train = zip(*train_scoref_w())
-        print('  epoch %i, training sim same words %f, diff words %f' % \
-              (epoch, numpy.mean(tmp_train[0]), numpy.mean(tmp_train[1])))
-        tmp_train = zip(*train_scoref_s())
-        print('  epoch %i, training sim same spkrs %f, diff spkrs %f' % \
-              (epoch, numpy.mean(tmp_train[0]), numpy.mean(tmp_train[1])))
-        # TODO update lr(t) = lr(0) / (1 + lr(0) * lambda * t)
-        lr = numpy.float32(init_lr / (numpy.sqrt(iteration) + 1.)) ### TODO
-        #lr = numpy.float32(init_lr / (iteration + 1.)) ### TODO
-        # or another scheme for learning rate decay
-        #with open(output_file_name + 'epoch_' +str(epoch) + '.pickle', 'wb') as f:
-        #    cPickle.dump(nnet, f, protocol=-1)
-
-        # we check the validation loss on every epoch
-        validation_losses_w = zip(*valid_scoref_w())
-        validation_losses_s = zip(*valid_scoref_s())
-        this_validation_loss = 0.25*(1.-numpy.mean(validation_losses_w[0])) +\
-                0.25*numpy.mean(validation_losses_w[1]) +\
-                0.25*(1.-numpy.mean(validation_losses_s[0])) +\
-                0.25*numpy.mean(validation_losses_s[1])
-
-        print('  epoch %i, valid sim same words %f, diff words %f' % \
-              (epoch, numpy.mean(validation_losses_w[0]), numpy.mean(validation_losses_w[1])))
-        print('  epoch %i, valid sim same spkrs %f, diff spkrs %f' % \
-              (epoch, numpy.mean(validation_losses_s[0]), numpy.mean(validation_losses_s[1])))
-        # if we got the best validation score until now
-        if this_validation_loss < best_validation_loss:
-            with open(output_file_name + '.pickle', 'wb') as f:
-                cPickle.dump(nnet, f, protocol=-1)
-            # improve patience if loss improvement is good enough
-            if (this_validation_loss < best_validation_loss *
-                improvement_threshold):
-                patience = max(patience, iteration * patience_increase)
-            # save best validation score and iteration number
-            best_validation_loss = this_validation_loss
-            # test it on the test set
-            test_losses_w = zip(*test_scoref_w())
-            test_losses_s = zip(*test_scoref_s())
-            print('  epoch %i, test sim same words %f, diff words %f' % \
-                  (epoch, numpy.mean(test_losses_w[0]), numpy.mean(test_losses_w[1])))
-            print('  epoch %i, test sim same spkrs %f, diff spkrs %f' % \
-                  (epoch, numpy.mean(test_losses_s[0]), numpy.mean(test_losses_s[1])))
-        if patience <= iteration:  # TODO correct that
-            done_looping = True
-            break
-
-    end_time = time.clock()
-    print(('Optimization complete with best validation score of %f, '
-           'with test performance %f') %
-                 (best_validation_loss, test_score))
-    print >> sys.stderr, ('The fine tuning code for file ' +
-                          os.path.split(__file__)[1] +
-                          ' ran for %.2fm' % ((end_time - start_time)
-                                              / 60.))
-    with open(output_file_name + '_final.pickle', 'wb') as f:
-        cPickle.dump(nnet, f, protocol=-1)
+    engine = TrainingEngine(nnet, train_fn, trainer_type, train_set_iterator,
+            output_file_name, init_lr=init_lr, max_epochs=max_epochs,
+            train_score=same_diff_word_spkr(
+                nnet.score_classif_same_diff_word_spkr(train_set_iterator),
+                "training sim"),
+            valid_score=same_diff_word_spkr(
+                nnet.score_classif_same_diff_word_spkr(valid_set_iterator),
+                "valid sim"),
+            test_score=same_diff_word_spkr(
+                nnet.score_classif_same_diff_word_spkr(test_set_iterator),
+                "test sim"),
+            lr_decay=True, patience=1000,
+            data_rng_state=data_rng,
+            debug_print=debug_print, debug_time=debug_time,
+            debug_plot=debug_plot)
+    if resume_state is not None:
+        engine.restore(resume_state)
+    engine.run()
 
 if __name__=='__main__':
     arguments = docopt.docopt(__doc__, version='run_exp version 0.1')
@@ -389,6 +286,9 @@ if __name__=='__main__':
     debug_plot = 0
     if arguments['--debug-plot']:
         debug_plot = int(arguments['--debug-plot'])
+    resume = False
+    if arguments['--resume']:
+        resume = True
 
     run(dataset_path=dataset_path, dataset_name=dataset_name,
         iterator_type=iterator_type, batch_size=batch_size,
@@ -400,6 +300,7 @@ if __name__=='__main__':
         prefix_fname=prefix_fname,
         debug_print=debug_print,
         debug_time=debug_time,
-        debug_plot=debug_plot)
+        debug_plot=debug_plot,
+        resume=resume)
 
     #THEANO_FLAGS="device=gpu0" python run_exp_AB_phn_spkr.py --dataset-path=BUCKEYE_test.joblib --dataset-name="buckeye_dtw_word_spkr" --prefix-output-fname="small_coscos2_WORD_ONLY" --iterator-type=dtw --network-type=ab_net --epochs=2000 --nframes=11 --debug-print=1 --debug-plot=0 --debug-time
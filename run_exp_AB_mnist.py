@@ -5,7 +5,7 @@ Usage:
     [--batch-size=100] [--init-lr=0.001] [--epochs=500] 
     [--network-type=dropout_net] [--trainer-type=adadelta] 
     [--prefix-output-fname=my_prefix_42] [--debug-test] [--debug-print=0] 
-    [--debug-time] [--debug-plot=0]
+    [--debug-time] [--debug-plot=0] [--resume]
 
 
 Options:
@@ -35,6 +35,8 @@ Options:
     default is False, using it makes it True
     --debug-plot=int           Level of debug plotting, 1: costs
     default is 0               >= 2: gradients & updates
+    --resume                   Flag that resumes training from the last
+    default is False           resumable checkpoint of this output file name
 """
 
 import socket, docopt, cPickle, time, sys, os
@@ -55,81 +57,15 @@ from dataset_iterators import DatasetABIterator, DatasetABSamplingIteratorFromLa
 from layers import Linear, ReLU, SigmoidLayer
 from classifiers import LogisticRegression
 from nnet_archs import NeuralNet, DropoutNet, ABNeuralNet, DropoutABNeuralNet
+from training_engine import TrainingEngine, same_diff
+from training_engine import load_resume_state, data_rng_state
 
 
 #DEFAULT_DATASET = 'MNIST_train.joblib'
 DEFAULT_DATASET = ''
-DEBUG = False
 DIM_EMBEDDING = 50
 
 
-def print_mean_weights_biases(params):
-    for layer_ind, param in enumerate(params):
-        filler = "weight"
-        if layer_ind % 2:
-            filler = "bias"
-        print("layer %i mean %s values %f and std devs %f" % (layer_ind/2, 
-            filler, numpy.mean(param.eval()), numpy.std(param.eval())))
-
-
-def plot_costs(cost):
-    # TODO
-    pass
-
-
-def rolling_avg_pgu(iteration, pgu, l):
-    # (iteration * pgu + l) / (iteration + 1)
-    assert len(l) == len(pgu)
-    ll = len(l)/3
-    params, gparams, updates = l[:ll], l[ll:-ll], l[-ll:]
-    mpars, mgpars, mupds = pgu[:ll], pgu[ll:-ll], pgu[-ll:]
-    ii = iteration + 1
-    return [(iteration * mpars[k] + p) / ii for k, p in enumerate(params)] +\
-            [(iteration * mgpars[k] + g) / ii for k, g in enumerate(gparams)] +\
-            [(iteration * mupds[k] + u) / ii for k, u in enumerate(updates)]
-
-
-def plot_params_gradients_updates(n, l):
-    # TODO currently works only with THEANO_FLAGS="device=cpu" (not working on
-    #CudaNDArrays)
-    def plot_helper(li, ti, p):
-        if ppl == None:
-            print >> sys.stderr, "cannot plot this without prettyplotlib"
-            return
-        fig, ax = plt.subplots(1)
-        if li % 2:
-            title = "biases" + ti
-            ppl.bar(ax, numpy.arange(p.shape[0]), p) # TODO with plt
-        else:
-            title = "weights" + ti
-            ppl.pcolormesh(fig, ax, p) # TODO with plt
-        plt.title(title)
-        plt.savefig(title + ".png")
-        #ppl.show()
-        plt.close()
-    ll = len(l)/3
-    params, gparams, updates = l[:ll], l[ll:-ll], l[-ll:]
-    if DEBUG:
-        print "params"
-        print params
-        print "===================="
-        print "gparams"  # TODO find out why not CudaNDArray here
-        print gparams
-        print "===================="
-        print "updates"  # TODO find out why not CudaNDArray here
-        print updates
-    title_iter =  "_%04i" % n
-    for layer_ind, param in enumerate(params):
-        title = "_for_layer_" + str(layer_ind/3) + title_iter
-        plot_helper(layer_ind, title, param)
-    for layer_ind, gparam in enumerate(gparams):
-        title = "_gradients_for_layer_" + str(layer_ind/3) + title_iter
-        plot_helper(layer_ind, title, gparam)
-    for layer_ind, update in enumerate(updates):
-        title = "_updates_for_layer_" + str(layer_ind/3) + title_iter
-        plot_helper(layer_ind, title, update)
-
-
 def run(dataset_path=DEFAULT_DATASET, dataset_name='mnist',
         iterator_type=DatasetABIterator, batch_size=100,
         init_lr=0.001, max_epochs=500, 
@@ -142,7 +78,8 @@ def run(dataset_path=DEFAULT_DATASET, dataset_name='mnist',
         debug_on_test_only=False,
         debug_print=0,
         debug_time=False,
-        debug_plot=0):
+        debug_plot=0,
+        resume=False):
     """
     FIXME TODO
     """
@@ -153,6 +90,10 @@ def run(dataset_path=DEFAULT_DATASET, dataset_name='mnist',
     output_file_name += "_" + network_type + "_" + trainer_type
     output_file_name += "_emb_" + str(DIM_EMBEDDING)
     print "output file name:", output_file_name
+    resume_state = None
+    if resume:
+        resume_state = load_resume_state(output_file_name)
+    data_rng = data_rng_state(resume_state)
 
     n_ins = None
     n_outs = None
@@ -285,122 +226,32 @@ def run(dataset_path=DEFAULT_DATASET, dataset_name='mnist',
     valid_scoref = nnet.score_classif_same_diff_separated(valid_set_iterator)
     test_scoref = nnet.score_classif(test_set_iterator)
     data_iterator = train_set_iterator
+    valid_score = same_diff(valid_scoref, "valid error")
 
     if debug_on_test_only:
         data_iterator = test_set_iterator
         train_scoref = test_scoref
-
-    print '... training the model'
-    # early-stopping parameters
-    patience = 1000  # look as this many examples regardless TODO
-    patience_increase = 2.  # wait this much longer when a new best is
-                            # found
-    improvement_threshold = 0.995  # a relative improvement of this much is
-                                   # considered significant
-
-    best_validation_loss = numpy.inf
-    test_score = 0.
-    start_time = time.clock()
-
-    done_looping = False
-    epoch = 0
-    lr = init_lr
-    timer = None
-    if debug_plot:
-        print_mean_weights_biases(nnet.params)
-    #with open(output_file_name + 'epoch_0.pickle', 'wb') as f:
-    #    cPickle.dump(nnet, f)
-
-    while (epoch < max_epochs) and (not done_looping):
-        epoch = epoch + 1
-        avg_costs = []
-        avg_params_gradients_updates = []
-        if debug_time:
-            timer = time.time()
-        for iteration, (x, y) in enumerate(data_iterator):
-            avg_cost = 0.
-            if "ab_net" in network_type:  # remove need for this if
-                if "delta" in trainer_type:  # TODO remove need for this if
-                    avg_cost = train_fn(x[0], x[1], y)
-                else:
-                    avg_cost = train_fn(x[0], x[1], y, lr)
-                if debug_print >= 3:
-                    print "cost:", avg_cost[0]
-                if debug_plot >= 2:
-                    plot_costs(avg_cost[0])
-                    if not len(avg_params_gradients_updates):
-                        avg_params_gradients_updates = map(numpy.asarray, avg_cost[1:])
-                    else:
-                        avg_params_gradients_updates = rolling_avg_pgu(
-                                iteration, avg_params_gradients_updates,
-                                map(numpy.asarray, avg_cost[1:]))
-                if debug_plot >= 3:
-                    plot_params_gradients_updates(iteration, avg_cost[1:])
-            else:
-                if "delta" in trainer_type:  # TODO remove need for this if
-                    avg_cost = train_fn(x, y)
-                else:
-                    avg_cost = train_fn(x, y, lr)
-            if type(avg_cost) == list:
-                avg_costs.append(avg_cost[0])
-            else:
-                avg_costs.append(avg_cost)
-        if debug_print >= 2:
-            print_mean_weights_biases(nnet.params)
-        if debug_plot >= 2:
-            plot_params_gradients_updates(epoch, avg_params_gradients_updates)
-        if debug_time:
-            print('  epoch %i took %f seconds' % (epoch, time.time() - timer))
-        print('  epoch %i, avg costs %f' % \
-              (epoch, numpy.mean(avg_costs)))
-        tmp_train = zip(*train_scoref())
-        print('  epoch %i, training error same %f, diff %f' % \
-              (epoch, numpy.mean(tmp_train[0]), numpy.mean(tmp_train[1])))
-        # TODO update lr(t) = lr(0) / (1 + lr(0) * lambda * t)
-        # or another scheme for learning rate decay
-        #with open(output_file_name + 'epoch_' +str(epoch) + '.pickle', 'wb') as f:
-        #    cPickle.dump(nnet, f)
-
-        if debug_on_test_only:
-            continue
-
-        # we check the validation loss on every epoch
-        validation_losses = zip(*valid_scoref())
-        #this_validation_loss = -numpy.mean(validation_losses[0])  # TODO this is a mean of means (with different lengths)
-        this_validation_loss = 0.5*(1.-numpy.mean(validation_losses[0])) +\
-                0.5*numpy.mean(validation_losses[1])
-        print('  epoch %i, valid error same %f, diff %f' % \
-              (epoch, numpy.mean(validation_losses[0]), numpy.mean(validation_losses[1])))
-        # if we got the best validation score until now
-        if this_validation_loss < best_validation_loss:
-            with open(output_file_name + '.pickle', 'wb') as f:
-                cPickle.dump(nnet, f)
-            # improve patience if loss improvement is good enough
-            if (this_validation_loss < best_validation_loss *
-                improvement_threshold):
-                patience = max(patience, iteration * patience_increase)
-            # save best validation score and iteration number
-            best_validation_loss = this_validation_loss
-            # test it on the test set
-            test_losses = test_scoref()
-            test_score_same = numpy.mean(test_losses[0])  # TODO this is a mean of means (with different lengths)
-            test_score_diff = numpy.mean(test_losses[1])  # TODO this is a mean of means (with different lengths)
-            print(('  epoch %i, test error of best model same %f diff %f') %
-                  (epoch, test_score_same, test_score_diff))
-        if patience <= iteration:  # TODO correct that
-            done_looping = True
-            break
-
-    end_time = time.clock()
-    print(('Optimization complete with best validation score of %f, '
-           'with test performance %f') %
-                 (best_validation_loss, test_score))
-    print >> sys.stderr, ('The fine tuning code for file ' +
-                          os.path.split(__file__)[1] +
-                          ' ran for %.2fm' % ((end_time - start_time)
-                                              / 60.))
-    with open(output_file_name + '_final.pickle', 'wb') as f:
-        cPickle.dump(nnet, f)
+        valid_score = None
+
+    def test_score(epoch):
+        test_losses = test_scoref()
+        test_score_same = numpy.mean(test_losses[0])  # TODO this is a mean of means (with different lengths)
+        test_score_diff = numpy.mean(test_losses[1])  # TODO this is a mean of means (with different lengths)
+        print(('  epoch %i, test error of best model same %f diff %f') %
+              (epoch, test_score_same, test_score_diff))
+        return {'same': test_score_same, 'diff': test_score_diff}
+
+    engine = TrainingEngine(nnet, train_fn, trainer_type, data_iterator,
+            output_file_name, init_lr=init_lr, max_epochs=max_epochs,
+            train_score=same_diff(train_scoref, "training error"),
+            valid_score=valid_score, test_score=test_score,
+            patience=1000,
+            data_rng_state=data_rng,
+            debug_print=debug_print, debug_time=debug_time,
+            debug_plot=debug_plot)
+    if resume_state is not None:
+        engine.restore(resume_state)
+    engine.run()
 
 if __name__=='__main__':
     arguments = docopt.docopt(__doc__, version='run_exp version 0.1')
@@ -441,6 +292,9 @@ if __name__=='__main__':
     debug_plot = 0
     if arguments['--debug-plot']:
         debug_plot = int(arguments['--debug-plot'])
+    resume = False
+    if arguments['--resume']:
+        resume = True
 
     run(dataset_path=dataset_path, dataset_name=dataset_name,
         iterator_type=iterator_type, batch_size=batch_size,
@@ -463,7 +317,8 @@ if __name__=='__main__':
         debug_on_test_only=debug_on_test_only,
         debug_print=debug_print,
         debug_time=debug_time,
-        debug_plot=debug_plot)
+        debug_plot=debug_plot,
+        resume=resume)
 
 
     #THEANO_FLAGS="device=gpu1" python run_exp_AB_mnist.py --dataset-path=MNIST_train.joblib --dataset-name="MNIST" --prefix-output-fname="deep_cos_cos2" --iterator-type=batch --network-type=fast_dropout_ab_net --debug-print=1 --debug-plot=0 --debug-time
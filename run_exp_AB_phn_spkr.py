@@ -6,7 +6,9 @@ Usage:
     [--features=fbank] [--init-lr=0.001] [--epochs=500] 
     [--network-type=dropout_net] [--trainer-type=adadelta] 
     [--prefix-output-fname=my_prefix_42] [--debug-test] [--debug-print=0] 
-    [--debug-time] [--debug-plot=0]
+    [--debug-time] [--debug-plot=0] [--workers=1] [--resume]
+    [--autotune] [--max-batch-memory=1024] [--hard-negatives=0]
+    [--async-scoring] [--score-subset=0] [--cmvn=stats]
 
 
 Options:
@@ -42,6 +44,24 @@ Options:
     default is False, using it makes it True
     --debug-plot=int           Level of debug plotting, 1: costs
     default is 0               >= 2: gradients & updates
+    --resume                   Flag that resumes training from the last
+    default is False           resumable checkpoint of this output file name
+    --autotune                 Flag that times a few batch sizes around
+    default is False           --batch-size and trains with the fastest one
+    --max-batch-memory=int     Memory cap (in MB) for the autotuned batch size
+    default is 1024
+    --hard-negatives=int       Every that many epochs, replace the pairs of
+    default is 0 (never)       different words by confusable ones, mined with
+                               the current word embeddings
+    --workers=int              Number of data-parallel worker processes that
+    default is 1               share the gradients computation (CPU only)
+    --async-scoring            Flag that activates scoring (and checkpointing)
+    default is False           in a separate process while training goes on
+    --score-subset=int         Number of batches of a fixed random subset of
+    default is 0 (all)         each set to score on (with conf. intervals)
+    --cmvn=str                 Stats file (fbanks_cmvn.npz of the extraction)
+    default is None            to normalize the words by their speaker's mean
+                               and std (instead of the global ones)
 """
 
 import socket, docopt, cPickle, time, sys, os
@@ -58,92 +78,32 @@ import random
 from random import shuffle
 
 from prep_timit import load_data
+from cmvn import CMVN
 from dataset_iterators import DatasetSentencesIterator
 from dataset_iterators import DatasetDTWIterator, DatasetBatchIteratorPhn
 from dataset_iterators import DatasetDTWWrdSpkrIterator, DatasetDTReWIterator
+from dataset_iterators import DatasetSubsetIterator
 from layers import Linear, ReLU, SigmoidLayer, SoftPlus
 from classifiers import LogisticRegression
 from nnet_archs import ABNeuralNet2Outputs
 from nnet_archs import DropoutABNeuralNet # TODO
+from data_parallel import DataParallelTrainer, benchmark_scaling
+from training_engine import TrainingEngine, same_diff_word_spkr
+from training_engine import load_resume_state, data_rng_state
+from training_engine import autotune_batch_size
 
 DEFAULT_DATASET = '/fhgfs/bootphon/scratch/gsynnaeve/TIMIT/train_dev_test_split'
 if socket.gethostname() == "syhws-MacBook-Pro.local":
     DEFAULT_DATASET = '/Users/gabrielsynnaeve/postdoc/datasets/TIMIT_train_dev_test'
 elif socket.gethostname() == "TODO":  # TODO
     DEFAULT_DATASET = '/media/bigdata/TIMIT_train_dev_test'
-DEBUG = False
 
 REDTW = False
+REDTW_EVERY = 5  # epochs
+REDTW_THRESHOLD = 0.05  # relative change of the embeddings of a word
 DIM_EMBEDDING = 100
 
 
-def print_mean_weights_biases(params):
-    for layer_ind, param in enumerate(params):
-        filler = "weight"
-        if layer_ind % 2:
-            filler = "bias"
-        print("layer %i mean %s values %f and std devs %f" % (layer_ind/2, 
-            filler, numpy.mean(param.eval()), numpy.std(param.eval())))
-
-
-def plot_costs(cost):
-    # TODO
-    pass
-
-
-def rolling_avg_pgu(iteration, pgu, l):
-    # (iteration * pgu + l) / (iteration + 1)
-    assert len(l) == len(pgu)
-    ll = len(l)/3
-    params, gparams, updates = l[:ll], l[ll:-ll], l[-ll:]
-    mpars, mgpars, mupds = pgu[:ll], pgu[ll:-ll], pgu[-ll:]
-    ii = iteration + 1
-    return [(iteration * mpars[k] + p) / ii for k, p in enumerate(params)] +\
-            [(iteration * mgpars[k] + g) / ii for k, g in enumerate(gparams)] +\
-            [(iteration * mupds[k] + u) / ii for k, u in enumerate(updates)]
-
-
-def plot_params_gradients_updates(n, l):
-    # TODO currently works only with THEANO_FLAGS="device=cpu" (not working on
-    #CudaNDArrays)
-    def plot_helper(li, ti, p):
-        if ppl == None:
-            print >> sys.stderr, "cannot plot this without prettyplotlib"
-            return
-        fig, ax = plt.subplots(1)
-        if li % 2:
-            title = "biases" + ti
-            ppl.bar(ax, numpy.arange(p.shape[0]), p) # TODO with plt
-        else:
-            title = "weights" + ti
-            ppl.pcolormesh(fig, ax, p) # TODO with plt
-        plt.title(title)
-        plt.savefig(title + ".png")
-        #ppl.show()
-        plt.close()
-    ll = len(l)/3
-    params, gparams, updates = l[:ll], l[ll:-ll], l[-ll:]
-    if DEBUG:
-        print "params"
-        print params
-        print "===================="
-        print "gparams"  # TODO find out why not CudaNDArray here
-        print gparams
-        print "===================="
-        print "updates"  # TODO find out why not CudaNDArray here
-        print updates
-    title_iter =  "_%04i" % n
-    for layer_ind, param in enumerate(params):
-        title = "_for_layer_" + str(layer_ind/3) + title_iter
-        plot_helper(layer_ind, title, param)
-    for layer_ind, gparam in enumerate(gparams):
-        title = "_gradients_for_layer_" + str(layer_ind/3) + title_iter
-        plot_helper(layer_ind, title, gparam)
-    for layer_ind, update in enumerate(updates):
-        title = "_updates_for_layer_" + str(layer_ind/3) + title_iter
-        plot_helper(layer_ind, title, update)
-
-
 def run(dataset_path=DEFAULT_DATASET, dataset_name='timit',
         iterator_type=DatasetDTWIterator, batch_size=100,
         nframes=13, features="fbank",
@@ -157,7 +117,15 @@ def run(dataset_path=DEFAULT_DATASET, dataset_name='timit',
         debug_on_test_only=False,
         debug_print=0,
         debug_time=False,
-        debug_plot=0):
+        debug_plot=0,
+        autotune=False,
+        max_batch_memory=1024,
+        hard_negatives=0,
+        n_workers=1,
+        async_scoring=False,
+        score_subset=0,
+        cmvn=None,
+        resume=False):
     """
     FIXME TODO
     """
@@ -169,6 +137,10 @@ def run(dataset_path=DEFAULT_DATASET, dataset_name='timit',
     output_file_name += "_" + network_type + "_" + trainer_type
     output_file_name += "_emb_" + str(DIM_EMBEDDING)
     print "output file name:", output_file_name
+    resume_state = None
+    if resume:
+        resume_state = load_resume_state(output_file_name)
+    data_rng = data_rng_state(resume_state)
 
     n_ins = None
     n_outs = None
@@ -213,12 +185,14 @@ def run(dataset_path=DEFAULT_DATASET, dataset_name='timit',
         train_set_iterator = DatasetDTWWrdSpkrIterator(data_same,
                 normalize=normalize, min_max_scale=min_max_scale,
                 scale_f1=None, scale_f2=None, nframes=nframes,
-                batch_size=batch_size, marginf=marginf)
+                batch_size=batch_size, marginf=marginf,
+                cmvn=cmvn)
     else:
         train_set_iterator = DatasetDTWWrdSpkrIterator(
                 data_same[:dev_split_at], normalize=normalize,
                 min_max_scale=min_max_scale, scale_f1=None, scale_f2=None,
-                nframes=nframes, batch_size=batch_size, marginf=marginf)
+                nframes=nframes, batch_size=batch_size, marginf=marginf,
+                cmvn=cmvn)
     f1 = train_set_iterator._scale_f1
     f2 = train_set_iterator._scale_f2
 
@@ -228,12 +202,14 @@ def run(dataset_path=DEFAULT_DATASET, dataset_name='timit',
         valid_set_iterator = DatasetDTWWrdSpkrIterator(data_same,
                 normalize=normalize, min_max_scale=min_max_scale,
                 scale_f1=f1, scale_f2=f2,
-                nframes=nframes, batch_size=batch_size, marginf=marginf)
+                nframes=nframes, batch_size=batch_size, marginf=marginf,
+                cmvn=cmvn)
     else:
         valid_set_iterator = DatasetDTWWrdSpkrIterator(
                 data_same[dev_split_at:test_split_at], normalize=normalize,
                 min_max_scale=min_max_scale, scale_f1=f1, scale_f2=f2,
-                nframes=nframes, batch_size=batch_size, marginf=marginf)
+                nframes=nframes, batch_size=batch_size, marginf=marginf,
+                cmvn=cmvn)
 
     ### TEST SET
     if has_dev_and_test_set or has_test_set_only:
@@ -241,12 +217,14 @@ def run(dataset_path=DEFAULT_DATASET, dataset_name='timit',
         test_set_iterator = DatasetDTWWrdSpkrIterator(data_same,
                 normalize=normalize, min_max_scale=min_max_scale,
                 scale_f1=f1, scale_f2=f2, nframes=nframes,
-                batch_size=batch_size, marginf=marginf)
+                batch_size=batch_size, marginf=marginf,
+                cmvn=cmvn)
     else:
         test_set_iterator = DatasetDTWWrdSpkrIterator(
                 data_same[test_split_at:], normalize=normalize,
                 min_max_scale=min_max_scale, scale_f1=f1, scale_f2=f2,
-                nframes=nframes, batch_size=batch_size, marginf=marginf)
+                nframes=nframes, batch_size=batch_size, marginf=marginf,
+                cmvn=cmvn)
 
     assert n_ins != None
     assert n_outs != None
@@ -303,150 +281,72 @@ def run(dataset_path=DEFAULT_DATASET, dataset_name='timit',
             train_fn = nnet.get_adagrad_trainer()
         else:
             train_fn = nnet.get_SGD_trainer()
-
-    train_scoref_w = nnet.score_classif_same_diff_word_separated(train_set_iterator)
-    valid_scoref_w = nnet.score_classif_same_diff_word_separated(valid_set_iterator)
-    test_scoref_w = nnet.score_classif_same_diff_word_separated(test_set_iterator)
-    train_scoref_s = nnet.score_classif_same_diff_spkr_separated(train_set_iterator)
-    valid_scoref_s = nnet.score_classif_same_diff_spkr_separated(valid_set_iterator)
-    test_scoref_s = nnet.score_classif_same_diff_spkr_separated(test_set_iterator)
-    data_iterator = train_set_iterator
+    if n_workers > 1:
+        if debug_plot or debug_print >= 3:
+            print >> sys.stderr, "debug outputs are not available with workers"
+            debug_plot = 0
+            debug_print = min(debug_print, 2)
+        if debug_time:
+            benchmark_scaling(nnet, trainer_type, train_set_iterator,
+                    sorted(set([2 ** i for i in xrange(int(numpy.log2(n_workers)))]
+                        + [n_workers])))
+        train_fn = DataParallelTrainer(nnet, trainer_type, n_workers)
+    tuned_batch_size = None
+    if autotune and resume_state is None:  # else restored with the checkpoint
+        tuned_batch_size = autotune_batch_size(nnet, train_fn, trainer_type,
+                train_set_iterator,
+                [max(1, batch_size / 4), max(1, batch_size / 2), batch_size,
+                    batch_size * 2, batch_size * 4],
+                max_memory_mb=max_batch_memory,
+                stats_file_name=output_file_name + '_epochs.jsonl')
 
     if debug_on_test_only:
         print >> sys.stderr, "NOT IMPLEMENTED"
         sys.exit(-1)
-        data_iterator = test_set_iterator
-        train_scoref_w = test_scoref_w
-        train_scoref_s = test_scoref_s
-
-    print '... training the model'
-    # early-stopping parameters
-    patience = 1000  # look as this many examples regardless TODO
-    patience_increase = 2.  # wait this much longer when a new best is
-                            # found
-    improvement_threshold = 0.995  # a relative improvement of this much is
-                                   # considered significant
 
-    best_validation_loss = numpy.inf
-    test_score = 0.
-    start_time = time.clock()
+    if hard_negatives:
+        transform_x1 = nnet.transform_x1()
+    first_epoch = [True]
 
-    done_looping = False
-    epoch = 0
-    lr = init_lr
-    timer = None
-    if debug_plot:
-        print_mean_weights_biases(nnet.params)
-    #with open(output_file_name + 'epoch_0.pickle', 'wb') as f:
-    #    cPickle.dump(nnet, f, protocol=-1)
-
-    while (epoch < max_epochs) and (not done_looping):
-        if REDTW and "ab_net" in network_type and ((epoch + 1) % 20) == 0:
+    def before_epoch(epoch):
+        if REDTW and "ab_net" in network_type and (epoch % REDTW_EVERY) == 0:
             print "recomputing DTW:"
-            data_iterator.recompute_DTW(nnet.transform_x1())
-
-        epoch = epoch + 1
-        avg_costs = []
-        avg_params_gradients_updates = []
-        if debug_time:
-            timer = time.time()
-        for iteration, (x, y) in enumerate(data_iterator):
-            #print "x[0][0]", x[0][0]
-            #print "x[1][0]", x[1][0]
-            #print "y[0][0]", y[0][0]
-            #print "y[1][0]", y[1][0]
-            avg_cost = 0.
-            if "delta" in trainer_type:  # TODO remove need for this if
-                avg_cost = train_fn(x[0], x[1], y[0], y[1])
-            else:
-                avg_cost = train_fn(x[0], x[1], y[0], y[1], lr)
-            if debug_print >= 3:
-                print "cost:", avg_cost[0]
-            if debug_plot >= 2:
-                plot_costs(avg_cost[0])
-                if not len(avg_params_gradients_updates):
-                    avg_params_gradients_updates = map(numpy.asarray, avg_cost[1:])
-                else:
-                    avg_params_gradients_updates = rolling_avg_pgu(
-                            iteration, avg_params_gradients_updates,
-                            map(numpy.asarray, avg_cost[1:]))
-            if debug_plot >= 3:
-                plot_params_gradients_updates(iteration, avg_cost[1:])
-            if type(avg_cost) == list:
-                avg_costs.append(avg_cost[0])
-            else:
-                avg_costs.append(avg_cost)
-        if debug_print >= 2:
-            print_mean_weights_biases(nnet.params)
-        if debug_plot >= 2:
-            plot_params_gradients_updates(epoch, avg_params_gradients_updates)
-        if debug_time:
-            print('  epoch %i took %f seconds' % (epoch, time.time() - timer))
-        avg_cost = numpy.mean(avg_costs)
-        if numpy.isnan(avg_cost):
-            print("avg costs is NaN so we're stopping here!")
-            break
-        print('  epoch %i, avg costs %f' % \
-              (epoch, avg_cost))
-        tmp_train = zip(*train_scoref_w())
-        print('  epoch %i, training sim same words %f, diff words %f' % \
-              (epoch, numpy.mean(tmp_train[0]), numpy.mean(tmp_train[1])))
-        tmp_train = zip(*train_scoref_s())
-        print('  epoch %i, training sim same spkrs %f, diff spkrs %f' % \
-              (epoch, numpy.mean(tmp_train[0]), numpy.mean(tmp_train[1])))
-        # TODO update lr(t) = lr(0) / (1 + lr(0) * lambda * t)
-        lr = numpy.float32(init_lr / (numpy.sqrt(iteration) + 1.)) ### TODO
-        #lr = numpy.float32(init_lr / (iteration + 1.)) ### TODO
-        # or another scheme for learning rate decay
-        #with open(output_file_name + 'epoch_' +str(epoch) + '.pickle', 'wb') as f:
-        #    cPickle.dump(nnet, f, protocol=-1)
-
-        if debug_on_test_only:
-            continue
-
-        # we check the validation loss on every epoch
-        validation_losses_w = zip(*valid_scoref_w())
-        validation_losses_s = zip(*valid_scoref_s())
-        this_validation_loss = 0.25*(1.-numpy.mean(validation_losses_w[0])) +\
-                0.25*numpy.mean(validation_losses_w[1]) +\
-                0.25*(1.-numpy.mean(validation_losses_s[0])) +\
-                0.25*numpy.mean(validation_losses_s[1])
-
-        print('  epoch %i, valid sim same words %f, diff words %f' % \
-              (epoch, numpy.mean(validation_losses_w[0]), numpy.mean(validation_losses_w[1])))
-        print('  epoch %i, valid sim same spkrs %f, diff spkrs %f' % \
-              (epoch, numpy.mean(validation_losses_s[0]), numpy.mean(validation_losses_s[1])))
-        # if we got the best validation score until now
-        if this_validation_loss < best_validation_loss:
-            with open(output_file_name + '.pickle', 'wb') as f:
-                cPickle.dump(nnet, f, protocol=-1)
-            # improve patience if loss improvement is good enough
-            if (this_validation_loss < best_validation_loss *
-                improvement_threshold):
-                patience = max(patience, iteration * patience_increase)
-            # save best validation score and iteration number
-            best_validation_loss = this_validation_loss
-            # test it on the test set
-            test_losses_w = zip(*test_scoref_w())
-            test_losses_s = zip(*test_scoref_s())
-            print('  epoch %i, test sim same words %f, diff words %f' % \
-                  (epoch, numpy.mean(test_losses_w[0]), numpy.mean(test_losses_w[1])))
-            print('  epoch %i, test sim same spkrs %f, diff spkrs %f' % \
-                  (epoch, numpy.mean(test_losses_s[0]), numpy.mean(test_losses_s[1])))
-        if patience <= iteration:  # TODO correct that
-            done_looping = True
-            break
-
-    end_time = time.clock()
-    print(('Optimization complete with best validation score of %f, '
-           'with test performance %f') %
-                 (best_validation_loss, test_score))
-    print >> sys.stderr, ('The fine tuning code for file ' +
-                          os.path.split(__file__)[1] +
-                          ' ran for %.2fm' % ((end_time - start_time)
-                                              / 60.))
-    with open(output_file_name + '_final.pickle', 'wb') as f:
-        cPickle.dump(nnet, f, protocol=-1)
+            train_set_iterator.recompute_DTW(nnet.transform_x1(),
+                    threshold=REDTW_THRESHOLD)
+        if hard_negatives and (epoch % hard_negatives == 0 or
+                (first_epoch[0] and epoch > hard_negatives)):  # resuming
+            print "mining hard negatives:"
+            train_set_iterator.mine_hard_negatives(transform_x1)
+        first_epoch[0] = False
+
+    train_scored_set = train_set_iterator
+    valid_scored_set = valid_set_iterator
+    test_scored_set = test_set_iterator
+    ci = score_subset > 0
+    if ci:
+        train_scored_set = DatasetSubsetIterator(train_set_iterator, score_subset)
+        valid_scored_set = DatasetSubsetIterator(valid_set_iterator, score_subset)
+        test_scored_set = DatasetSubsetIterator(test_set_iterator, score_subset)
+
+    engine = TrainingEngine(nnet, train_fn, trainer_type, train_set_iterator,
+            output_file_name, init_lr=init_lr, max_epochs=max_epochs,
+            train_score=same_diff_word_spkr(
+                nnet.score_classif_same_diff_word_spkr(train_scored_set),
+                "training sim", ci=ci),
+            valid_score=same_diff_word_spkr(
+                nnet.score_classif_same_diff_word_spkr(valid_scored_set),
+                "valid sim", ci=ci),
+            test_score=same_diff_word_spkr(
+                nnet.score_classif_same_diff_word_spkr(test_scored_set),
+                "test sim", ci=ci),
+            lr_decay=True, patience=1000, before_epoch=before_epoch,
+            async_scoring=async_scoring,
+            data_rng_state=data_rng, batch_size=tuned_batch_size,
+            debug_print=debug_print, debug_time=debug_time,
+            debug_plot=debug_plot)
+    if resume_state is not None:
+        engine.restore(resume_state)
+    engine.run()
 
 if __name__=='__main__':
     arguments = docopt.docopt(__doc__, version='run_exp version 0.1')
@@ -506,6 +406,30 @@ if __name__=='__main__':
     debug_plot = 0
     if arguments['--debug-plot']:
         debug_plot = int(arguments['--debug-plot'])
+    resume = False
+    if arguments['--resume']:
+        resume = True
+    autotune = False
+    if arguments['--autotune']:
+        autotune = True
+    max_batch_memory = 1024
+    if arguments['--max-batch-memory']:
+        max_batch_memory = int(arguments['--max-batch-memory'])
+    hard_negatives = 0
+    if arguments['--hard-negatives']:
+        hard_negatives = int(arguments['--hard-negatives'])
+    n_workers = 1
+    if arguments['--workers']:
+        n_workers = int(arguments['--workers'])
+    async_scoring = False
+    if arguments['--async-scoring']:
+        async_scoring = True
+    score_subset = 0
+    if arguments['--score-subset']:
+        score_subset = int(arguments['--score-subset'])
+    cmvn = None
+    if arguments['--cmvn']:
+        cmvn = CMVN(arguments['--cmvn'])
 
     run(dataset_path=dataset_path, dataset_name=dataset_name,
         iterator_type=iterator_type, batch_size=batch_size,
@@ -533,7 +457,15 @@ if __name__=='__main__':
         debug_on_test_only=debug_on_test_only,
         debug_print=debug_print,
         debug_time=debug_time,
-        debug_plot=debug_plot)
+        debug_plot=debug_plot,
+        autotune=autotune,
+        max_batch_memory=max_batch_memory,
+        hard_negatives=hard_negatives,
+        n_workers=n_workers,
+        async_scoring=async_scoring,
+        score_subset=score_subset,
+        cmvn=cmvn,
+        resume=resume)
     # TODO I-vector features that are averaged at least on a whole word (UBM like)
 
     #THEANO_FLAGS='device=gpu0' python run_exp_AB_phn_spkr.py --dataset-path=LUCID_9chars.joblib --dataset-name=LUCID_9chars --nframes=7 --network-type=abnet --debug-print=1 --debug-time
@@ -6,7 +6,7 @@ Usage:
     [--features=fbank] [--init-lr=0.001] [--epochs=500] 
     [--network-type=dropout_net] [--trainer-type=adadelta] 
     [--prefix-output-fname=my_prefix_42] [--debug-print=0] 
-    [--debug-time] [--debug-plot=0]
+    [--debug-time] [--debug-plot=0] [--resume]
 
 
 Options:
@@ -40,6 +40,8 @@ Options:
     default is False, using it makes it True
     --debug-plot=int           Level of debug plotting, 1: costs
     default is 0               >= 2: gradients & updates
+    --resume                   Flag that resumes training from the last
+    default is False           resumable checkpoint of this output file name
 """
 
 import socket, docopt, cPickle, time, sys, os
@@ -59,79 +61,13 @@ from layers import Linear, ReLU, SigmoidLayer, SoftPlus
 from classifiers import LogisticRegression
 from nnet_archs import ABNeuralNet2Outputs
 from nnet_archs import DropoutABNeuralNet # TODO
+from training_engine import TrainingEngine, same_diff_word_spkr
+from training_engine import load_resume_state, data_rng_state
 
-DEBUG = False
 
 DIM_EMBEDDING = 100
 
 
-def print_mean_weights_biases(params):
-    for layer_ind, param in enumerate(params):
-        filler = "weight"
-        if layer_ind % 2:
-            filler = "bias"
-        print("layer %i mean %s values %f and std devs %f" % (layer_ind/2, 
-            filler, numpy.mean(param.eval()), numpy.std(param.eval())))
-
-
-def plot_costs(cost):
-    # TODO
-    pass
-
-
-def rolling_avg_pgu(iteration, pgu, l):
-    # (iteration * pgu + l) / (iteration + 1)
-    assert len(l) == len(pgu)
-    ll = len(l)/3
-    params, gparams, updates = l[:ll], l[ll:-ll], l[-ll:]
-    mpars, mgpars, mupds = pgu[:ll], pgu[ll:-ll], pgu[-ll:]
-    ii = iteration + 1
-    return [(iteration * mpars[k] + p) / ii for k, p in enumerate(params)] +\
-            [(iteration * mgpars[k] + g) / ii for k, g in enumerate(gparams)] +\
-            [(iteration * mupds[k] + u) / ii for k, u in enumerate(updates)]
-
-
-def plot_params_gradients_updates(n, l):
-    # TODO currently works only with THEANO_FLAGS="device=cpu" (not working on
-    #CudaNDArrays), debug only
-    def plot_helper(li, ti, p):
-        if ppl == None:
-            print >> sys.stderr, "cannot plot this without prettyplotlib"
-            return
-        fig, ax = plt.subplots(1)
-        if li % 2:
-            title = "biases" + ti
-            ppl.bar(ax, numpy.arange(p.shape[0]), p) # TODO with plt
-        else:
-            title = "weights" + ti
-            ppl.pcolormesh(fig, ax, p) # TODO with plt
-        plt.title(title)
-        plt.savefig(title + ".png")
-        #ppl.show()
-        plt.close()
-    ll = len(l)/3
-    params, gparams, updates = l[:ll], l[ll:-ll], l[-ll:]
-    if DEBUG:
-        print "params"
-        print params
-        print "===================="
-        print "gparams"  # TODO find out why not CudaNDArray here
-        print gparams
-        print "===================="
-        print "updates"  # TODO find out why not CudaNDArray here
-        print updates
-    title_iter =  "_%04i" % n
-    for layer_ind, param in enumerate(params):
-        title = "_for_layer_" + str(layer_ind/3) + title_iter
-        plot_helper(layer_ind, title, param)
-    for layer_ind, gparam in enumerate(gparams):
-        title = "_gradients_for_layer_" + str(layer_ind/3) + title_iter
-        plot_helper(layer_ind, title, gparam)
-    for layer_ind, update in enumerate(updates):
-        title = "_updates_for_layer_" + str(layer_ind/3) + title_iter
-        plot_helper(layer_ind, title, update)
-
-
 def run(dataset_path="from_aren.joblib", dataset_name='timit',
         batch_size=100,
         nframes=13, features="fbank",
@@ -145,7 +81,8 @@ def run(dataset_path="from_aren.joblib", dataset_name='timit',
         prefix_fname='',
         debug_print=0,
         debug_time=False,
-        debug_plot=0):
+        debug_plot=0,
+        resume=False):
     """
     Configures and run the neural net on the given dataset.
     """
@@ -157,6 +94,10 @@ def run(dataset_path="from_aren.joblib", dataset_name='timit',
     output_file_name += "_" + network_type + "_" + trainer_type
     output_file_name += "_emb_" + str(DIM_EMBEDDING)
     print "output file name:", output_file_name
+    resume_state = None
+    if resume:
+        resume_state = load_resume_state(output_file_name)
+    data_rng = data_rng_state(resume_state)
 
     n_ins = None
     n_outs = None
@@ -250,109 +191,21 @@ def run(dataset_path="from_aren.joblib", dataset_name='timit',
         else:
             train_fn = nnet.get_SGD_trainer()
 
-    train_scoref_w = nnet.score_classif_same_diff_word_separated(train_set_iterator)
-    valid_scoref_w = nnet.score_classif_same_diff_word_separated(valid_set_iterator)
-    train_scoref_s = nnet.score_classif_same_diff_spkr_separated(train_set_iterator)
-    valid_scoref_s = nnet.score_classif_same_diff_spkr_separated(valid_set_iterator)
-    data_iterator = train_set_iterator
-
-    print '... training the model'
-    best_validation_loss = numpy.inf
-    test_score = 0.
-    start_time = time.clock()
-
-    epoch = 0
-    lr = init_lr
-    timer = None
-    if debug_plot:
-        print_mean_weights_biases(nnet.params)
-    #with open(output_file_name + 'epoch_0.pickle', 'wb') as f:
-    #    cPickle.dump(nnet, f, protocol=-1)
-
-    while (epoch < max_epochs):
-        epoch = epoch + 1
-        avg_costs = []
-        avg_params_gradients_updates = []
-        if debug_time:
-            timer = time.time()
-        for iteration, (x, y) in enumerate(data_iterator):
-            #print "x[0][0]", x[0][0]
-            #print "x[1][0]", x[1][0]
-            #print "y[0][0]", y[0][0]
-            #print "y[1][0]", y[1][0]
-            avg_cost = 0.
-            if "delta" in trainer_type:  # TODO remove need for this if
-                avg_cost = train_fn(x[0], x[1], y[0], y[1])
-            else:
-                avg_cost = train_fn(x[0], x[1], y[0], y[1], lr)
-            if debug_print >= 3:
-                print "cost:", avg_cost[0]
-            if debug_plot >= 2:
-                plot_costs(avg_cost[0])
-                if not len(avg_params_gradients_updates):
-                    avg_params_gradients_updates = map(numpy.asarray, avg_cost[1:])
-                else:
-                    avg_params_gradients_updates = rolling_avg_pgu(
-                            iteration, avg_params_gradients_updates,
-                            map(numpy.asarray, avg_cost[1:]))
-            if debug_plot >= 3:
-                plot_params_gradients_updates(iteration, avg_cost[1:])
-            if type(avg_cost) == list:
-                avg_costs.append(avg_cost[0])
-            else:
-                avg_costs.append(avg_cost)
-        if debug_print >= 2:
-            print_mean_weights_biases(nnet.params)
-        if debug_plot >= 2:
-            plot_params_gradients_updates(epoch, avg_params_gradients_updates)
-        if debug_time:
-            print('  epoch %i took %f seconds' % (epoch, time.time() - timer))
-        avg_cost = numpy.mean(avg_costs)
-        if numpy.isnan(avg_cost):
-            print("avg costs is NaN so we're stopping here!")
-            break
-        print('  epoch %i, avg costs %f' % \
-              (epoch, avg_cost))
-        tmp_train = zip(*train_scoref_w())
-        print('  epoch %i, training sim same words %f, diff words %f' % \
-              (epoch, numpy.mean(tmp_train[0]), numpy.mean(tmp_train[1])))
-        tmp_train = zip(*train_scoref_s())
-        print('  epoch %i, training sim same spkrs %f, diff spkrs %f' % \
-              (epoch, numpy.mean(tmp_train[0]), numpy.mean(tmp_train[1])))
-        # TODO update lr(t) = lr(0) / (1 + lr(0) * lambda * t)
-        lr = numpy.float32(init_lr / (numpy.sqrt(iteration) + 1.)) ### TODO
-        # or another scheme for learning rate decay
-        #with open(output_file_name + 'epoch_' +str(epoch) + '.pickle', 'wb') as f:
-        #    cPickle.dump(nnet, f, protocol=-1)
-
-        # we check the validation loss on every epoch
-        validation_losses_w = zip(*valid_scoref_w())
-        validation_losses_s = zip(*valid_scoref_s())
-        this_validation_loss = 0.25*(1.-numpy.mean(validation_losses_w[0])) +\
-                0.25*numpy.mean(validation_losses_w[1]) +\
-                0.25*(1.-numpy.mean(validation_losses_s[0])) +\
-                0.25*numpy.mean(validation_losses_s[1])
-
-        print('  epoch %i, valid sim same words %f, diff words %f' % \
-              (epoch, numpy.mean(validation_losses_w[0]), numpy.mean(validation_losses_w[1])))
-        print('  epoch %i, valid sim same spkrs %f, diff spkrs %f' % \
-              (epoch, numpy.mean(validation_losses_s[0]), numpy.mean(validation_losses_s[1])))
-        # if we got the best validation score until now
-        if this_validation_loss < best_validation_loss:
-            with open(output_file_name + '.pickle', 'wb') as f:
-                cPickle.dump(nnet, f, protocol=-1)
-            # save best validation score and iteration number
-            best_validation_loss = this_validation_loss
-
-    end_time = time.clock()
-    print(('Optimization complete with best validation score of %f, ') %
-                 (best_validation_loss))
-    print >> sys.stderr, ('The fine tuning code for file ' +
-                          os.path.split(__file__)[1] +
-                          ' ran for %.2fm' % ((end_time - start_time)
-                                              / 60.))
-    with open(output_file_name + '_final.pickle', 'wb') as f:
-        cPickle.dump(nnet, f, protocol=-1)
+    engine = TrainingEngine(nnet, train_fn, trainer_type, train_set_iterator,
+            output_file_name, init_lr=init_lr, max_epochs=max_epochs,
+            train_score=same_diff_word_spkr(
+                nnet.score_classif_same_diff_word_spkr(train_set_iterator),
+                "training sim"),
+            valid_score=same_diff_word_spkr(
+                nnet.score_classif_same_diff_word_spkr(valid_set_iterator),
+                "valid sim"),
+            lr_decay=True,
+            data_rng_state=data_rng,
+            debug_print=debug_print, debug_time=debug_time,
+            debug_plot=debug_plot)
+    if resume_state is not None:
+        engine.restore(resume_state)
+    engine.run()
 
 if __name__=='__main__':
     arguments = docopt.docopt(__doc__, version='run_exp version 0.1')
@@ -398,6 +251,9 @@ if __name__=='__main__':
     debug_plot = 0
     if arguments['--debug-plot']:
         debug_plot = int(arguments['--debug-plot'])
+    resume = False
+    if arguments['--resume']:
+        resume = True
 
     run(dataset_path=dataset_path, dataset_name=dataset_name,
         batch_size=batch_size, nframes=nframes, features=features,
@@ -409,7 +265,8 @@ if __name__=='__main__':
         prefix_fname=prefix_fname,
         debug_print=debug_print,
         debug_time=debug_time,
-        debug_plot=debug_plot)
+        debug_plot=debug_plot,
+        resume=resume)
     # TODO I-vector features that are averaged at least on a whole word (UBM like)
 
     #THEANO_FLAGS='device=gpu0' python run_exp_STD.py --dataset-path=from_aren.joblib --dataset-name=buckeye_STD --nframes=7 --network-type=AB --loss=cos_cos2_w --debug-print=1 --debug-time
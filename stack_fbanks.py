@@ -1,34 +1,38 @@
 """python stack_fbanks.py npz7_train/*.npy
+python stack_fbanks.py --archive timit_train_fbanks timit_train_fbanks7
+
+The second form stacks all the utterances of a features archive (see
+features_archive.py) into another archive (whose frames times are
+k * FEATURES_RATE + FEATURES_RATE / 2).
 """
 
 import sys
 import numpy as np
+from features_archive import FeaturesArchive, ArchiveWriter
+from embedding_pipeline import stack as stack_nframes
 
 NFRAMES = 7
-b_a = (NFRAMES - 1) / 2
 FRAMES_PER_SEC = 100  # features frames per second
 FEATURES_RATE = 1. / FRAMES_PER_SEC
 
-for fname in sys.argv[1:]:
-    fbanks = np.load(fname)
-    fbanks_s = np.zeros((fbanks.shape[0], fbanks.shape[1] * NFRAMES),
-            dtype='float32')
-    for i in xrange(b_a + 1):
-        fbanks_s[i] = np.pad(fbanks[max(0, i - b_a):i + b_a + 1].flatten(),
-                (max(0, (b_a - i) * fbanks.shape[1]),
-                    max(0, ((i+b_a+1) - fbanks.shape[0]) * fbanks.shape[1])),
-                'constant', constant_values=(0, 0))
-    for i in xrange(b_a + 1, fbanks.shape[0] - b_a):
-        fbanks_s[i] = fbanks[i - b_a:i + b_a + 1].flatten()
-    for i in xrange(fbanks.shape[0] - b_a - 1, fbanks.shape[0]):
-        fbanks_s[i] = np.pad(fbanks[max(0, i - b_a):i + b_a + 1].flatten(),
-                (max(0, (b_a - i) * fbanks.shape[1]),
-                    max(0, ((i+b_a+1) - fbanks.shape[0]) * fbanks.shape[1])),
-                'constant', constant_values=(0, 0))
-    time_table = np.zeros(fbanks_s.shape[0])
-    for i in xrange(time_table.shape[0]):
-        time_table[i] = float(i) / FRAMES_PER_SEC + FEATURES_RATE / 2
-    np.savez(fname.split('.')[0] + '.npz',
-            features=fbanks_s,
-            time=time_table)
 
+def stack(fbanks):
+    return stack_nframes(fbanks, NFRAMES)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--archive':
+        archive = FeaturesArchive(sys.argv[2])
+        with ArchiveWriter(sys.argv[3], archive.dim * NFRAMES,
+                archive.features.dtype) as writer:
+            for name, speaker, fbanks in archive.utterances():
+                writer.write(name, stack(fbanks), speaker)
+        sys.exit(0)
+    for fname in sys.argv[1:]:
+        fbanks_s = stack(np.load(fname))
+        time_table = np.zeros(fbanks_s.shape[0])
+        for i in xrange(time_table.shape[0]):
+            time_table[i] = float(i) / FRAMES_PER_SEC + FEATURES_RATE / 2
+        np.savez(fname.split('.')[0] + '.npz',
+                features=fbanks_s,
+                time=time_table)
@@ -0,0 +1,747 @@
+"""
+The epoch loop shared by all the run_exp_* drivers.
+
+A TrainingEngine takes a compiled train_fn (or a DataParallelTrainer), the
+training iterator and scoring callbacks, and does the training passes, the
+learning rate decay, the early stopping and the checkpointing (pickling) of
+the best nnet. The wall-clock time of each epoch is split between:
+ - fetch: getting the batches out of the data iterator,
+ - train: the train_fn calls,
+ - score: the train/valid/test scoring callbacks,
+ - checkpoint: pickling the nnet,
+and one JSON record per epoch (with frames/sec and pairs/sec of the training
+pass) is appended to output_file_name + '_epochs.jsonl':
+
+    engine = TrainingEngine(nnet, train_fn, trainer_type, data_iterator,
+            output_file_name, train_score=same_diff_word_spkr(
+                nnet.score_classif_same_diff_word_spkr(train_set_iterator),
+                "training sim"), ...)
+    engine.run()
+
+A scoring callback takes the epoch number, prints what it wants and returns a
+dict of metrics; the validation one must have a 'loss' entry (lower is
+better) and the test one may have a 'score' entry (reported at the end).
+With resume_every=N, a resumable checkpoint (output_file_name +
+'_resume.pickle') with the parameters, the Adadelta accumulators, the RNG
+states (including the dropout ones of the DataParallelTrainer workers), the
+autotuned batch size and the early stopping state is written every N epochs. The drivers
+restore it with --resume:
+
+    resume_state = None
+    if resume:
+        resume_state = load_resume_state(output_file_name)
+    data_rng = data_rng_state(resume_state)  # before loading the data
+    ...
+    engine = TrainingEngine(..., data_rng_state=data_rng)
+    if resume_state is not None:
+        engine.restore(resume_state)
+
+The data order (shuffles and sampling of the pairs by the iterators) is
+reproduced by restoring the states of the RNGs before the data is loaded.
+
+The scoring can be done asynchronously (async_scoring=True) in a forked
+process, and on a fixed random subset of the batches (see
+dataset_iterators.DatasetSubsetIterator and the ci argument of the scoring
+callbacks for confidence intervals).
+
+The batch size can be chosen, before training, by timing train_fn on a few
+batches of the real data for several batch sizes (autotune_batch_size).
+"""
+
+import sys, os, time, json, cPickle, random
+import numpy
+from multiprocessing import Process, Pipe
+from theano.tensor.shared_randomstreams import RandomStateSharedVariable
+try:
+    import matplotlib.pyplot as plt
+except:
+    plt = None
+try:
+    import prettyplotlib as ppl
+except:
+    ppl = None
+
+from data_parallel import symbolic_inputs
+
+DEBUG = False
+
+
+def print_mean_weights_biases(params):
+    for layer_ind, param in enumerate(params):
+        filler = "weight"
+        if layer_ind % 2:
+            filler = "bias"
+        print("layer %i mean %s values %f and std devs %f" % (layer_ind/2,
+            filler, numpy.mean(param.eval()), numpy.std(param.eval())))
+
+
+def plot_costs(cost):
+    # TODO
+    pass
+
+
+def rolling_avg_pgu(iteration, pgu, l):
+    # (iteration * pgu + l) / (iteration + 1)
+    assert len(l) == len(pgu)
+    ll = len(l)/3
+    params, gparams, updates = l[:ll], l[ll:-ll], l[-ll:]
+    mpars, mgpars, mupds = pgu[:ll], pgu[ll:-ll], pgu[-ll:]
+    ii = iteration + 1
+    return [(iteration * mpars[k] + p) / ii for k, p in enumerate(params)] +\
+            [(iteration * mgpars[k] + g) / ii for k, g in enumerate(gparams)] +\
+            [(iteration * mupds[k] + u) / ii for k, u in enumerate(updates)]
+
+
+def plot_params_gradients_updates(n, l):
+    # TODO currently works only with THEANO_FLAGS="device=cpu" (not working on
+    #CudaNDArrays), debug only
+    def plot_helper(li, ti, p):
+        if ppl == None or plt == None:
+            print >> sys.stderr, "cannot plot this without prettyplotlib"
+            return
+        fig, ax = plt.subplots(1)
+        if li % 2:
+            title = "biases" + ti
+            ppl.bar(ax, numpy.arange(p.shape[0]), p) # TODO with plt
+        else:
+            title = "weights" + ti
+            ppl.pcolormesh(fig, ax, p) # TODO with plt
+        plt.title(title)
+        plt.savefig(title + ".png")
+        #ppl.show()
+        plt.close()
+    ll = len(l)/3
+    params, gparams, updates = l[:ll], l[ll:-ll], l[-ll:]
+    if DEBUG:
+        print "params"
+        print params
+        print "===================="
+        print "gparams"
+        print gparams
+        print "===================="
+        print "updates"
+        print updates
+        print "===================="
+    title_iter = "_iter_" + str(n)
+    for layer_ind, param in enumerate(params):
+        title = "_for_layer_" + str(layer_ind/3) + title_iter
+        plot_helper(layer_ind, title, param)
+    for layer_ind, gparam in enumerate(gparams):
+        title = "_gradients_for_layer_" + str(layer_ind/3) + title_iter
+        plot_helper(layer_ind, title, gparam)
+    for layer_ind, update in enumerate(updates):
+        title = "_updates_for_layer_" + str(layer_ind/3) + title_iter
+        plot_helper(layer_ind, title, update)
+
+
+def rng_states():
+    """ Returns the states of the random and numpy.random global RNGs. """
+    return {'random': random.getstate(), 'numpy': numpy.random.get_state()}
+
+
+def set_rng_states(states):
+    random.setstate(states['random'])
+    numpy.random.set_state(states['numpy'])
+
+
+def load_resume_state(output_file_name):
+    """ Loads the resumable checkpoint of output_file_name, if any. """
+    fname = output_file_name + '_resume.pickle'
+    if not os.path.exists(fname):
+        print >> sys.stderr, "no checkpoint to resume from in", fname
+        return None
+    print "resuming from", fname
+    with open(fname, 'rb') as f:
+        return cPickle.load(f)
+
+
+def data_rng_state(resume_state=None):
+    """ To be called before the data is loaded: sets the global RNGs to
+    the state that they had when the data of resume_state was loaded (so that
+    the shuffles and the sampling of the pairs are the same), and returns the
+    state to save in the new checkpoints. """
+    if resume_state is not None:
+        set_rng_states(resume_state['data_rng'])
+    return rng_states()
+
+
+def batch_args(n_inputs, x, y):
+    """ (x, y) as yielded by the iterators -> train_fn arguments (without
+    the learning rate), n_inputs being len(symbolic_inputs(nnet)). """
+    if n_inputs == 2:  # NeuralNet
+        return [x, y]
+    if n_inputs == 3:  # ABNeuralNet
+        return [x[0], x[1], y]
+    return [x[0], x[1], y[0], y[1]]  # ABNeuralNet2Outputs
+
+
+def batch_frames_pairs(n_inputs, x):
+    """ Number of frames and of pairs (rows) in the batch x. """
+    if n_inputs == 2:
+        return len(x), len(x)
+    return len(x[0]) + len(x[1]), len(x[0])
+
+
+def batch_memory(nnet, rows):
+    """ Rough estimate (in bytes) of the memory that a train_fn call takes
+    for a batch of rows (pairs) rows: the inputs and the activations of all
+    the layers, and as much for their gradients, for each side of the
+    AB nets. """
+    widths = [p.get_value(borrow=True).shape for p in nnet.params
+            if p.ndim == 2]
+    units = widths[0][0] + sum(w[1] for w in widths)
+    sides = 1 if len(symbolic_inputs(nnet)) == 2 else 2
+    return rows * units * sides * 2 * numpy.dtype(nnet.params[0].dtype).itemsize
+
+
+def autotune_batch_size(nnet, train_fn, trainer_type, data_iterator,
+        batch_sizes, max_memory_mb=1024, n_batches=5,
+        lr=numpy.float32(0.01), stats_file_name=None, out=sys.stdout):
+    """ Times n_batches train_fn calls on data_iterator (that must have a
+    set_batch_size method) for each of the batch_sizes, prints the measured
+    frames/sec curve (and appends it to stats_file_name, if any), and sets
+    the batch size of data_iterator to the fastest one whose estimated memory
+    (see batch_memory) fits in max_memory_mb. The parameters, accumulators
+    and dropout RNGs of nnet are restored afterwards, returns the batch size.
+    """
+    if not hasattr(data_iterator, 'set_batch_size'):
+        print >> sys.stderr, "the batch size of", type(data_iterator).__name__,\
+                "can not be autotuned"
+        return None
+    n_inputs = len(symbolic_inputs(nnet))
+    shared = nnet.params + nnet._accugrads + nnet._accudeltas
+    if hasattr(train_fn, 'maker'):
+        shared = shared + [inp.variable for inp in train_fn.maker.inputs
+                if isinstance(inp.variable, RandomStateSharedVariable)]
+    state = [v.get_value() for v in shared]
+    if hasattr(train_fn, 'get_random_streams'):  # DataParallelTrainer
+        workers_streams = train_fn.get_random_streams()
+    extra = [] if "delta" in trainer_type else [lr]
+    curve = []
+    for batch_size in sorted(set(batch_sizes)):
+        data_iterator.set_batch_size(batch_size)
+        batches = []
+        for x, y in data_iterator:
+            batches.append((batch_args(n_inputs, x, y),
+                batch_frames_pairs(n_inputs, x)))
+            if len(batches) > n_batches:  # + 1 for the warm-up
+                break
+        rows = max(pairs for _, (frames, pairs) in batches)
+        point = {'batch_size': batch_size, 'max_rows': rows,
+                'memory_mb': batch_memory(nnet, rows) / 2.**20}
+        curve.append(point)
+        if point['memory_mb'] > max_memory_mb:
+            point['frames_per_sec'] = None
+            continue
+        train_fn(*(batches[0][0] + extra))  # warm-up (allocations)
+        frames = 0
+        timer = time.time()
+        for args, (f, _) in batches[1:] or batches:
+            train_fn(*(args + extra))
+            frames += f
+        point['frames_per_sec'] = frames / (time.time() - timer)
+        for v, s in zip(shared, state):
+            v.set_value(s)
+        if hasattr(train_fn, '_sync_params'):  # DataParallelTrainer
+            train_fn._sync_params()
+            train_fn.set_random_streams(workers_streams)
+    if hasattr(train_fn, 'reset_stats'):
+        train_fn.reset_stats()
+    fits = [p for p in curve if p['frames_per_sec'] is not None]
+    if not len(fits):
+        print >> sys.stderr, "no batch size fits in", max_memory_mb, "MB"
+        best = curve[0]
+    else:
+        best = max(fits, key=lambda p: p['frames_per_sec'])
+    print >> out, "batch size  rows  memory (MB)  frames/sec"
+    for p in curve:
+        print >> out, "%10i  %4i  %11.1f  %10s" % (p['batch_size'],
+                p['max_rows'], p['memory_mb'], "over cap"
+                if p['frames_per_sec'] is None
+                else "%.1f" % p['frames_per_sec'])
+    print >> out, "using a batch size of", best['batch_size']
+    if stats_file_name is not None:
+        with open(stats_file_name, 'a') as f:
+            f.write(json.dumps({'autotune': curve,
+                'batch_size': best['batch_size']}) + '\n')
+    data_iterator.set_batch_size(best['batch_size'])
+    return best['batch_size']
+
+
+def confidence_interval(values, z=1.96):
+    """ Half-width of the (normal approximation, 95% by default) confidence
+    interval of the mean of values. """
+    if len(values) < 2:
+        return numpy.inf
+    return z * numpy.std(values, ddof=1) / numpy.sqrt(len(values))
+
+
+def score_same_diff(scoref, epoch, desc, what="", ci=False):
+    """ Prints and returns the mean (same, diff) of a scoring function that
+    returns a list of per-batch [same, diff] (score_classif_same_diff_*),
+    followed by the half-widths of their confidence intervals (printed if ci,
+    e.g. when scoring on a DatasetSubsetIterator). """
+    scores = zip(*scoref())
+    same, diff = numpy.mean(scores[0]), numpy.mean(scores[1])
+    same_ci, diff_ci = confidence_interval(scores[0]), confidence_interval(scores[1])
+    suffix = ""
+    if what != "":
+        suffix = " " + what
+    if ci:
+        print('  epoch %i, %s same%s %f (+/- %f), diff%s %f (+/- %f)' % \
+              (epoch, desc, suffix, same, same_ci, suffix, diff, diff_ci))
+    else:
+        print('  epoch %i, %s same%s %f, diff%s %f' % \
+              (epoch, desc, suffix, same, suffix, diff))
+    return same, diff, same_ci, diff_ci
+
+
+def same_diff(scoref, desc, ci=False):
+    """ Scoring callback for the AB nets: the validation loss is the mean of
+    the dissimilarity of "same" pairs and the similarity of "diff" ones. """
+    def score(epoch):
+        same, diff, same_ci, diff_ci = score_same_diff(scoref, epoch, desc,
+                ci=ci)
+        metrics = {'same': same, 'diff': diff,
+                   'loss': 0.5*(1.-same) + 0.5*diff}
+        if ci:
+            metrics.update({'same_ci': same_ci, 'diff_ci': diff_ci,
+                'loss_ci': 0.5*same_ci + 0.5*diff_ci})
+        return metrics
+    return score
+
+
+def ratio_confidence_interval(sums, counts, z=1.96):
+    """ Half-width of the confidence interval of sum(sums) / sum(counts),
+    with the batches as sampling units (ratio estimator). """
+    sums = numpy.asarray(sums, dtype='float64')
+    counts = numpy.asarray(counts, dtype='float64')
+    n = len(sums)
+    if n < 2 or counts.sum() == 0:
+        return numpy.inf
+    ratio = sums.sum() / counts.sum()
+    var = numpy.sum((sums - ratio * counts) ** 2) / (n - 1)
+    return z * numpy.sqrt(var / n) / counts.mean()
+
+
+def same_diff_word_spkr(scoref, desc, what=("words", "spkrs"), ci=False):
+    """ Scoring callback for the ABNeuralNet2Outputs (word and speaker
+    embeddings) from the per-batch sums and counts of
+    score_classif_same_diff_word_spkr (one pass on the set, exact means).
+    The validation loss is weighted equally on words and speakers. """
+    def score(epoch):
+        stats = zip(*scoref())
+        means = []
+        cis = []
+        for k in xrange(0, 8, 2):
+            n = numpy.sum(stats[k + 1])
+            means.append(numpy.sum(stats[k], dtype='float64') / n
+                    if n else numpy.nan)
+            cis.append(ratio_confidence_interval(stats[k], stats[k + 1]))
+        same_w, diff_w, same_s, diff_s = means
+        for (same, diff, same_ci, diff_ci), w in zip([means[:2] + cis[:2],
+            means[2:] + cis[2:]], what):
+            if ci:
+                print('  epoch %i, %s same %s %f (+/- %f), diff %s %f (+/- %f)' % \
+                      (epoch, desc, w, same, same_ci, w, diff, diff_ci))
+            else:
+                print('  epoch %i, %s same %s %f, diff %s %f' % \
+                      (epoch, desc, w, same, w, diff))
+        metrics = {'same_' + what[0]: same_w, 'diff_' + what[0]: diff_w,
+                   'same_' + what[1]: same_s, 'diff_' + what[1]: diff_s,
+                   'loss': 0.25*(1.-same_w) + 0.25*diff_w +
+                           0.25*(1.-same_s) + 0.25*diff_s}
+        if ci:
+            metrics.update({'same_' + what[0] + '_ci': cis[0],
+                'diff_' + what[0] + '_ci': cis[1],
+                'same_' + what[1] + '_ci': cis[2],
+                'diff_' + what[1] + '_ci': cis[3],
+                # upper bound (the 4 scores are not independent)
+                'loss_ci': 0.25*sum(cis)})
+        return metrics
+    return score
+
+
+class TrainingEngine(object):
+    """ Runs the epochs of training of nnet with train_fn on data_iterator.
+
+    train_score, valid_score and test_score are scoring callbacks (see the
+    module docstring), valid_score=None disables early stopping and
+    checkpointing of the best model (e.g. for --debug-test), test_score is
+    only called when the validation loss improves.
+    lr_decay: lr = init_lr / (sqrt(iteration) + 1) after each epoch.
+    patience: number of iterations to look at regardless, None for no early
+    stopping (all the max_epochs epochs are done).
+    before_epoch: callback(epoch) called before each training pass.
+    max_batches: stop each training pass after that many batches (debug).
+    resume_every: write a resumable checkpoint every resume_every epochs
+    (None for never), data_rng_state being the RNG states from before the
+    data was loaded (see data_rng_state()).
+    batch_size: the batch size set on data_iterator by autotune_batch_size
+    (None if not tuned), saved in the checkpoints and set again by restore().
+    async_scoring: score (and checkpoint) in a separate process, on a
+    snapshot of the parameters taken at the end of the epoch, while the
+    training goes on. Early stopping uses the results when they arrive, and
+    the epochs that end while the scoring process is busy are not scored.
+    """
+    def __init__(self, nnet, train_fn, trainer_type, data_iterator,
+            output_file_name, init_lr=0.01, max_epochs=500,
+            train_score=None, valid_score=None, test_score=None,
+            lr_decay=False, patience=None, patience_increase=2.,
+            improvement_threshold=0.995, before_epoch=None, max_batches=None,
+            resume_every=1, data_rng_state=None, batch_size=None,
+            async_scoring=False,
+            debug_print=0, debug_time=False, debug_plot=0,
+            stats_file_name=None):
+        self.nnet = nnet
+        self.train_fn = train_fn
+        self.trainer_type = trainer_type
+        self.data_iterator = data_iterator
+        self.output_file_name = output_file_name
+        self.init_lr = init_lr
+        self.max_epochs = max_epochs
+        self.train_score = train_score
+        self.valid_score = valid_score
+        self.test_score = test_score
+        self.lr_decay = lr_decay
+        self.patience = patience
+        self.patience_increase = patience_increase  # wait this much longer
+                                            # when a new best is found
+        self.improvement_threshold = improvement_threshold  # a relative
+                # improvement of this much is considered significant
+        self.before_epoch = before_epoch
+        self.max_batches = max_batches
+        self.resume_every = resume_every
+        self.data_rng_state = data_rng_state
+        self.batch_size = batch_size
+        self.async_scoring = async_scoring
+        self.debug_print = debug_print
+        self.debug_time = debug_time
+        self.debug_plot = debug_plot
+        if stats_file_name is None:
+            stats_file_name = output_file_name + '_epochs.jsonl'
+        self.stats_file_name = stats_file_name
+        self._n_inputs = len(symbolic_inputs(nnet))
+
+        self.epoch = 0
+        self.iteration = 0
+        self.lr = init_lr
+        self.best_validation_loss = numpy.inf
+        self.best_test_score = 0.
+        self.done_looping = False
+        self.diverged = False
+
+    def batch_args(self, x, y):
+        return batch_args(self._n_inputs, x, y)
+
+    def checkpoint(self, fname):
+        with open(fname, 'wb') as f:
+            cPickle.dump(self.nnet, f, protocol=-1)
+
+    def _random_streams(self):
+        """ The states of the RandomStreams (dropout) of train_fn (of each
+        of its workers for a DataParallelTrainer). """
+        if hasattr(self.train_fn, 'get_random_streams'):
+            return self.train_fn.get_random_streams()
+        return [inp.variable.get_value() for inp in self.train_fn.maker.inputs
+                if isinstance(inp.variable, RandomStateSharedVariable)]
+
+    def _set_random_streams(self, states):
+        if hasattr(self.train_fn, 'set_random_streams'):
+            if len(states):  # not in the older checkpoints
+                self.train_fn.set_random_streams(states)
+            return
+        for inp, value in zip([inp for inp in self.train_fn.maker.inputs
+                if isinstance(inp.variable, RandomStateSharedVariable)],
+                states):
+            inp.variable.set_value(value, borrow=True)
+
+    def get_state(self):
+        """ Everything that is needed to resume training at this epoch. """
+        return {'params': [v.get_value() for v in self.nnet.params +
+                    self.nnet._accugrads + self.nnet._accudeltas],
+                'random_streams': self._random_streams(),
+                'rng': rng_states(),
+                'data_rng': self.data_rng_state,
+                'batch_size': self.batch_size,
+                'engine': {'epoch': self.epoch, 'iteration': self.iteration,
+                    'lr': self.lr, 'patience': self.patience,
+                    'best_validation_loss': self.best_validation_loss,
+                    'best_test_score': self.best_test_score,
+                    'done_looping': self.done_looping}}
+
+    def save_resume_state(self):
+        fname = self.output_file_name + '_resume.pickle'
+        with open(fname + '.tmp', 'wb') as f:
+            cPickle.dump(self.get_state(), f, protocol=-1)
+        os.rename(fname + '.tmp', fname)  # atomic, never a truncated file
+
+    def restore(self, state):
+        """ Restores a state from get_state() (in a new process, with the
+        same nnet architecture and data). """
+        for v, value in zip(self.nnet.params + self.nnet._accugrads +
+                self.nnet._accudeltas, state['params']):
+            v.set_value(value, borrow=True)
+        self._set_random_streams(state['random_streams'])
+        if hasattr(self.train_fn, '_sync_params'):  # DataParallelTrainer
+            self.train_fn._sync_params()
+        if state.get('batch_size') is not None:  # autotuned
+            self.batch_size = state['batch_size']
+            self.data_iterator.set_batch_size(self.batch_size)
+            print "with the autotuned batch size of", self.batch_size
+        set_rng_states(state['rng'])
+        for k, v in state['engine'].iteritems():
+            setattr(self, k, v)
+        print "resuming after epoch", self.epoch
+
+    def train_epoch(self, timings):
+        """ One pass on data_iterator, returns (avg cost, frames, pairs). """
+        avg_costs = []
+        avg_params_gradients_updates = []
+        frames = 0
+        pairs = 0
+        with_lr = "delta" not in self.trainer_type  # TODO remove need for this
+        it = iter(self.data_iterator)
+        iteration = 0
+        while True:
+            t0 = time.time()
+            try:
+                x, y = next(it)
+            except StopIteration:
+                break
+            t1 = time.time()
+            args = self.batch_args(x, y)
+            if with_lr:
+                args.append(self.lr)
+            avg_cost = self.train_fn(*args)
+            t2 = time.time()
+            timings['fetch'] += t1 - t0
+            timings['train'] += t2 - t1
+            f, p = batch_frames_pairs(self._n_inputs, x)
+            frames += f
+            pairs += p
+            if self.debug_print >= 3:
+                print "cost:", avg_cost[0]
+            if self.debug_plot >= 2:
+                plot_costs(avg_cost[0])
+                if not len(avg_params_gradients_updates):
+                    avg_params_gradients_updates = map(numpy.asarray, avg_cost[1:])
+                else:
+                    avg_params_gradients_updates = rolling_avg_pgu(
+                            iteration, avg_params_gradients_updates,
+                            map(numpy.asarray, avg_cost[1:]))
+            if self.debug_plot >= 3:
+                plot_params_gradients_updates(iteration, avg_cost[1:])
+            if type(avg_cost) == list:
+                avg_costs.append(avg_cost[0])
+            else:
+                avg_costs.append(avg_cost)
+            self.iteration = iteration
+            iteration += 1
+            if self.max_batches is not None and iteration >= self.max_batches:
+                break
+        if self.debug_print >= 2:
+            print_mean_weights_biases(self.nnet.params)
+        if self.debug_plot >= 2:
+            plot_params_gradients_updates(self.epoch,
+                    avg_params_gradients_updates)
+        return numpy.mean(avg_costs), frames, pairs
+
+    def evaluate(self, epoch):
+        """ Scores the current parameters of nnet, checkpoints (and tests)
+        them if the validation loss improved, returns the metrics and the
+        time it took. Runs in the scoring process with async_scoring. """
+        result = {'checkpoint_seconds': 0.}
+        timer = time.time()
+        if self.train_score is not None:
+            result['train'] = self.train_score(epoch)
+        if self.valid_score is not None:
+            # we check the validation loss on every epoch
+            result['valid'] = self.valid_score(epoch)
+            this_validation_loss = result['valid']['loss']
+            # if we got the best validation score until now
+            result['improved'] = bool(this_validation_loss <
+                    self.best_validation_loss)
+            if result['improved']:
+                t0 = time.time()
+                self.checkpoint(self.output_file_name + '.pickle')
+                result['checkpoint_seconds'] = time.time() - t0
+                # is the improvement good enough to improve patience
+                result['significant'] = bool(this_validation_loss <
+                        self.best_validation_loss * self.improvement_threshold)
+                self.best_validation_loss = this_validation_loss
+                # test it on the test set
+                if self.test_score is not None:
+                    result['test'] = self.test_score(epoch)
+        result['score_seconds'] = (time.time() - timer -
+                result['checkpoint_seconds'])
+        return result
+
+    def apply(self, result, iteration):
+        """ Early stopping bookkeeping with the result of evaluate() for the
+        parameters at the end of iteration. """
+        if not result.get('improved', False):
+            return
+        # save best validation score and iteration number
+        self.best_validation_loss = result['valid']['loss']
+        if 'test' in result:
+            self.best_test_score = result['test'].get('score',
+                    self.best_test_score)
+        # improve patience if loss improvement is good enough
+        if self.patience is not None and result['significant']:
+            self.patience = max(self.patience,
+                    iteration * self.patience_increase)
+
+    def _start_scorer(self):
+        self._snapshot_vars = (self.nnet.params + self.nnet._accugrads +
+                self.nnet._accudeltas)
+        self._scorer, child_conn = Pipe()
+        self._scorer_process = Process(target=self._scoring_loop,
+                args=(child_conn,))
+        self._scorer_process.daemon = True
+        self._scorer_process.start()
+        self._pending = None
+        self._last_submitted = 0
+
+    def _scoring_loop(self, conn):
+        """ In the (forked) scoring process: loads the snapshots of the
+        parameters sent by the training process and evaluates them. """
+        while True:
+            msg = conn.recv()
+            if msg is None:
+                break
+            epoch, values = msg
+            for v, value in zip(self._snapshot_vars, values):
+                v.set_value(value, borrow=True)
+            conn.send(self.evaluate(epoch))
+        conn.close()
+
+    def _submit(self, record):
+        """ Sends a snapshot of the parameters to the scoring process, unless
+        it is still busy with a previous one (then this epoch is not scored
+        and False is returned). """
+        if self._pending is not None:
+            return False
+        self._scorer.send((record['epoch'],
+            [v.get_value() for v in self._snapshot_vars]))
+        self._pending = (record, self.iteration)
+        self._last_submitted = record['epoch']
+        return True
+
+    def _collect(self, block=False):
+        """ Applies the result of the scoring process if it arrived. """
+        if self._pending is None or not (block or self._scorer.poll()):
+            return
+        result = self._scorer.recv()
+        record, iteration = self._pending
+        self._pending = None
+        self.apply(result, iteration)
+        record.update(result)
+        self._write_record(record)
+
+    def run_epoch(self):
+        """ Trains for one epoch, scores and checkpoints. The epoch record is
+        appended to stats_file_name once it has been scored. """
+        if self.before_epoch is not None:
+            self.before_epoch(self.epoch + 1)
+        self.epoch += 1
+        epoch = self.epoch
+        timings = {'fetch': 0., 'train': 0.}
+        timer = time.time()
+        avg_cost, frames, pairs = self.train_epoch(timings)
+        train_time = time.time() - timer
+        record = {'epoch': epoch, 'lr': float(self.lr),
+                  'avg_cost': float(avg_cost), 'frames': frames,
+                  'pairs': pairs, 'seconds': train_time,
+                  'fetch_seconds': timings['fetch'],
+                  'train_seconds': timings['train'],
+                  'frames_per_sec': frames / max(train_time, 1.E-9),
+                  'pairs_per_sec': pairs / max(train_time, 1.E-9)}
+        if self.debug_time:
+            print('  epoch %i took %f seconds' % (epoch, train_time))
+            print('  epoch %i, %f frames/sec, %f pairs/sec' % \
+                    (epoch, record['frames_per_sec'], record['pairs_per_sec']))
+        if hasattr(self.train_fn, 'report'):  # DataParallelTrainer
+            rep = self.train_fn.report()
+            record['n_workers'] = rep['n_workers']
+            record['workers_utilization'] = rep['workers_utilization']
+            if self.debug_time:
+                print('  epoch %i, %f frames/sec with %i workers' % \
+                        (epoch, rep['frames_per_sec'], rep['n_workers']))
+            self.train_fn.reset_stats()
+        if numpy.isnan(avg_cost):
+            print("avg costs is NaN so we're stopping here!")
+            self.done_looping = True
+            self.diverged = True
+            self._write_record(record)
+            return
+        print('  epoch %i, avg costs %f' % \
+              (epoch, avg_cost))
+        if self.lr_decay:
+            # TODO update lr(t) = lr(0) / (1 + lr(0) * lambda * t)
+            self.lr = numpy.float32(self.init_lr /
+                    (numpy.sqrt(self.iteration) + 1.)) ### TODO
+
+        if self.async_scoring:
+            self._collect()
+            if not self._submit(record):
+                record['scored'] = False
+                self._write_record(record)
+        else:
+            result = self.evaluate(epoch)
+            record['seconds'] += result['score_seconds'] + \
+                    result['checkpoint_seconds']
+            self.apply(result, self.iteration)
+            record.update(result)
+        if (self.valid_score is not None and self.patience is not None and
+                self.patience <= self.iteration):
+            self.done_looping = True  # TODO correct that
+        if self.resume_every and epoch % self.resume_every == 0:
+            t0 = time.time()
+            self.save_resume_state()
+            record['resume_seconds'] = time.time() - t0
+        if not self.async_scoring:
+            self._write_record(record)
+
+    def _write_record(self, record):
+        record['best_validation_loss'] = float(self.best_validation_loss)
+        if self.debug_time:
+            print('  epoch %i, fetch %.2fs, train %.2fs, score %.2fs, '
+                  'checkpoint %.2fs' % (record['epoch'],
+                      record.get('fetch_seconds', 0.),
+                      record.get('train_seconds', 0.),
+                      record.get('score_seconds', 0.),
+                      record.get('checkpoint_seconds', 0.)))
+        with open(self.stats_file_name, 'a') as f:
+            f.write(json.dumps(record, default=float) + '\n')
+
+    def run(self):
+        """ Trains until max_epochs, NaN costs or early stopping, then saves
+        the final nnet in output_file_name + '_final.pickle'. """
+        print '... training the model'
+        start_time = time.clock()
+        if self.debug_plot:
+            print_mean_weights_biases(self.nnet.params)
+        if self.async_scoring:
+            self._start_scorer()
+        while (self.epoch < self.max_epochs) and (not self.done_looping):
+            self.run_epoch()
+        if self.async_scoring:
+            self._collect(block=True)
+            if self._last_submitted < self.epoch and not self.diverged:
+                # the last parameters have not been scored yet
+                self._submit({'epoch': self.epoch, 'scored_at_end': True})
+                self._collect(block=True)
+            self._scorer.send(None)
+            self._scorer_process.join()
+        end_time = time.clock()
+        print(('Optimization complete with best validation score of %f, '
+               'with test performance %f') %
+                     (self.best_validation_loss, self.best_test_score))
+        print >> sys.stderr, ('The fine tuning code for file ' +
+                              os.path.split(sys.argv[0])[1] +
+                              ' ran for %.2fm' % ((end_time - start_time)
+                                                  / 60.))
+        if hasattr(self.train_fn, 'close'):  # DataParallelTrainer
+            self.train_fn.close()
+        self.checkpoint(self.output_file_name + '_final.pickle')